@@ -0,0 +1,205 @@
+"""
+Cold storage for old chat messages.
+
+``archive_room`` moves a room's messages older than a cutoff out of
+chat_chatmessage and into append-only segments under CHAT_ARCHIVE_ROOT.
+Segments are gzip-compressed JSON Lines, one history row per line. Each
+segment is written as independent gzip members of CHAT_ARCHIVE_BLOCK_SIZE
+rows. Its ArchiveSegment row keeps a sparse index of where every block
+starts, so reading a page means decompressing a block or two, never the
+whole file.
+
+A room's archive always holds a prefix of its history: every seq up to the
+last archived one. The hot table holds the rest. History reads therefore
+only open the archive once they run past the oldest hot message (see
+chat.pagination). Inside the archive, messages are in seq order, which is
+also id order within a room.
+
+Archived messages can't be searched: deleting their rows drops them from
+the search index (chat.search) too. Mention notifications keep a copy of
+the message and stay in the inbox, with ``message_id`` cleared.
+
+Archiving a room holds a lock file in its directory, so two runs never
+archive the same room at once. Segment files get unique names, and a
+segment is only recorded if its rows were all still in the hot table, so
+even without the lock a run can't remove another run's data.
+"""
+import bisect
+import json
+import logging
+import os
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+
+from . import metrics, pagination
+from .models import ArchiveSegment, ChatMessage
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Columns of an archived row; the same as pagination.HISTORY_FIELDS.
+ID, SEQ = 0, 4
+
+
+def segment_path(relative):
+    return os.path.join(settings.CHAT_ARCHIVE_ROOT, relative)
+
+
+def encode_row(row):
+    row = list(row)
+    row[3] = row[3].isoformat()
+    return json.dumps(row, separators=(',', ':'))
+
+
+def decode_row(line):
+    row = json.loads(line)
+    row[3] = datetime.fromisoformat(row[3])
+    return tuple(row)
+
+
+class ArchiveConflict(Exception):
+    """The rows of a segment changed while its file was being written."""
+
+
+@contextmanager
+def room_lock(room_id):
+    """Keep other archive runs, in any process on this storage, off a room."""
+    path = segment_path(f'{room_id}/.lock')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def write_segment(room_id, rows, block_size):
+    """Write ``rows`` to a new segment file; returns its path, sparse index and size."""
+    relative = f'{room_id}/{rows[0][SEQ]:012d}-{rows[-1][SEQ]:012d}-{uuid.uuid4().hex[:8]}.jsonl.gz'
+    target = segment_path(relative)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f'{target}.tmp'
+    blocks = []
+    with open(partial, 'wb') as f:
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            blocks.append([block[0][SEQ], block[0][ID], f.tell()])
+            # wbits=31 writes a complete gzip member.
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            data = ''.join(encode_row(row) + '\n' for row in block).encode()
+            f.write(compressor.compress(data) + compressor.flush())
+        size = f.tell()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, target)
+    return relative, blocks, size
+
+
+def archive_room(room_id, before, segment_size=10_000, block_size=256):
+    """
+    Archive every message of a room up to the newest one sent before
+    ``before``, ``segment_size`` messages per segment. Each segment is
+    written to disk first and then recorded, in the same transaction that
+    deletes its rows from the hot table. Returns how many messages moved.
+    """
+    if not ChatMessage.objects.filter(room_id=room_id, timestamp__lt=before).exists():
+        return 0
+    with room_lock(room_id):
+        return _archive_room(room_id, before, segment_size, block_size)
+
+
+def _archive_room(room_id, before, segment_size, block_size):
+    boundary = (
+        ChatMessage.objects.filter(room_id=room_id, timestamp__lt=before)
+        .aggregate(seq=Max('seq'))['seq']
+    )
+    if boundary is None:
+        return 0
+
+    archived = 0
+    while True:
+        rows = list(
+            ChatMessage.objects.filter(room_id=room_id, seq__lte=boundary)
+            .order_by('seq').values_list(*pagination.HISTORY_FIELDS)[:segment_size]
+        )
+        if not rows:
+            break
+        relative, blocks, size = write_segment(room_id, rows, block_size)
+        try:
+            with transaction.atomic():
+                ArchiveSegment.objects.create(
+                    room_id=room_id,
+                    first_seq=rows[0][SEQ], last_seq=rows[-1][SEQ],
+                    first_id=rows[0][ID], last_id=rows[-1][ID],
+                    count=len(rows), path=relative, size=size, blocks=blocks,
+                )
+                _, deleted = ChatMessage.objects.filter(
+                    room_id=room_id, seq__gte=rows[0][SEQ], seq__lte=rows[-1][SEQ]
+                ).delete()
+                if deleted.get(ChatMessage._meta.label, 0) != len(rows):
+                    raise ArchiveConflict(f'Messages {rows[0][SEQ]}-{rows[-1][SEQ]} of room {room_id} changed')
+        except Exception as e:
+            # Never remove a file that a recorded segment points to.
+            if not ArchiveSegment.objects.filter(path=relative).exists():
+                os.unlink(segment_path(relative))
+            # Another run got to these rows first.
+            if isinstance(e, (ArchiveConflict, IntegrityError)):
+                logger.warning('Stopped archiving room %s: %s', room_id, e)
+                break
+            raise
+        archived += len(rows)
+        metrics.incr('archive.messages', len(rows))
+        metrics.incr('archive.bytes', size)
+    return archived
+
+
+def read_block(segment, index):
+    blocks = segment.blocks
+    start = blocks[index][2]
+    end = blocks[index + 1][2] if index + 1 < len(blocks) else segment.size
+    with open(segment_path(segment.path), 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    metrics.incr('archive.blocks_read')
+    return [decode_row(line) for line in zlib.decompress(data, 31).decode().splitlines()]
+
+
+def rows_after(room_id, seq=None, message_id=None):
+    """
+    Archived rows of a room after ``seq`` or after message ``message_id``
+    (or from the start), oldest first. Blocks are read as the caller goes.
+    """
+    column, position = (SEQ, seq) if seq is not None else (ID, message_id if message_id is not None else -1)
+    field = 'last_seq' if column == SEQ else 'last_id'
+    segments = ArchiveSegment.objects.filter(room_id=room_id, **{f'{field}__gt': position}).order_by('first_seq')
+    for segment in segments:
+        # The last block starting at or before the position holds it.
+        keys = [block[1 if column == ID else 0] for block in segment.blocks]
+        first = max(bisect.bisect_right(keys, position) - 1, 0)
+        for index in range(first, len(segment.blocks)):
+            for row in read_block(segment, index):
+                if row[column] > position:
+                    yield row
+
+
+def rows_before(room_id, message_id=None):
+    """Archived rows of a room before message ``message_id`` (or all), newest first."""
+    segments = ArchiveSegment.objects.filter(room_id=room_id)
+    if message_id is not None:
+        segments = segments.filter(first_id__lt=message_id)
+    for segment in segments.order_by('-first_seq'):
+        keys = [block[1] for block in segment.blocks]
+        last = len(keys) if message_id is None else bisect.bisect_left(keys, message_id)
+        for index in range(last - 1, -1, -1):
+            for row in reversed(read_block(segment, index)):
+                if message_id is None or row[ID] < message_id:
+                    yield row
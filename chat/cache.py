@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .models import ChatRoom, User
+
+
+class LookupCache:
+    """
+    Bounded LRU cache with a TTL for name -> primary key lookups.
+
+    A reverse index from value to keys lets model signals evict an entry by
+    primary key, which also covers renames.
+    """
+
+    def __init__(self, name, maxsize=10000, ttl=300):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._keys_by_value = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    metrics.incr(f'cache.{self.name}.hits')
+                    return value
+                self._remove(key)
+        metrics.incr(f'cache.{self.name}.misses')
+        return None
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._keys_by_value.setdefault(value, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                metrics.incr(f'cache.{self.name}.evictions')
+
+    def invalidate_value(self, value):
+        with self._lock:
+            for key in list(self._keys_by_value.get(value, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._keys_by_value.clear()
+
+    def _remove(self, key):
+        value, _ = self._data.pop(key)
+        keys = self._keys_by_value.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_value[value]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'hits': metrics.get(f'cache.{self.name}.hits'),
+            'misses': metrics.get(f'cache.{self.name}.misses'),
+            'evictions': metrics.get(f'cache.{self.name}.evictions'),
+            'size': len(self),
+        }
+
+
+room_ids = LookupCache('room', settings.CHAT_LOOKUP_CACHE_SIZE, settings.CHAT_LOOKUP_CACHE_TTL)
+user_ids = LookupCache('user', settings.CHAT_LOOKUP_CACHE_SIZE, settings.CHAT_LOOKUP_CACHE_TTL)
+
+
+def _load(cache, queryset, field, key):
+    value = queryset.filter(**{field: key}).values_list('id', flat=True).first()
+    if value is not None:
+        cache.set(key, value)
+    return value
+
+
+def get_room_id(room_name):
+    room_id = room_ids.get(room_name)
+    if room_id is None:
+        room_id = _load(room_ids, ChatRoom.objects, 'name', room_name)
+    return room_id
+
+
+def get_user_id(username):
+    user_id = user_ids.get(username)
+    if user_id is None:
+        user_id = _load(user_ids, User.objects, 'username', username)
+    return user_id
+
+
+async def aget_room_id(room_name):
+    room_id = room_ids.get(room_name)
+    if room_id is None:
+        room_id = await database_sync_to_async(_load)(room_ids, ChatRoom.objects, 'name', room_name)
+    return room_id
@@ -1,10 +1,23 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.db.models import Q
 from .models import ChatRoom, ChatMessage, User
 from channels.layers import get_channel_layer
 from rest_framework.serializers import ModelSerializer
-from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from . import metrics
+from .cache import aget_room_id
+from .notifications import user_group
+from .persistence import get_write_buffer
+from .pagination import paginate_messages
+from .presence import apresence
+from .replay import get_replay
+from .sendqueue import SendQueue
+from .ratelimit import acheck_message
+from .protocol import ProtocolError, chat_event, negotiate
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -12,58 +25,181 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
 
+        # Resolve the user and room once per connection; later frames only
+        # carry the message body.
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+        self.room_id = await aget_room_id(self.room_name)
+        if self.room_id is None or not await self.is_member(self.room_id, user.id):
+            await self.close()
+            return
+        self.user_id = user.id
+        self.username = user.username
+        self.codec = negotiate(self.scope.get('subprotocols'))
+
         # Add user to the room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        # and to their own group for notifications
+        await self.channel_layer.group_add(user_group(self.user_id), self.channel_name)
+
+        if settings.PRESENCE_ENABLED:
+            await apresence('join', self.channel_name, self.room_id, self.room_group_name, self.user_id, self.username)
 
         # Accept the WebSocket connection
-        await self.accept()
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.outbox = SendQueue(
+            self.write_frame, self.codec,
+            size=settings.CHAT_SEND_QUEUE_SIZE, policy=settings.CHAT_SEND_QUEUE_POLICY,
+        )
+        self.outbox.start()
+        get_replay().attach(self.room_id)
+        self.broadcasts = set()
+
+        # A reconnecting client says what it saw last and gets the rest first.
+        last_seq = parse_qs(self.scope.get('query_string', b'').decode()).get('last_seq')
+        if last_seq:
+            try:
+                after_seq = int(last_seq[0])
+            except ValueError:
+                after_seq = None
+            if after_seq is not None and after_seq >= 0:
+                await self.catch_up(after_seq)
 
     async def disconnect(self, close_code):
+        if settings.PRESENCE_ENABLED:
+            await apresence('leave', self.channel_name)
+        if hasattr(self, 'outbox'):
+            self.outbox.close()
+        if hasattr(self, 'broadcasts'):
+            get_replay().detach(self.room_id)
         # Remove user from the room group on disconnect
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        if hasattr(self, 'user_id'):
+            await self.channel_layer.group_discard(user_group(self.user_id), self.channel_name)
 
     # Handle receiving messages from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        user = text_data_json['user']
-        room = text_data_json['room']
-
-        # Save message to the database asynchronously
-        await self.save_message(room, user, message)
-
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            frame = self.codec.decode(text_data, bytes_data)
+            if settings.PRESENCE_ENABLED:
+                await apresence('heartbeat', self.channel_name)
+            if frame.get('type') == 'heartbeat':
+                return
+            message = frame['message']
+            if not isinstance(message, str) or not message:
+                raise ProtocolError('message must be a non-empty string')
+        except (ProtocolError, KeyError):
+            await self.send_frame(self.codec.encode({'error': 'Invalid message frame'}))
+            return
+
+        wait = await acheck_message(self.user_id, self.room_id)
+        if wait:
+            await self.send_frame(self.codec.encode({'error': 'Rate limit exceeded', 'retry_after': round(wait, 3)}))
+            return
+
+        # Queue the message for the write-behind buffer. It is broadcast as
+        # soon as its seq, which clients resume from, is reserved; it is
+        # written with the next batch while this consumer goes on reading
+        # frames.
+        seq, saved = await self.save_message(self.room_id, self.user_id, message)
+        task = asyncio.ensure_future(self.broadcast(seq, saved, message))
+        self.broadcasts.add(task)
+        task.add_done_callback(self.broadcasts.discard)
+
+    async def broadcast(self, seq, saved, message):
+        try:
+            seq = await seq
+        except Exception:
+            await self.send_frame(self.codec.encode({'error': 'Message could not be saved'}))
+            return
         # Send message to the room group
         await self.channel_layer.group_send(
             self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'user': user
-            }
+            chat_event(self.username, message, seq)
         )
+        try:
+            await saved
+        except Exception:
+            await self.send_frame(self.codec.encode({'error': 'Message could not be saved', 'seq': seq}))
+
+    async def catch_up(self, after_seq):
+        limit = settings.CHAT_REPLAY_MAX_MESSAGES
+        found = get_replay().since(self.room_id, after_seq, limit)
+        if found is not None:
+            metrics.incr('replay.memory')
+            messages, has_more = found
+        else:
+            metrics.incr('replay.database')
+            # Messages broadcast but still in the write buffer must be in the table first.
+            await get_write_buffer().flush()
+            page = await database_sync_to_async(paginate_messages)(self.room_id, after_seq=after_seq, limit=limit)
+            messages = [{'user': m['user'], 'message': m['message'], 'seq': m['seq']} for m in page['messages']]
+            has_more = page['has_more']
+        if messages:
+            await self.send_frame(self.codec.encode_batch(messages), messages=messages)
+        if has_more:
+            # Too far behind for one frame; the rest is in the history API.
+            await self.send_frame(self.codec.encode({'catch_up': 'incomplete', 'after_seq': messages[-1]['seq']}))
 
     # Handle sending messages to WebSocket
     async def chat_message(self, event):
-        message = event['message']
-        user = event['user']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'user': user
-        }))
-
-    @sync_to_async
-    def save_message(self, room_name, username, content):
-        room = ChatRoom.objects.get(name=room_name)
-        user = User.objects.get(username=username)
-        ChatMessage.objects.create(room=room, user=user, content=content)
+        get_replay().record(self.room_id, event.get('seq'), event.get('user'), event['message'])
+        # Forward the frame encoded by the sender when there is one
+        frame = event.get('frames', {}).get(self.codec.name)
+        if frame is None:
+            frame = self.codec.encode_chat(event.get('user'), event['message'], event.get('seq'))
+
+        # Queue the frame for the WebSocket
+        message = {'user': event.get('user'), 'message': event['message'], 'seq': event.get('seq')}
+        await self.send_frame(frame, messages=[message])
+
+    # Several messages relayed from RabbitMQ in one frame
+    async def chat_message_batch(self, event):
+        replay = get_replay()
+        for message in event['messages']:
+            replay.record(self.room_id, message.get('seq'), message.get('user'), message['message'])
+        frame = event.get('frames', {}).get(self.codec.name)
+        if frame is None:
+            frame = self.codec.encode_batch(event['messages'])
+        await self.send_frame(frame, messages=event['messages'])
+
+    # Debounced joins and leaves from chat.presence
+    async def presence_update(self, event):
+        frame = event.get('frames', {}).get(self.codec.name)
+        if frame is None:
+            frame = self.codec.encode_presence(event['online'], event['joined'], event['left'])
+        await self.send_frame(frame, presence=(event['online'], event['joined'], event['left']))
+
+    # Mentions of this user, from chat.notifications
+    async def notification_push(self, event):
+        await self.send_frame(self.codec.encode({'notification': event['notification']}))
+
+    async def send_frame(self, frame, messages=None, presence=None):
+        if not self.outbox.put(frame, messages, presence):
+            # Too far behind to catch up live; the client reconnects with
+            # ?last_seq= instead.
+            await self.close(code=1013)
+
+    async def write_frame(self, frame):
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def save_message(self, room_id, user_id, content):
+        return await get_write_buffer().add(room_id, user_id, content)
+
+    @database_sync_to_async
+    def is_member(self, room_id, user_id):
+        return ChatRoom.users.through.objects.filter(chatroom_id=room_id, user_id=user_id).exists()
 
 # Serializer for ChatMessage
 class ChatMessageSerializer(ModelSerializer):
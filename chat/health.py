@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+def check_database(alias='default'):
+    """
+    Run a trivial query on ``alias`` and report how long it took. On SQLite
+    the journal mode is included, so a database that is not in WAL mode
+    shows up. If connections are pooled, the pool's stats are included too.
+    """
+    connection = connections[alias]
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+        elapsed = time.perf_counter() - started
+        info = {
+            'vendor': connection.vendor,
+            'latency_ms': round(elapsed * 1000, 2),
+            'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+        }
+        if connection.vendor == 'sqlite':
+            cursor.execute('PRAGMA journal_mode')
+            info['journal_mode'] = cursor.fetchone()[0]
+    pool = getattr(connection, 'pool', None)
+    if pool is not None:
+        info['pool'] = pool.get_stats()
+    return info
+
+
+def check():
+    return {'profile': settings.CHAT_DB_PROFILE, 'database': check_database()}
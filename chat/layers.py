@@ -0,0 +1,417 @@
+import asyncio
+import logging
+import random
+import string
+import time
+from copy import deepcopy
+from types import MappingProxyType
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedInMemoryChannelLayer(BaseChannelLayer):
+    """
+    In-process channel layer for single-node deployments and tests.
+
+    Unlike channels' InMemoryChannelLayer it does not scan every channel and
+    group on each call: group maps are split into shards, a reverse index
+    tracks each channel's groups, and expired messages and memberships are
+    swept at most once every ``sweep_interval`` seconds. ``group_send`` puts a
+    copy of the message straight onto each member's bounded queue.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 shards=64, sweep_interval=1.0, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.sweep_interval = sweep_interval
+        self.channels = {}
+        # Expiry of the newest message queued on each channel, and how many
+        # receive() calls are waiting on it.
+        self._expires = {}
+        self._waiters = {}
+        self._shards = [{} for _ in range(shards)]
+        self._memberships = {}
+        self._next_sweep = 0
+
+    def _shard(self, group):
+        return self._shards[hash(group) % len(self._shards)]
+
+    def _queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _put(self, channel, message):
+        expires = time.time() + self.expiry
+        self._queue(channel).put_nowait((expires, message))
+        self._expires[channel] = expires
+
+    def _drop(self, channel, queue):
+        if queue.empty() and not self._waiters.get(channel) and self.channels.get(channel) is queue:
+            del self.channels[channel]
+            self._expires.pop(channel, None)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        try:
+            self._put(channel, deepcopy(message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._maybe_sweep()
+        queue = self._queue(channel)
+        self._waiters[channel] = self._waiters.get(channel, 0) + 1
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+                metrics.incr('layer.expired')
+        finally:
+            if self._waiters[channel] == 1:
+                del self._waiters[channel]
+            else:
+                self._waiters[channel] -= 1
+            self._drop(channel, queue)
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.inmemory!%s' % (prefix, ''.join(random.choice(string.ascii_letters) for _ in range(12)))
+
+    # Expiry
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+
+        # Messages expire in the order they were queued, so once the newest
+        # one has expired the whole queue has, and nobody is reading it.
+        for channel, queue in list(self.channels.items()):
+            if not queue.empty() and self._expires.get(channel, now) < now:
+                while not queue.empty():
+                    queue.get_nowait()
+                    metrics.incr('layer.expired')
+                self._remove_from_groups(channel)
+            # A consumer may be waiting in receive() on this very queue;
+            # replacing it would strand whatever is sent next.
+            self._drop(channel, queue)
+
+        cutoff = now - self.group_expiry
+        for shard in self._shards:
+            for group, members in list(shard.items()):
+                for channel, joined in list(members.items()):
+                    if joined < cutoff:
+                        self._discard(group, channel)
+
+    def _remove_from_groups(self, channel):
+        for group in list(self._memberships.get(channel, ())):
+            self._discard(group, channel)
+
+    # Flush extension
+
+    async def flush(self):
+        self.channels = {}
+        self._expires = {}
+        self._shards = [{} for _ in self._shards]
+        self._memberships = {}
+
+    async def close(self):
+        pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._shard(group).setdefault(group, {})[channel] = time.time()
+        self._memberships.setdefault(channel, set()).add(group)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._discard(group, channel)
+
+    def _discard(self, group, channel):
+        shard = self._shard(group)
+        members = shard.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del shard[group]
+        groups = self._memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self._memberships[channel]
+
+    def group_channels(self, group):
+        return list(self._shard(group).get(group, ()))
+
+    def _deliver(self, group, message):
+        members = self._shard(group).get(group)
+        if not members:
+            return
+        # Every recipient gets its own copy, as with channels' in-memory layer,
+        # except for pre-encoded frames: immutable bytes shared read-only.
+        frames = message.get('frames')
+        if frames is not None:
+            frames = MappingProxyType(frames)
+            message = {key: value for key, value in message.items() if key != 'frames'}
+        for channel in members:
+            copied = deepcopy(message)
+            if frames is not None:
+                copied['frames'] = frames
+            try:
+                self._put(channel, copied)
+            except asyncio.QueueFull:
+                metrics.incr('layer.dropped')
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        self._maybe_sweep()
+        self._deliver(group, message)
+
+
+class HybridChannelLayer(ShardedInMemoryChannelLayer):
+    """
+    Local delivery with a cross-node relay for multi-worker deployments.
+
+    Channels created here live in this process and are delivered to
+    directly. For every group with local members, the node joins the group
+    on the ``relay`` layer (e.g. Redis) with a single node channel. A
+    group_send therefore reaches local members without leaving the process,
+    and other nodes get one relayed message per event instead of one per
+    member.
+
+    Nodes announce the groups they join and leave to each other, so a
+    group_send is only relayed when another node has members. A node that
+    has just started relays everything for ``relay_warmup`` seconds while it
+    hears from the others. Relay memberships and announcements are renewed
+    every ``relay_refresh`` seconds, well within the relay's group expiry.
+    """
+
+    nodes_group = 'hybrid_nodes'
+
+    def __init__(self, relay=None, relay_refresh=3600, relay_warmup=5, **kwargs):
+        super().__init__(**kwargs)
+        if isinstance(relay, dict):
+            relay = import_string(relay['BACKEND'])(**relay.get('CONFIG', {}))
+        self.relay = relay
+        self.relay_refresh = relay_refresh
+        self.relay_warmup = relay_warmup
+        self.node = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        self.node_channel = None
+        self._relay_groups = set()
+        self._leaving = set()
+        # group -> {node: when it last announced the group}
+        self._remote = {}
+        self._started = None
+        self._startup_lock = asyncio.Lock()
+        self._relay_task = self._refresh_task = self._leave_task = None
+
+    def is_local(self, channel):
+        return f'.hybrid.{self.node}!' in channel
+
+    async def _ensure_relay(self):
+        if self._started is not None:
+            return
+        # Startup awaits the relay several times; callers arriving meanwhile
+        # wait for it to finish instead of using a half-started node.
+        async with self._startup_lock:
+            if self._started is not None:
+                return
+            self.node_channel = await self.relay.new_channel(prefix='hybrid.node.')
+            await self._join_node_groups()
+            loop = asyncio.get_running_loop()
+            self._relay_task = loop.create_task(self._relay_loop())
+            self._refresh_task = loop.create_task(self._refresh_loop())
+            await self.relay.group_send(self.nodes_group, {'type': 'hybrid.hello', 'origin': self.node})
+            self._started = time.time()
+
+    async def _join_node_groups(self):
+        # Direct sends to this node's consumers arrive through its own group.
+        await self.relay.group_add(f'hybrid_node_{self.node}', self.node_channel)
+        await self.relay.group_add(self.nodes_group, self.node_channel)
+
+    async def _announce(self, target, kind, groups):
+        if groups:
+            await self.relay.group_send(target, {'type': kind, 'origin': self.node, 'groups': sorted(groups)})
+
+    async def _relay_loop(self):
+        while True:
+            try:
+                event = await self.relay.receive(self.node_channel)
+                await self._handle_relayed(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Error receiving from the relay channel layer')
+                await asyncio.sleep(1)
+                continue
+            metrics.incr('layer.relay.received')
+
+    async def _handle_relayed(self, event):
+        kind = event['type']
+        if kind == 'hybrid.send':
+            try:
+                self._put(event['channel'], event['message'])
+            except asyncio.QueueFull:
+                metrics.incr('layer.dropped')
+            return
+        origin = event['origin']
+        if origin == self.node:
+            return
+        if kind == 'hybrid.group':
+            self._deliver(event['group'], event['message'])
+        elif kind == 'hybrid.hello':
+            await self._announce(f'hybrid_node_{origin}', 'hybrid.join', self._relay_groups)
+        elif kind == 'hybrid.join':
+            now = time.time()
+            for group in event['groups']:
+                self._remote.setdefault(group, {})[origin] = now
+        elif kind == 'hybrid.leave':
+            for group in event['groups']:
+                nodes = self._remote.get(group)
+                if nodes is not None:
+                    nodes.pop(origin, None)
+                    if not nodes:
+                        del self._remote[group]
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.relay_refresh)
+            try:
+                await self._join_node_groups()
+                for group in list(self._relay_groups):
+                    await self.relay.group_add(group, self.node_channel)
+                await self._announce(self.nodes_group, 'hybrid.join', self._relay_groups)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Error refreshing relay group memberships')
+            # A node that stopped announcing a group has left it or died.
+            cutoff = time.time() - 2 * self.relay_refresh
+            for group, nodes in list(self._remote.items()):
+                for node, seen in list(nodes.items()):
+                    if seen < cutoff:
+                        del nodes[node]
+                if not nodes:
+                    del self._remote[group]
+
+    def _has_remote_members(self, group):
+        if self._started is None or time.time() - self._started < self.relay_warmup:
+            return True
+        return bool(self._remote.get(group))
+
+    async def new_channel(self, prefix='specific.'):
+        await self._ensure_relay()
+        return '%s.hybrid.%s!%s' % (
+            prefix, self.node, ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        )
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            return await super().send(channel, message)
+        self.require_valid_channel_name(channel)
+        if '.hybrid.' in channel and '!' in channel:
+            # A consumer on another node: route through that node's channel.
+            node = channel.split('.hybrid.', 1)[1].split('!', 1)[0]
+            await self.relay.group_send(
+                f'hybrid_node_{node}', {'type': 'hybrid.send', 'channel': channel, 'message': message}
+            )
+        else:
+            await self.relay.send(channel, message)
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        await self._ensure_relay()
+        self._leaving.discard(group)
+        if group not in self._relay_groups:
+            self._relay_groups.add(group)
+            await self.relay.group_add(group, self.node_channel)
+            await self._announce(self.nodes_group, 'hybrid.join', [group])
+
+    def _discard(self, group, channel):
+        super()._discard(group, channel)
+        if group in self._relay_groups and not self._shard(group).get(group):
+            self._relay_groups.discard(group)
+            self._leaving.add(group)
+
+    def _maybe_sweep(self):
+        super()._maybe_sweep()
+        # Memberships the sweep expired leave the relay in the background.
+        if self._leaving and (self._leave_task is None or self._leave_task.done()):
+            self._leave_task = asyncio.get_running_loop().create_task(self._leave_relay_groups())
+
+    async def _leave_relay_groups(self):
+        while self._leaving:
+            groups, self._leaving = self._leaving, set()
+            left = []
+            # A local member may join a group again at any await; such groups
+            # are skipped, or re-added if their group_add may have lost the
+            # race with our discard on the relay.
+            for group in groups:
+                if group in self._relay_groups:
+                    continue
+                await self.relay.group_discard(group, self.node_channel)
+                if group in self._relay_groups:
+                    await self.relay.group_add(group, self.node_channel)
+                else:
+                    left.append(group)
+            left = [group for group in left if group not in self._relay_groups]
+            await self._announce(self.nodes_group, 'hybrid.leave', left)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        if self._leaving:
+            await self._leave_relay_groups()
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        self._maybe_sweep()
+        self._deliver(group, message)
+        await self._ensure_relay()
+        if not self._has_remote_members(group):
+            metrics.incr('layer.relay.skipped')
+            return
+        # Pre-encoded frames only pay off in-process; remote consumers
+        # encode their own rather than every codec's copy being relayed.
+        message = {key: value for key, value in message.items() if key != 'frames'}
+        await self.relay.group_send(group, {
+            'type': 'hybrid.group', 'origin': self.node, 'group': group, 'message': message,
+        })
+        metrics.incr('layer.relay.sent')
+
+    async def flush(self):
+        await super().flush()
+        self._relay_groups = set()
+        self._leaving = set()
+        self._remote = {}
+        await self.relay.flush()
+
+    async def close(self):
+        for task in (self._relay_task, self._refresh_task, self._leave_task):
+            if task is not None:
+                task.cancel()
+        self._relay_task = self._refresh_task = self._leave_task = None
+        await self.relay.close()
@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import archive_room
+from chat.models import ChatMessage, ChatRoom
+
+
+class Command(BaseCommand):
+    help = (
+        'Move old chat messages from the database into compressed per-room archive segments. '
+        'Archived messages stay in the history but are no longer found by search.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=settings.CHAT_ARCHIVE_AFTER_DAYS,
+                            help='Archive messages older than this many days.')
+        parser.add_argument('--room', action='append', dest='rooms', metavar='NAME',
+                            help='Only archive this room; may be repeated.')
+        parser.add_argument('--segment-size', type=int, default=settings.CHAT_ARCHIVE_SEGMENT_SIZE)
+        parser.add_argument('--block-size', type=int, default=settings.CHAT_ARCHIVE_BLOCK_SIZE)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the messages that would be archived.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        rooms = ChatRoom.objects.order_by('pk')
+        if options['rooms']:
+            rooms = rooms.filter(name__in=options['rooms'])
+        if options['dry_run']:
+            count = ChatMessage.objects.filter(room__in=rooms, timestamp__lt=before).count()
+            self.stdout.write(f'{count} messages were sent before {before:%Y-%m-%d %H:%M:%S}.')
+            return
+        total = 0
+        for room_id, name in rooms.values_list('pk', 'name'):
+            archived = archive_room(room_id, before, options['segment_size'], options['block_size'])
+            if archived:
+                self.stdout.write(f'{name}: archived {archived} messages.')
+            total += archived
+        self.stdout.write(f'Archived {total} messages.')
@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatConsumer
+from chat.protocol import CODECS, JSON, chat_event
+
+
+class Recipient(ChatConsumer):
+    """A ChatConsumer whose socket discards frames."""
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Measure CPU time per broadcast as room size grows, with and without serialize-once fan-out.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000, 20000])
+        parser.add_argument('--broadcasts', type=int, default=20)
+        parser.add_argument('--message-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        codecs = [JSON, *CODECS.values()]
+        message = 'x' * options['message_size']
+        self.stdout.write(f'{"members":>8} {"per-recipient encode":>22} {"serialize once":>16} {"speedup":>8}')
+        for size in options['sizes']:
+            # Spread members evenly over the available wire formats.
+            recipients = [Recipient(codecs[i % len(codecs)]) for i in range(size)]
+            legacy = await self.measure(recipients, options['broadcasts'], lambda: {
+                'type': 'chat_message', 'message': message, 'user': 'bench',
+            })
+            encoded = await self.measure(recipients, options['broadcasts'], lambda: chat_event('bench', message))
+            self.stdout.write(
+                f'{size:>8} {legacy * 1000:>19.3f}ms {encoded * 1000:>13.3f}ms {legacy / encoded:>7.1f}x'
+            )
+
+    async def measure(self, recipients, broadcasts, make_event):
+        start = time.process_time()
+        for _ in range(broadcasts):
+            # The event is built once per broadcast, as the sender would.
+            event = make_event()
+            for recipient in recipients:
+                await recipient.chat_message(event)
+        return (time.process_time() - start) / broadcasts
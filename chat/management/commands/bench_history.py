@@ -0,0 +1,112 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat.models import ChatMessage, ChatRoom
+from chat.pagination import paginate_messages
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway test database with chat messages and compare history '
+        'query plans and latency with and without the history indexes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--batch-size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        # Never touch the real database: build a fresh test database, seed it,
+        # measure and throw it away.
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            rooms = self.seed(options['messages'], options['rooms'], options['batch_size'])
+            target = max(rooms, key=lambda room: room.last_seq)
+            self.stdout.write(f'Seeded {options["messages"]} messages in {len(rooms)} rooms; '
+                              f'benchmarking room {target.name} ({target.last_seq} messages)')
+
+            self.stdout.write(self.style.MIGRATE_HEADING('Without history indexes'))
+            self.drop_indexes()
+            self.run_queries(target, options['repeat'])
+
+            self.stdout.write(self.style.MIGRATE_HEADING('With history indexes'))
+            self.create_indexes()
+            self.run_queries(target, options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, total, room_count, batch_size):
+        user = User.objects.create_user(username='bench')
+        rooms = ChatRoom.objects.bulk_create(ChatRoom(name=f'bench_{i}') for i in range(room_count))
+        seqs = {room.pk: 0 for room in rooms}
+        start = time.perf_counter()
+        batch = []
+        for _ in range(total):
+            room = random.choice(rooms)
+            seqs[room.pk] += 1
+            batch.append(ChatMessage(room=room, user=user, content='x' * 64, seq=seqs[room.pk]))
+            if len(batch) >= batch_size:
+                ChatMessage.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            ChatMessage.objects.bulk_create(batch)
+        for room in rooms:
+            room.last_seq = seqs[room.pk]
+        ChatRoom.objects.bulk_update(rooms, ['last_seq'])
+        self.stdout.write(f'Seeding took {time.perf_counter() - start:.1f}s')
+        return rooms
+
+    def drop_indexes(self):
+        # SQLite drops a unique constraint by rebuilding the table from the
+        # model state, so hide the constraints while they are removed.
+        constraints = ChatMessage._meta.constraints
+        ChatMessage._meta.constraints = []
+        try:
+            with connection.schema_editor() as editor:
+                for constraint in constraints:
+                    editor.remove_constraint(ChatMessage, constraint)
+                for index in ChatMessage._meta.indexes:
+                    editor.remove_index(ChatMessage, index)
+        finally:
+            ChatMessage._meta.constraints = constraints
+
+    def create_indexes(self):
+        with connection.schema_editor() as editor:
+            for index in ChatMessage._meta.indexes:
+                editor.add_index(ChatMessage, index)
+            for constraint in ChatMessage._meta.constraints:
+                editor.add_constraint(ChatMessage, constraint)
+        with connection.cursor() as cursor:
+            if connection.vendor in ('sqlite', 'postgresql'):
+                cursor.execute('ANALYZE')
+
+    def run_queries(self, room, repeat):
+        latest = paginate_messages(room, limit=50)
+        middle_seq = room.last_seq // 2
+        queries = {
+            'latest page': lambda: paginate_messages(room, limit=50),
+            'page before cursor': lambda: paginate_messages(room, before=latest['before'], limit=50),
+            'after seq': lambda: paginate_messages(room, after_seq=middle_seq, limit=50),
+        }
+        plans = {
+            'latest page': ChatMessage.objects.filter(room=room).order_by('-timestamp', '-id')[:51],
+            'after seq': ChatMessage.objects.filter(room=room, seq__gt=middle_seq).order_by('seq')[:51],
+        }
+        for name, queryset in plans.items():
+            self.stdout.write(f'  plan ({name}): {queryset.explain()}')
+        for name, query in queries.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                query()
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            p50 = timings[len(timings) // 2] * 1000
+            p95 = timings[int(len(timings) * 0.95) - 1] * 1000
+            self.stdout.write(f'  {name:<20} p50={p50:.2f}ms p95={p95:.2f}ms')
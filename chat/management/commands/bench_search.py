@@ -0,0 +1,104 @@
+import itertools
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat import search
+from chat.models import ChatMessage, ChatRoom
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway test database with a synthetic corpus and compare '
+        'search latency with a LIKE scan over the messages.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--vocabulary', type=int, default=20_000)
+        parser.add_argument('--words', type=int, default=12, help='Words per message.')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--backend', choices=['fts5', 'inverted'], default=None)
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        previous_backend = search._backend
+        try:
+            if options['backend']:
+                search._backend = options['backend']
+            backend = search.get_backend()
+            # Zipf-like word frequencies; fixed-width words so that no word
+            # is a substring of another and LIKE finds the same messages.
+            vocabulary = [f'w{i:06d}' for i in range(options['vocabulary'])]
+            weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocabulary))))
+            user, rooms = self.seed(options, vocabulary, weights, backend)
+
+            start = time.perf_counter()
+            search.rebuild(batch_size=options['batch_size'])
+            self.stdout.write(f'Rebuilding the {backend} index took {time.perf_counter() - start:.1f}s')
+
+            room = rooms[0]
+            queries = {
+                'common word': (vocabulary[0], None),
+                'rare word': (vocabulary[-1], None),
+                'two words': (f'{vocabulary[5]} {vocabulary[500]}', None),
+                'common word, one room': (vocabulary[0], room.pk),
+            }
+            orders = {'rank': 'rank', 'newest first': 'recent'}
+            for heading, order in orders.items():
+                self.stdout.write(self.style.MIGRATE_HEADING(f'Search ({backend}, {heading})'))
+                for name, (query, room_id) in queries.items():
+                    self.time(name, options['repeat'],
+                              lambda: search.search(query, user, room_id=room_id, limit=50, order=order))
+            self.stdout.write(self.style.MIGRATE_HEADING('LIKE scan'))
+            for name, (query, room_id) in queries.items():
+                self.time(name, options['repeat'], lambda: self.like(query, user, room_id))
+        finally:
+            search._backend = previous_backend
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def seed(self, options, vocabulary, weights, backend):
+        user = User.objects.create_user(username='bench')
+        rooms = ChatRoom.objects.bulk_create(ChatRoom(name=f'bench_{i}') for i in range(options['rooms']))
+        user.chat_rooms.add(*rooms)
+        seqs = {room.pk: 0 for room in rooms}
+        start = time.perf_counter()
+        batch = []
+        for _ in range(options['messages']):
+            room = random.choice(rooms)
+            seqs[room.pk] += 1
+            content = ' '.join(random.choices(vocabulary, cum_weights=weights, k=options['words']))
+            batch.append(ChatMessage(room=room, user=user, content=content, seq=seqs[room.pk]))
+            if len(batch) >= options['batch_size']:
+                ChatMessage.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            ChatMessage.objects.bulk_create(batch)
+        for room in rooms:
+            room.last_seq = seqs[room.pk]
+        ChatRoom.objects.bulk_update(rooms, ['last_seq'])
+        note = ' (including FTS5 triggers)' if backend == 'fts5' else ''
+        self.stdout.write(f'Seeding {options["messages"]} messages took {time.perf_counter() - start:.1f}s{note}')
+        return user, rooms
+
+    def like(self, query, user, room_id):
+        queryset = ChatMessage.objects.filter(room_id=room_id) if room_id else ChatMessage.objects.filter(room__users=user)
+        for word in query.split():
+            queryset = queryset.filter(content__icontains=word)
+        return list(queryset.order_by('-id').values_list('id', flat=True)[:51])
+
+    def time(self, name, repeat, query):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        p50 = timings[len(timings) // 2] * 1000
+        p95 = timings[int(len(timings) * 0.95) - 1] * 1000
+        self.stdout.write(f'  {name:<24} p50={p50:.2f}ms p95={p95:.2f}ms')
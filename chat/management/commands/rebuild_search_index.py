@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the message search index from the stored messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10_000,
+                            help='Messages indexed per transaction by the inverted index.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        total = search.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(f'Indexed {total} messages with {search.get_backend()} '
+                          f'in {time.perf_counter() - start:.1f}s.')
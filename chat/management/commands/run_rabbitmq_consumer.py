@@ -0,0 +1,43 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import metrics
+from chat.rabbitmq_consumer import AsyncRabbitMQConsumer, serve
+
+
+class Command(BaseCommand):
+    help = 'Relay chat messages from RabbitMQ to the channel layer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Consumer connections to run in this process.')
+        parser.add_argument('--prefetch', type=int, default=settings.RABBITMQ_CONSUMER_PREFETCH,
+                            help='Unacknowledged messages per worker.')
+        parser.add_argument('--concurrency', type=int, default=settings.RABBITMQ_CONSUMER_CONCURRENCY,
+                            help='Messages dispatched to the channel layer at once per worker.')
+        parser.add_argument('--batch-window', type=float, default=settings.RABBITMQ_CONSUMER_BATCH_WINDOW,
+                            help='Seconds to collect messages per room into one event (0 disables batching).')
+        parser.add_argument('--max-batch', type=int, default=settings.RABBITMQ_CONSUMER_MAX_BATCH,
+                            help='Relay a room early once this many messages are waiting.')
+        parser.add_argument('--stats-interval', type=float, default=0,
+                            help='Log throughput every N seconds.')
+        parser.add_argument('--queue', default=settings.RABBITMQ_QUEUE)
+
+    def handle(self, *args, **options):
+        consumers = [
+            AsyncRabbitMQConsumer(
+                queue_name=options['queue'],
+                prefetch=options['prefetch'],
+                concurrency=options['concurrency'],
+                batch_window=options['batch_window'],
+                max_batch=options['max_batch'],
+            )
+            for _ in range(options['workers'])
+        ]
+        self.stdout.write(f'Starting {len(consumers)} consumer(s) on {options["queue"]}. To exit press CTRL+C')
+        asyncio.run(serve(consumers, options['stats_interval']))
+        messages = metrics.get('bridge.messages')
+        sends = metrics.get('bridge.group_sends')
+        self.stdout.write(f'Consumers drained and stopped after relaying {messages} messages in {sends} group_sends.')
@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import Invitation, delete_expired_invitations
+from chat.sms import get_dispatcher, requeue_invitations
+
+
+class Command(BaseCommand):
+    help = 'Delete expired invitations in small batches and resend SMS lost while queued.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.INVITATION_SWEEP_BATCH_SIZE)
+        parser.add_argument('--grace-hours', type=float, default=settings.INVITATION_SWEEP_GRACE_HOURS,
+                            help='Keep invitations for this long after they expire.')
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help='Seconds to sleep between batches.')
+        parser.add_argument('--max-batches', type=int, default=None)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the invitations that would be deleted.')
+        parser.add_argument('--requeue-after', type=float, default=settings.SMS_REQUEUE_AFTER_MINUTES,
+                            help='Resend invitations whose SMS has been queued for this many minutes.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(hours=options['grace_hours'])
+        if options['dry_run']:
+            count = Invitation.objects.filter(expires_at__lt=before).count()
+            self.stdout.write(f'{count} invitations expired before {before:%Y-%m-%d %H:%M:%S}.')
+            return
+        requeued = requeue_invitations(timedelta(minutes=options['requeue_after']))
+        if requeued:
+            get_dispatcher().join()
+            self.stdout.write(f'Resent {requeued} queued invitations.')
+        deleted = delete_expired_invitations(
+            before=before,
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            max_batches=options['max_batches'],
+        )
+        self.stdout.write(f'Deleted {deleted} expired invitations.')
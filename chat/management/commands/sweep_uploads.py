@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.media import delete_abandoned_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete unfinished uploads and their partial files once they have been idle too long.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=settings.MEDIA_UPLOAD_EXPIRY_HOURS,
+                            help='Remove uploads idle for longer than this.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(hours=options['hours'])
+        deleted = delete_abandoned_uploads(before=before)
+        self.stdout.write(f'Deleted {deleted} abandoned uploads.')
@@ -0,0 +1,338 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+
+from . import metrics, thumbnails
+from .models import ChatMessage, ChatRoom, MediaFile, MediaUpload
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not on Windows
+    fcntl = None
+
+# Bytes read from the request or disk at a time.
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def media_path(relative):
+    return os.path.join(settings.MEDIA_ROOT, relative)
+
+
+def partial_path(upload):
+    return media_path(f'uploads/partial/{upload.id}')
+
+
+@contextmanager
+def locked_partial(upload):
+    """
+    Open an upload's partial file holding an exclusive lock on it, so only
+    one request at a time writes to it or removes it.
+    """
+    fd = os.open(partial_path(upload), os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+b') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Another chunk is being written', status=409)
+        yield f
+
+
+def is_member(user_id, room_id):
+    return ChatRoom.users.through.objects.filter(chatroom_id=room_id, user_id=user_id).exists()
+
+
+def can_view_media(user, media):
+    """
+    A file is visible to whoever uploaded it and to the members of any room
+    with a message that carries it.
+    """
+    if media.uploaded_by_id == user.id or MediaUpload.objects.filter(media=media, user=user).exists():
+        return True
+    return ChatMessage.objects.filter(media=media, room__users=user).exists()
+
+
+def serialize_media(sha256, size, content_type):
+    data = {
+        'id': sha256,
+        'size': size,
+        'content_type': content_type,
+        'url': f'{settings.MEDIA_URL}uploads/{sha256[:2]}/{sha256}',
+    }
+    if thumbnails.supports(content_type):
+        data['thumbnails'] = {
+            str(size): f'{settings.MEDIA_URL}thumbs/{sha256}/{size}' for size in settings.MEDIA_THUMBNAIL_SIZES
+        }
+    return data
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def store_file(path, sha256, size, content_type, user):
+    """
+    Move a finished file at ``path`` into content-addressed storage and
+    return its MediaFile. If the same content is already stored the new copy
+    is discarded instead.
+    """
+    media = MediaFile.objects.filter(sha256=sha256).first()
+    if media is not None:
+        os.unlink(path)
+        metrics.incr('media.deduplicated')
+        return media
+
+    target = media_path(MediaFile(sha256=sha256).path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # A rename within MEDIA_ROOT; only falls back to copying across filesystems.
+    shutil.move(path, target)
+    try:
+        with transaction.atomic():
+            media = MediaFile.objects.create(
+                sha256=sha256, size=size, content_type=content_type, uploaded_by=user
+            )
+    except IntegrityError:
+        # Stored concurrently by another upload of the same content.
+        media = MediaFile.objects.get(sha256=sha256)
+    metrics.incr('media.stored')
+    transaction.on_commit(lambda: thumbnails.schedule_thumbnails(sha256, target, content_type))
+    return media
+
+
+def store_uploaded_file(file, user):
+    """Store a Django UploadedFile without copying it through memory again."""
+    if file.size > settings.MEDIA_UPLOAD_MAX_SIZE:
+        raise UploadError(f'File exceeds {settings.MEDIA_UPLOAD_MAX_SIZE} bytes', status=413)
+    content_type = file.content_type or guess_content_type(file.name)
+    if hasattr(file, 'temporary_file_path'):
+        path = file.temporary_file_path()
+        return store_file(path, hash_file(path), file.size, content_type, user)
+
+    path = media_path(f'uploads/partial/{os.urandom(16).hex()}')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.sha256()
+    with open(path, 'wb') as destination:
+        for chunk in file.chunks():
+            digest.update(chunk)
+            destination.write(chunk)
+    return store_file(path, digest.hexdigest(), file.size, content_type, user)
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def create_upload(user, filename, size, content_type=None, room=None):
+    if size < 1:
+        raise UploadError('size must be positive')
+    if size > settings.MEDIA_UPLOAD_MAX_SIZE:
+        raise UploadError(f'File exceeds {settings.MEDIA_UPLOAD_MAX_SIZE} bytes', status=413)
+    upload = MediaUpload.objects.create(
+        user=user,
+        room=room,
+        filename=os.path.basename(filename)[:255],
+        content_type=content_type or guess_content_type(filename),
+        size=size,
+    )
+    os.makedirs(os.path.dirname(partial_path(upload)), exist_ok=True)
+    return upload
+
+
+def write_chunk(upload, stream, offset, length):
+    """
+    Append ``length`` bytes read from ``stream`` at ``offset`` and return the
+    new offset. The chunk goes straight from the request to the partial
+    file; whatever arrived before a dropped connection is kept so the client
+    can resume from the returned offset.
+
+    The partial file is locked and the offset re-read before anything is
+    written, so two requests racing on the same offset can't both write.
+    """
+    if length > settings.MEDIA_UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError(f'Chunks are limited to {settings.MEDIA_UPLOAD_MAX_CHUNK_SIZE} bytes', status=413)
+    if offset + length > upload.size:
+        raise UploadError('Chunk runs past the declared size')
+
+    written = 0
+    with locked_partial(upload) as destination:
+        upload.refresh_from_db(fields=['offset', 'media'])
+        if upload.media_id is not None:
+            raise UploadError('Upload already completed', status=409)
+        if offset != upload.offset:
+            raise UploadError(f'Expected offset {upload.offset}', status=409)
+        destination.seek(offset)
+        while written < length:
+            block = stream.read(min(BLOCK_SIZE, length - written))
+            if not block:
+                break
+            destination.write(block)
+            written += len(block)
+        destination.truncate()
+
+        # Without flock (Windows) this is the only guard against a racing writer.
+        updated = MediaUpload.objects.filter(pk=upload.pk, offset=offset).update(offset=offset + written)
+        if not updated:
+            raise UploadError('Upload was modified concurrently', status=409)
+    upload.offset = offset + written
+    metrics.incr('media.bytes_received', written)
+    return upload.offset
+
+
+def complete_upload(upload):
+    """
+    Hash the finished upload, store it and post it to the room if it has
+    one. The uploader must still be a member of that room; otherwise the
+    partial file is left for delete_abandoned_uploads.
+    """
+    if upload.room_id is not None and not is_member(upload.user_id, upload.room_id):
+        raise UploadError('Not a member of this room', status=403)
+    path = partial_path(upload)
+    media = store_file(path, hash_file(path), upload.size, upload.content_type, upload.user)
+    with transaction.atomic():
+        upload.media = media
+        upload.save(update_fields=['media'])
+        message = None
+        if upload.room_id is not None:
+            message = ChatMessage.objects.create(
+                room_id=upload.room_id, user=upload.user, content=upload.filename, media=media
+            )
+    return media, message
+
+
+def delete_abandoned_uploads(before=None):
+    """
+    Delete unfinished uploads started before ``before`` (default: now minus
+    MEDIA_UPLOAD_EXPIRY_HOURS) that haven't received a chunk since, along
+    with their partial files. Returns how many were removed.
+    """
+    before = before or timezone.now() - timedelta(hours=settings.MEDIA_UPLOAD_EXPIRY_HOURS)
+    deleted = 0
+    for upload in MediaUpload.objects.filter(media__isnull=True, created_at__lt=before).iterator():
+        path = partial_path(upload)
+        try:
+            if os.path.getmtime(path) >= before.timestamp():
+                continue
+        except FileNotFoundError:
+            pass
+        try:
+            with locked_partial(upload):
+                # A chunk may have completed the upload since it was listed.
+                if not MediaUpload.objects.filter(pk=upload.pk, media__isnull=True).delete()[0]:
+                    continue
+                os.unlink(path)
+        except UploadError:
+            # A chunk is being written right now.
+            continue
+        deleted += 1
+    metrics.incr('media.uploads_expired', deleted)
+    return deleted
+
+
+# Serving
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Parse a single ``bytes=`` range into inclusive (start, end) offsets.
+    Returns None when the whole file should be sent, which includes
+    malformed and multi-range headers.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(size - suffix, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+
+async def iter_file(path, start, length):
+    """Read a slice of a file in blocks off the event loop."""
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(f.seek, start)
+        while length > 0:
+            block = await asyncio.to_thread(f.read, min(BLOCK_SIZE * 4, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+def media_response(request, relative, etag, content_type, size):
+    """
+    Respond with a stored file, honouring If-None-Match and Range. Stored
+    files never change, so the ETag is derived from the content hash and
+    clients may cache them indefinitely.
+
+    With MEDIA_SENDFILE_HEADER set (X-Accel-Redirect for nginx, X-Sendfile
+    for Apache), the body is left to the front-end server, which sends it
+    with sendfile(2) and handles ranges itself.
+    """
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes',
+    }
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        metrics.incr('media.not_modified')
+        return HttpResponseNotModified(headers={'ETag': etag, 'Cache-Control': headers['Cache-Control']})
+
+    if settings.MEDIA_SENDFILE_HEADER:
+        metrics.incr('media.sendfile')
+        headers[settings.MEDIA_SENDFILE_HEADER] = f'{settings.MEDIA_SENDFILE_ROOT}{relative}'
+        return HttpResponse(content_type=content_type, headers=headers)
+
+    byte_range = None
+    if request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except RangeNotSatisfiable:
+            return HttpResponse(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+    start, end = byte_range or (0, size - 1)
+    headers['Content-Length'] = str(end - start + 1)
+    if byte_range:
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    metrics.incr('media.bytes_served', end - start + 1)
+    return StreamingHttpResponse(
+        iter_file(media_path(relative), start, end - start + 1),
+        status=206 if byte_range else 200,
+        content_type=content_type,
+        headers=headers,
+    )
@@ -0,0 +1,37 @@
+import threading
+from collections import Counter
+
+# Process-local counters and gauges for the chat hot paths. They are cheap
+# enough to bump on every message and are exposed through MetricsView.
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name, value):
+    _gauges[name] = value
+
+
+def get(name):
+    with _lock:
+        if name in _counters:
+            return _counters[name]
+    return _gauges.get(name, 0)
+
+
+def snapshot():
+    with _lock:
+        data = dict(_counters)
+    data.update(_gauges)
+    return data
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+    _gauges.clear()
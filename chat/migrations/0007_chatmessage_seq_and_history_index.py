@@ -0,0 +1,54 @@
+from django.db import migrations, models
+
+
+def backfill_seq(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    for room in ChatRoom.objects.all().iterator():
+        seq = 0
+        batch = []
+        messages = ChatMessage.objects.filter(room=room).order_by('timestamp', 'id').only('id')
+        for message in messages.iterator(chunk_size=2000):
+            seq += 1
+            message.seq = seq
+            batch.append(message)
+            if len(batch) >= 2000:
+                ChatMessage.objects.bulk_update(batch, ['seq'])
+                batch = []
+        if batch:
+            ChatMessage.objects.bulk_update(batch, ['seq'])
+        ChatRoom.objects.filter(pk=room.pk).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_alter_invitation_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=['room', 'seq'], name='chat_msg_room_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatmessage_seq_and_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invitation',
+            name='sms_status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='invitation',
+            name='sms_error',
+            field=models.TextField(blank=True),
+        ),
+    ]
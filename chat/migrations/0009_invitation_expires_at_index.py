@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:24
+
+import chat.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_invitation_sms_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invitation',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, default=chat.models.invitation_expiry),
+        ),
+    ]
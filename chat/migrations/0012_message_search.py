@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_fts5(apps, schema_editor):
+    from chat.search import fts5_available, install_fts5
+
+    if fts5_available(schema_editor.connection):
+        install_fts5(schema_editor.connection)
+        schema_editor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+
+
+def drop_fts5(apps, schema_editor):
+    from chat.search import uninstall_fts5
+
+    if schema_editor.connection.vendor == 'sqlite':
+        uninstall_fts5(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_notifications'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatmessage')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'room', 'message'], name='chat_term_lookup_idx')],
+            },
+        ),
+        migrations.RunPython(create_fts5, drop_fts5),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_messages(apps, schema_editor):
+    Notification = apps.get_model('chat', 'Notification')
+    batch = []
+    notifications = Notification.objects.select_related('message__user').only(
+        'id', 'message__seq', 'message__content', 'message__user__username',
+    )
+    for notification in notifications.iterator(chunk_size=2000):
+        message = notification.message
+        notification.seq = message.seq
+        notification.sender = message.user.username
+        notification.content = message.content
+        batch.append(notification)
+        if len(batch) >= 2000:
+            Notification.objects.bulk_update(batch, ['seq', 'sender', 'content'])
+            batch = []
+    if batch:
+        Notification.objects.bulk_update(batch, ['seq', 'sender', 'content'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='content',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='sender',
+            field=models.CharField(blank=True, default='', max_length=150),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='message',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='chat.chatmessage'),
+        ),
+        migrations.RunPython(copy_messages, migrations.RunPython.noop),
+    ]
@@ -1,27 +1,232 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.dispatch import Signal
 from django.contrib.auth.models import User
 from django.utils import timezone
+import time
+import uuid
 from datetime import timedelta
 
+# Sent with ``messages=[...]`` once ChatMessages are inserted, including by
+# bulk_create, which skips post_save. Sent after the inserting transaction
+# commits (see send_messages_created).
+messages_created = Signal()
+
+INVITATION_TTL = timedelta(days=2)
+
+
+def send_messages_created(messages):
+    """
+    Send messages_created once the current transaction commits, so receivers
+    neither hold its locks nor roll the messages back. A failing receiver is
+    logged by send_robust and doesn't keep the others from running.
+    """
+    transaction.on_commit(lambda: messages_created.send_robust(sender=ChatMessage, messages=messages))
+
+
+def invitation_expiry():
+    return timezone.now() + INVITATION_TTL
+
+
 class ChatRoom(models.Model):
     name = models.CharField(max_length=100, unique=True)
     users = models.ManyToManyField(User, related_name='chat_rooms')
+    # Highest ChatMessage.seq handed out in this room.
+    last_seq = models.PositiveBigIntegerField(default=0)
 
 class Invitation(models.Model):
+    SMS_QUEUED = 'queued'
+    # Claimed by requeue_invitations (chat.sms) for sending again.
+    SMS_SENDING = 'sending'
+    SMS_SENT = 'sent'
+    SMS_FAILED = 'failed'
+    SMS_STATUS_CHOICES = [
+        (SMS_QUEUED, 'Queued'),
+        (SMS_SENDING, 'Sending'),
+        (SMS_SENT, 'Sent'),
+        (SMS_FAILED, 'Failed'),
+    ]
+
     first_name = models.CharField(max_length=100)
     last_name = models.CharField(max_length=100)
     phone_number = models.CharField(max_length=20)
     invited_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
-    expires_at = models.DateTimeField(default=timezone.now() +timedelta(days=2))
+    expires_at = models.DateTimeField(default=invitation_expiry, db_index=True)
+    sms_status = models.CharField(max_length=10, choices=SMS_STATUS_CHOICES, default=SMS_QUEUED)
+    sms_error = models.TextField(blank=True)
+    # Which requeue run claimed the invitation.
+    sms_claim = models.UUIDField(null=True, blank=True, editable=False)
 
     def save(self, *args, **kwargs):
         if not self.expires_at:
-            self.expires_at = timezone.now() + timedelta(days=2)
+            self.expires_at = invitation_expiry()
         super().save(*args, **kwargs)
 
+class MediaFile(models.Model):
+    """A stored upload, named and deduplicated by the SHA-256 of its content."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveBigIntegerField()
+    content_type = models.CharField(max_length=100, blank=True)
+    uploaded_by = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def path(self):
+        return f'uploads/{self.sha256[:2]}/{self.sha256}'
+
+class MediaUpload(models.Model):
+    """An upload in progress; ``offset`` bytes have been written so far."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    room = models.ForeignKey(ChatRoom, null=True, blank=True, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    media = models.ForeignKey(MediaFile, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+
 class ChatMessage(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    media = models.ForeignKey(MediaFile, null=True, blank=True, on_delete=models.SET_NULL, related_name='messages')
+    timestamp = models.DateTimeField(auto_now_add=True)
+    # Per-room, monotonically increasing position of the message so clients
+    # can catch up with "everything after seq N".
+    seq = models.PositiveBigIntegerField(editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_msg_room_seq_uniq'),
+        ]
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        with transaction.atomic():
+            if self.seq is None:
+                self.seq = allocate_seq(self.room_id)
+            super().save(*args, **kwargs)
+            if created:
+                send_messages_created([self])
+
+class RoomReadState(models.Model):
+    """
+    How far a user has read in a room. Unread messages are the room's
+    last_seq minus last_read_seq, so new messages need no per-member writes;
+    unread_mentions is kept up to date as mentions are delivered.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+    unread_mentions = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='chat_read_state_user_room_uniq'),
+        ]
+
+class Notification(models.Model):
+    """
+    A mention of ``user``. The message's seq, sender and text are copied in,
+    so the notification outlives the message row when it is archived.
+    """
+    MENTION = 'mention'
+    KIND_CHOICES = [(MENTION, 'Mention')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    message = models.ForeignKey(ChatMessage, on_delete=models.SET_NULL, null=True)
+    seq = models.PositiveBigIntegerField(default=0)
+    sender = models.CharField(max_length=150, blank=True, default='')
+    content = models.TextField(blank=True, default='')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default=MENTION)
+    read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # The inbox: newest first, optionally only unread.
+            models.Index(fields=['user', 'read', '-id'], name='chat_notif_inbox_idx'),
+        ]
+
+class MessageTerm(models.Model):
+    """
+    A word of a message, for search on databases without SQLite FTS5 (see
+    chat.search). The room is copied from the message so that room-scoped
+    searches stay inside the term index.
+    """
+    term = models.CharField(max_length=64)
+    message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, related_name='+')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'room', 'message'], name='chat_term_lookup_idx'),
+        ]
+
+class ArchiveSegment(models.Model):
+    """
+    An append-only, gzip-compressed JSON Lines file of archived messages of
+    one room (see chat.archive). ``blocks`` is its sparse index:
+    ``[first_seq, first_id, byte_offset]`` for every compressed block.
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archive_segments')
+    first_seq = models.PositiveBigIntegerField()
+    last_seq = models.PositiveBigIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    count = models.PositiveIntegerField()
+    path = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    blocks = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'first_seq'], name='chat_archive_room_seq_uniq'),
+        ]
+
+
+def allocate_seq(room_id, count=1):
+    """
+    Reserve ``count`` consecutive sequence numbers in a room and return the
+    first one. Call it inside the transaction that inserts the messages so the
+    room row stays locked until they are written.
+    """
+    with transaction.atomic():
+        ChatRoom.objects.filter(pk=room_id).update(last_seq=F('last_seq') + count)
+        last_seq = ChatRoom.objects.filter(pk=room_id).values_list('last_seq', flat=True).get()
+    return last_seq - count + 1
+
+
+def delete_expired_invitations(before=None, batch_size=500, pause=0, max_batches=None):
+    """
+    Delete invitations that expired before ``before`` (default: now) in
+    batches of ``batch_size`` and return how many were removed. Every batch
+    is its own short transaction found through the expires_at index, so the
+    table is never locked for long; ``pause`` seconds between batches leaves
+    room for other writers.
+    """
+    before = before or timezone.now()
+    deleted = batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = list(
+            Invitation.objects.filter(expires_at__lt=before)
+            .order_by('expires_at').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        count, _ = Invitation.objects.filter(pk__in=ids).delete()
+        deleted += count
+        batches += 1
+        if len(ids) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return deleted
@@ -0,0 +1,175 @@
+"""
+Per-user notification inbox.
+
+Mentions are fanned out once the messages are committed, in a transaction
+of their own: every ``@username`` that names a member of the room becomes a
+Notification row for that user, the user's unread mention counter for the
+room is bumped, and the notification is pushed to their open WebSockets
+once that transaction commits. Unread
+message counts need no fan-out at all: they are the room's ``last_seq``
+minus the user's ``last_read_seq``.
+"""
+import logging
+import re
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from . import metrics
+from .models import ChatRoom, Notification, RoomReadState, User
+
+logger = logging.getLogger(__name__)
+
+MENTION_RE = re.compile(r'(?<![\w@])@([\w.@+-]+)')
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def find_mentions(content):
+    names = []
+    for name in MENTION_RE.findall(content or ''):
+        # Trailing punctuation belongs to the sentence, not the name.
+        name = name.rstrip('.')
+        if name and name not in names:
+            names.append(name)
+    return names[:settings.NOTIFICATION_MAX_MENTIONS]
+
+
+def fan_out(messages):
+    """Create mention notifications for freshly inserted messages."""
+    mentions = [(message, find_mentions(message.content)) for message in messages]
+    names = {name for _, found in mentions for name in found}
+    if not names:
+        return []
+
+    user_ids = dict(User.objects.filter(username__in=names).values_list('username', 'id'))
+    room_ids = {message.room_id for message, found in mentions if found}
+    members = set(
+        ChatRoom.users.through.objects
+        .filter(chatroom_id__in=room_ids, user_id__in=user_ids.values())
+        .values_list('chatroom_id', 'user_id')
+    )
+
+    notifications = []
+    for message, found in mentions:
+        for name in found:
+            user_id = user_ids.get(name)
+            if user_id is None or user_id == message.user_id or (message.room_id, user_id) not in members:
+                continue
+            notifications.append(Notification(
+                user_id=user_id, room_id=message.room_id, message=message, seq=message.seq, content=message.content,
+            ))
+    if not notifications:
+        return []
+    senders = dict(User.objects.filter(pk__in={n.message.user_id for n in notifications}).values_list('id', 'username'))
+    for notification in notifications:
+        notification.sender = senders[notification.message.user_id]
+
+    notifications = Notification.objects.bulk_create(notifications)
+    counts = Counter((n.user_id, n.room_id) for n in notifications)
+    RoomReadState.objects.bulk_create(
+        [RoomReadState(user_id=user_id, room_id=room_id) for user_id, room_id in counts],
+        ignore_conflicts=True,
+    )
+    for (user_id, room_id), count in counts.items():
+        RoomReadState.objects.filter(user_id=user_id, room_id=room_id).update(
+            unread_mentions=F('unread_mentions') + count
+        )
+    metrics.incr('notifications.created', len(notifications))
+
+    events = [(n.user_id, serialize_notification(n)) for n in notifications]
+    transaction.on_commit(lambda: push(events))
+    return notifications
+
+
+def serialize_notification(notification):
+    return {
+        'id': notification.id,
+        'kind': notification.kind,
+        'room_id': notification.room_id,
+        # None once the message was archived.
+        'message_id': notification.message_id,
+        'seq': notification.seq,
+        'user': notification.sender,
+        'message': notification.content,
+        'read': notification.read,
+        'created_at': notification.created_at.isoformat(),
+    }
+
+
+def push(events):
+    channel_layer = get_channel_layer()
+    try:
+        for user_id, notification in events:
+            async_to_sync(channel_layer.group_send)(
+                user_group(user_id), {'type': 'notification_push', 'notification': notification}
+            )
+    except Exception:
+        # The inbox is the source of truth; clients catch up on their next read.
+        logger.exception('Failed to push %d notifications', len(events))
+
+
+def inbox(user, limit, unread_only=False):
+    """Unread counters for every room of ``user`` and their latest notifications."""
+    states = RoomReadState.objects.filter(user=user, room=OuterRef('pk'))
+    rooms = (
+        ChatRoom.objects.filter(users=user)
+        .annotate(
+            last_read=Coalesce(Subquery(states.values('last_read_seq')[:1]), Value(0)),
+            mentions=Coalesce(Subquery(states.values('unread_mentions')[:1]), Value(0)),
+        )
+        .values_list('name', 'last_seq', 'last_read', 'mentions')
+        .order_by('name')
+    )
+    queryset = Notification.objects.filter(user=user)
+    if unread_only:
+        queryset = queryset.filter(read=False)
+    notifications = queryset.order_by('-id')[:limit]
+    return {
+        'rooms': [
+            {'room_name': name, 'unread': max(last_seq - last_read, 0), 'unread_mentions': mentions}
+            for name, last_seq, last_read, mentions in rooms
+        ],
+        'notifications': [serialize_notification(n) for n in notifications],
+    }
+
+
+def mark_read(user, rooms=None, notification_ids=None):
+    """
+    Mark several rooms read up to a seq (``{room_id: seq}``) and individual
+    notifications read in one transaction. Returns the affected room ids.
+    """
+    rooms = rooms or {}
+    touched = set(rooms)
+    with transaction.atomic():
+        if rooms:
+            RoomReadState.objects.bulk_create(
+                [RoomReadState(user=user, room_id=room_id) for room_id in rooms], ignore_conflicts=True
+            )
+            for room_id, seq in rooms.items():
+                RoomReadState.objects.filter(user=user, room_id=room_id).update(
+                    last_read_seq=Greatest(F('last_read_seq'), Value(seq))
+                )
+                Notification.objects.filter(
+                    user=user, room_id=room_id, read=False, seq__lte=seq
+                ).update(read=True)
+        if notification_ids:
+            unread = Notification.objects.filter(user=user, pk__in=notification_ids, read=False)
+            touched.update(unread.values_list('room_id', flat=True))
+            unread.update(read=True)
+
+        # Recount only the rooms that changed.
+        counts = dict(
+            Notification.objects.filter(user=user, room_id__in=touched, read=False)
+            .values('room_id').annotate(count=Count('id')).values_list('room_id', 'count')
+        )
+        for room_id in touched:
+            RoomReadState.objects.filter(user=user, room_id=room_id).update(unread_mentions=counts.get(room_id, 0))
+    return touched
@@ -0,0 +1,209 @@
+import base64
+import json
+from datetime import datetime
+from itertools import chain, islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+
+from . import archive
+from .media import serialize_media
+from .models import ChatMessage
+
+DEFAULT_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+STREAM_CHUNK_SIZE = getattr(settings, 'CHAT_HISTORY_STREAM_CHUNK_SIZE', 2000)
+# Rows joined into a single chunk of the streamed response.
+STREAM_FLUSH_ROWS = 200
+
+# Only the columns the history payload needs; user__username is pulled in
+# through the join instead of one query per row.
+HISTORY_FIELDS = (
+    'id', 'user__username', 'content', 'timestamp', 'seq',
+    'media__sha256', 'media__size', 'media__content_type',
+)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, message_id):
+    raw = f'{timestamp.isoformat()}|{message_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor(f'Invalid cursor: {cursor!r}')
+
+
+def parse_limit(value):
+    if value in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def parse_seq(value):
+    if value in (None, ''):
+        return None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('after_seq must be an integer')
+    if seq < 0:
+        raise ValueError('after_seq must not be negative')
+    return seq
+
+
+def serialize_row(row):
+    message_id, username, content, timestamp, seq, media_sha256, media_size, media_type = row
+    return {
+        'id': message_id,
+        'seq': seq,
+        'user': username,
+        'message': content,
+        'timestamp': timestamp.isoformat(),
+        'media': serialize_media(media_sha256, media_size, media_type) if media_sha256 else None,
+    }
+
+
+def history_queryset(room):
+    return ChatMessage.objects.filter(room=room).values_list(*HISTORY_FIELDS)
+
+
+def paginate_messages(room, before=None, after=None, after_seq=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Keyset pagination over (timestamp, id).
+
+    Without a cursor the newest page is returned. ``before`` walks towards
+    older messages and ``after`` towards newer ones; either way the page is
+    returned in chronological order. ``after_seq`` pages forward through the
+    room's sequence numbers instead of a cursor.
+
+    Pages are read from the hot table; archived messages (chat.archive) are
+    only read once a page reaches past the oldest message still in it.
+    """
+    room_id = getattr(room, 'pk', room)
+    queryset = history_queryset(room)
+
+    if after_seq is not None:
+        rows = list(queryset.filter(seq__gt=after_seq).order_by('seq')[:limit + 1])
+        if not rows or rows[0][4] != after_seq + 1:
+            # Seqs have no gaps, so the ones missing are in the archive.
+            rows = list(islice(chain(archive.rows_after(room_id, seq=after_seq), rows), limit + 1))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    elif after is not None:
+        timestamp, message_id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+        ).order_by('timestamp', 'id')
+        rows = list(queryset[:limit + 1])
+        rows = list(islice(chain(archive.rows_after(room_id, message_id=message_id), rows), limit + 1))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        message_id = None
+        if before is not None:
+            timestamp, message_id = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+            )
+        queryset = queryset.order_by('-timestamp', '-id')
+        rows = list(queryset[:limit + 1])
+        if len(rows) <= limit:
+            # Ran past the oldest hot message.
+            rows += islice(archive.rows_before(room_id, message_id=message_id), limit + 1 - len(rows))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+
+    page = {
+        'messages': [serialize_row(row) for row in rows],
+        'has_more': has_more,
+        'before': None,
+        'after': None,
+    }
+    if rows:
+        first, last = rows[0], rows[-1]
+        page['before'] = encode_cursor(first[3], first[0])
+        page['after'] = encode_cursor(last[3], last[0])
+    return page
+
+
+def stream_messages(room):
+    """
+    Yield the whole room history as a JSON document, chunk by chunk.
+
+    Archived messages come first, a block at a time, then the hot table is
+    read with a server-side iterator, so memory stays flat no matter how
+    large the room is.
+    """
+    queryset = history_queryset(room).order_by('timestamp', 'id')
+    yield '{"messages": ['
+    buffer = []
+    separator = ''
+    rows = chain(archive.rows_after(getattr(room, 'pk', room)), queryset.iterator(chunk_size=STREAM_CHUNK_SIZE))
+    for row in rows:
+        buffer.append(separator + json.dumps(serialize_row(row)))
+        separator = ','
+        if len(buffer) >= STREAM_FLUSH_ROWS:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+    yield ']}'
+
+
+def _encode_rows(rows, separator):
+    rows = list(rows)
+    chunks = []
+    for start in range(0, len(rows), STREAM_FLUSH_ROWS):
+        encoded = (json.dumps(serialize_row(row)) for row in rows[start:start + STREAM_FLUSH_ROWS])
+        chunks.append(separator + ','.join(encoded))
+        separator = ','
+    return rows, chunks
+
+
+async def astream_messages(room):
+    """
+    ``stream_messages`` for ASGI, where a sync generator would be drained
+    in a thread and sent as one buffer. Archived rows and then keyset pages
+    of the hot table are read and encoded in a worker thread,
+    STREAM_CHUNK_SIZE rows at a time.
+    """
+    yield '{"messages": ['
+    separator = ''
+    archived = archive.rows_after(getattr(room, 'pk', room))
+    while True:
+        rows, chunks = await sync_to_async(_encode_rows)(islice(archived, STREAM_CHUNK_SIZE), separator)
+        for chunk in chunks:
+            yield chunk
+        if rows:
+            separator = ','
+        if len(rows) < STREAM_CHUNK_SIZE:
+            break
+    queryset = page = history_queryset(room).order_by('timestamp', 'id')
+    while True:
+        rows, chunks = await sync_to_async(_encode_rows)(page[:STREAM_CHUNK_SIZE], separator)
+        for chunk in chunks:
+            yield chunk
+        if len(rows) < STREAM_CHUNK_SIZE:
+            break
+        separator = ','
+        timestamp, message_id = rows[-1][3], rows[-1][0]
+        page = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id))
+    yield ']}'
@@ -0,0 +1,343 @@
+import asyncio
+import atexit
+import logging
+import weakref
+from collections import defaultdict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, transaction
+
+from .models import ChatMessage, ChatRoom, allocate_seq, send_messages_created
+
+logger = logging.getLogger(__name__)
+
+
+def group_by_room(messages):
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message.room_id].append(message)
+    return by_room
+
+
+def write_messages(messages):
+    """
+    Insert ``messages`` in one transaction, with a bulk INSERT per room.
+    Messages without a seq get one from a single reservation per room; seqs
+    handed out beforehand by a write buffer raise the room's last_seq.
+    """
+    allocated = []
+    try:
+        with transaction.atomic():
+            for room_id, room_messages in group_by_room(messages).items():
+                unsequenced = [message for message in room_messages if message.seq is None]
+                if unsequenced:
+                    first_seq = allocate_seq(room_id, len(unsequenced))
+                    for offset, message in enumerate(unsequenced):
+                        message.seq = first_seq + offset
+                    allocated += unsequenced
+                ChatMessage.objects.bulk_create(room_messages)
+                top = max(message.seq for message in room_messages)
+                ChatRoom.objects.filter(pk=room_id, last_seq__lt=top).update(last_seq=top)
+            send_messages_created(messages)
+    except Exception:
+        # Rolled back; the messages may be written again.
+        for message in messages:
+            message.pk = None
+        for message in allocated:
+            message.seq = None
+        raise
+
+
+def persist_messages(pending):
+    """
+    Write a batch of ``(room_id, user_id, content)`` tuples, or
+    ``(room_id, user_id, content, seq)`` ones whose seq was reserved
+    already. Returns, in the same order, each saved message or the
+    exception that kept it from being written.
+
+    The whole batch is tried in one transaction first. If that fails, every
+    room is written in a transaction of its own, and the messages of a room
+    that still fails one at a time, so a bad row (or a room deleted in the
+    meantime) only loses itself. An OperationalError, e.g. a locked
+    database, is returned as is for the caller to retry.
+    """
+    if not pending:
+        return []
+    created = [
+        ChatMessage(room_id=room_id, user_id=user_id, content=content, seq=seq[0] if seq else None)
+        for room_id, user_id, content, *seq in pending
+    ]
+    try:
+        write_messages(created)
+        return created
+    except OperationalError as e:
+        return [e] * len(created)
+    except Exception:
+        logger.warning('Failed to persist a batch of %d chat messages; writing them per room', len(created))
+
+    results = {}
+    for room_messages in group_by_room(created).values():
+        try:
+            write_messages(room_messages)
+        except Exception as e:
+            if len(room_messages) == 1:
+                results[id(room_messages[0])] = e
+                continue
+            for message in room_messages:
+                try:
+                    write_messages([message])
+                except Exception as e:
+                    results[id(message)] = e
+    for result in results.values():
+        if not isinstance(result, OperationalError):
+            logger.error('Failed to persist a chat message: %r', result)
+    return [results.get(id(message), message) for message in created]
+
+
+def read_last_seqs(room_ids):
+    return dict(ChatRoom.objects.filter(pk__in=room_ids).values_list('pk', 'last_seq'))
+
+
+class MessageWriteBuffer:
+    """
+    Write-behind buffer for chat messages received over WebSockets.
+
+    Consumers hand messages over with ``add`` and carry on. ``add`` returns
+    two futures: the message's seq and the saved message. Seqs are counted
+    in memory per room, from the room's last_seq read when the room first
+    gets a message, so the seq is normally known at once and the message
+    can be broadcast before it is written. The buffer persists messages
+    with ``bulk_create``, raising last_seq with them, once ``batch_size``
+    are waiting or ``flush_interval`` seconds have passed. When
+    ``max_pending`` messages are queued, ``add`` waits for the next flush.
+    Reads and writes that failed with an OperationalError are tried again
+    up to ``retries`` times, ``retry_delay`` seconds apart and doubling.
+
+    Every flush re-reads last_seq for the rooms it wrote and forgets rooms
+    that went quiet, so seqs taken meanwhile by REST posts or other
+    processes are skipped. A message whose seq was taken anyway in that
+    window is written with the next free seq, and keeps the seq it was
+    broadcast with only in clients that saw the broadcast.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=0.1, max_pending=10000, retries=3, retry_delay=0.1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pending = []
+        self._futures = []
+        # room_id -> next seq to hand out
+        self._next_seq = {}
+        # room_id -> [(user_id, content, seq future, saved future)] waiting for the room's last_seq
+        self._unsequenced = {}
+        self._reserving = 0
+        self._allocators = {}
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closed = False
+
+    @property
+    def queued(self):
+        return len(self.pending) + self._reserving
+
+    async def add(self, room_id, user_id, content):
+        if self._closed:
+            raise RuntimeError('Write buffer is closed')
+        while self.queued >= self.max_pending:
+            self._space.clear()
+            self._wakeup.set()
+            await self._space.wait()
+        loop = asyncio.get_running_loop()
+        seq, saved = loop.create_future(), loop.create_future()
+        if room_id in self._next_seq and room_id not in self._unsequenced:
+            self._queue(room_id, [(user_id, content, seq, saved)])
+        else:
+            self._unsequenced.setdefault(room_id, []).append((user_id, content, seq, saved))
+            self._reserving += 1
+            if room_id not in self._allocators:
+                self._allocators[room_id] = loop.create_task(self._allocate(room_id))
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+        return seq, saved
+
+    def _queue(self, room_id, waiting):
+        first_seq = self._next_seq[room_id]
+        self._next_seq[room_id] = first_seq + len(waiting)
+        for offset, (user_id, content, seq, saved) in enumerate(waiting):
+            self.pending.append((room_id, user_id, content, first_seq + offset))
+            self._futures.append(saved)
+            self._resolve(seq, first_seq + offset)
+        if len(self.pending) >= self.batch_size or self.queued >= self.max_pending:
+            self._wakeup.set()
+
+    async def _allocate(self, room_id):
+        # Seed the room's counter; messages arriving meanwhile wait in line.
+        try:
+            last_seqs = await self._retrying(read_last_seqs, [room_id])
+            if room_id not in last_seqs:
+                raise ChatRoom.DoesNotExist(f'Room {room_id} does not exist')
+        except Exception as e:
+            logger.warning('Failed to read the last seq of room %s: %r', room_id, e)
+            waiting = self._unsequenced.pop(room_id)
+            for _, _, seq, saved in waiting:
+                self._resolve(seq, exception=e)
+                self._resolve(saved, exception=e)
+        else:
+            self._next_seq[room_id] = max(self._next_seq.get(room_id, 1), last_seqs[room_id] + 1)
+            waiting = self._unsequenced.pop(room_id)
+            self._queue(room_id, waiting)
+        finally:
+            self._reserving -= len(waiting)
+            del self._allocators[room_id]
+            if self.queued < self.max_pending:
+                self._space.set()
+
+    async def _retrying(self, func, *args):
+        attempt = 0
+        while True:
+            try:
+                return await database_sync_to_async(func)(*args)
+            except OperationalError:
+                if attempt >= self.retries:
+                    raise
+            await asyncio.sleep(self.retry_delay * 2 ** attempt)
+            attempt += 1
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch, self.pending = self.pending, []
+            futures, self._futures = self._futures, []
+            if batch:
+                self._space.set()
+            rooms = {item[0] for item in batch}
+            renumbered = set()
+            attempt = 0
+            while batch:
+                try:
+                    results = await database_sync_to_async(persist_messages)(batch)
+                except Exception as e:
+                    results = [e] * len(batch)
+                retry_batch, retry_futures, clashed = [], [], []
+                for item, future, result in zip(batch, futures, results):
+                    if isinstance(result, OperationalError) and attempt < self.retries:
+                        retry_batch.append(item)
+                        retry_futures.append(future)
+                    elif isinstance(result, IntegrityError) and item not in renumbered:
+                        # Its seq may have been taken elsewhere since the room was read.
+                        clashed.append((item, future, result))
+                    elif isinstance(result, Exception):
+                        self._resolve(future, exception=result)
+                    else:
+                        self._resolve(future, result)
+                if clashed:
+                    await self._refresh_seqs({item[0] for item, _, _ in clashed})
+                    for (room_id, user_id, content, _), future, result in clashed:
+                        if room_id not in self._next_seq:
+                            self._resolve(future, exception=result)
+                            continue
+                        item = (room_id, user_id, content, self._take(room_id))
+                        renumbered.add(item)
+                        retry_batch.append(item)
+                        retry_futures.append(future)
+                    logger.warning('Renumbering %d chat messages whose seq was taken', len(clashed))
+                batch, futures = retry_batch, retry_futures
+                if batch and not clashed:
+                    logger.warning('Retrying %d chat messages after a database error', len(batch))
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                    attempt += 1
+            if rooms:
+                await self._refresh_seqs(rooms)
+                # Rooms that went quiet are read again when they next get a message.
+                busy = {item[0] for item in self.pending} | set(self._unsequenced) | rooms
+                for room_id in list(self._next_seq):
+                    if room_id not in busy:
+                        del self._next_seq[room_id]
+
+    def _take(self, room_id):
+        seq = self._next_seq[room_id]
+        self._next_seq[room_id] = seq + 1
+        return seq
+
+    async def _refresh_seqs(self, rooms):
+        """Skip seqs other writers took in ``rooms`` since they were read."""
+        try:
+            last_seqs = await self._retrying(read_last_seqs, list(rooms))
+        except Exception as e:
+            logger.warning('Failed to refresh the last seqs of %d rooms: %r', len(rooms), e)
+            return
+        for room_id, last_seq in last_seqs.items():
+            if room_id in self._next_seq:
+                self._next_seq[room_id] = max(self._next_seq[room_id], last_seq + 1)
+
+    @staticmethod
+    def _resolve(future, result=None, exception=None):
+        if future.done():
+            return
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+            # Nobody may be waiting; don't warn about it.
+            future.exception()
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def close(self):
+        self._closed = True
+        # Messages still waiting for their seq are written too.
+        await asyncio.gather(*self._allocators.values(), return_exceptions=True)
+        if self._task is not None:
+            # Let a flush in progress finish rather than cancel it mid-batch.
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def flush_sync(self):
+        # Last-resort flush at interpreter exit, when the event loop is gone.
+        # Messages still waiting for their room's seq get one as they are written.
+        batch, self.pending = self.pending, []
+        for room_id, waiting in self._unsequenced.items():
+            batch += [(room_id, user_id, content) for user_id, content, _, _ in waiting]
+        self._unsequenced = {}
+        self._futures = []
+        if batch:
+            persist_messages(batch)
+
+
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_write_buffer():
+    """Return the write buffer shared by every consumer on the running loop."""
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        buffer = _buffers[loop] = MessageWriteBuffer(
+            batch_size=settings.CHAT_WRITE_BUFFER_BATCH_SIZE,
+            flush_interval=settings.CHAT_WRITE_BUFFER_FLUSH_INTERVAL,
+            max_pending=settings.CHAT_WRITE_BUFFER_MAX_PENDING,
+            retries=settings.CHAT_WRITE_BUFFER_RETRIES,
+        )
+    return buffer
+
+
+@atexit.register
+def _flush_on_exit():
+    for buffer in list(_buffers.values()):
+        try:
+            buffer.flush_sync()
+        except Exception:
+            logger.exception('Failed to flush chat messages on shutdown')
@@ -0,0 +1,469 @@
+"""
+Who is online in each room.
+
+Every room keeps its online user ids in a sorted ``array('q')``: eight bytes
+per user, an O(1) online count and O(log n) membership checks, which keeps
+rooms with tens of thousands of members cheap. Connections are counted per
+user so a second tab doesn't announce a second join.
+
+A connection stays present while it sends heartbeats (or messages); one
+that has been silent for ``timeout`` seconds is dropped even if its socket
+never closed. Joins and leaves are collected per room and broadcast once per
+``broadcast_interval``, so a reconnect inside the window cancels out and a
+burst of arrivals costs one event instead of one per user.
+
+A connection that timed out but keeps talking is counted again on its next
+heartbeat.
+
+With the in-process channel layer (a single process) the state lives in
+``PresenceTracker``. Several workers share it through Redis instead
+(``RedisPresenceTracker``, PRESENCE_BACKEND = 'redis'): per room a sorted
+set of user ids scored by their last heartbeat, a hash of open connection
+counts and a hash of names to announce. Each worker still debounces the
+changes of its own connections and sweeps the rooms it serves; a user that
+another worker's sweep dropped is counted again on its next heartbeat.
+"""
+import asyncio
+import bisect
+import threading
+import time
+from array import array
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+from .protocol import presence_event
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class RoomPresence:
+    __slots__ = ('group', 'online', 'connections', 'usernames', 'changes')
+
+    def __init__(self, group):
+        self.group = group
+        self.online = array('q')
+        # user id -> open connections, and the name to announce them by
+        self.connections = {}
+        self.usernames = {}
+        # user id -> True for joined, False for left since the last broadcast
+        self.changes = {}
+
+    def __contains__(self, user_id):
+        i = bisect.bisect_left(self.online, user_id)
+        return i < len(self.online) and self.online[i] == user_id
+
+    def add(self, user_id, username):
+        count = self.connections.get(user_id, 0)
+        self.connections[user_id] = count + 1
+        if count:
+            return
+        self.usernames[user_id] = username
+        bisect.insort(self.online, user_id)
+        self._changed(user_id, True)
+
+    def remove(self, user_id):
+        count = self.connections.get(user_id, 0)
+        if count > 1:
+            self.connections[user_id] = count - 1
+            return
+        if not count:
+            return
+        del self.connections[user_id]
+        del self.online[bisect.bisect_left(self.online, user_id)]
+        self._changed(user_id, False)
+        if user_id not in self.changes:
+            self.usernames.pop(user_id, None)
+
+    def _changed(self, user_id, joined):
+        if self.changes.get(user_id) is (not joined):
+            # Left and came back (or the reverse) within one window.
+            del self.changes[user_id]
+        else:
+            self.changes[user_id] = joined
+
+
+class PresenceTracker:
+    # Cheap enough to call on the event loop.
+    local = True
+
+    def __init__(self, timeout=90, broadcast_interval=1.0, max_diff=100, sweep_interval=15):
+        self.timeout = timeout
+        self.broadcast_interval = broadcast_interval
+        self.max_diff = max_diff
+        self.sweep_interval = sweep_interval
+        self.rooms = {}
+        # channel name -> [room id, user id, last seen]
+        self.channels = {}
+        # channel name -> join() arguments of connections that timed out
+        self.timed_out = {}
+        self._lock = threading.Lock()
+        self._flush_handle = None
+        self._flush_loop = None
+        self._next_sweep = 0
+
+    def join(self, channel, room_id, group, user_id, username):
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self.rooms[room_id] = RoomPresence(group)
+            room.add(user_id, username)
+            self.channels[channel] = [room_id, user_id, time.monotonic()]
+            metrics.set_gauge('presence.connections', len(self.channels))
+        self._schedule()
+
+    def leave(self, channel):
+        with self._lock:
+            self.timed_out.pop(channel, None)
+            self._remove(channel)
+            metrics.set_gauge('presence.connections', len(self.channels))
+        self._schedule()
+
+    def _remove(self, channel):
+        entry = self.channels.pop(channel, None)
+        if entry is None:
+            return
+        room = self.rooms.get(entry[0])
+        if room is not None:
+            room.remove(entry[1])
+            if not room.connections and not room.changes:
+                del self.rooms[entry[0]]
+
+    def heartbeat(self, channel):
+        entry = self.channels.get(channel)
+        if entry is not None:
+            entry[2] = time.monotonic()
+        else:
+            with self._lock:
+                identity = self.timed_out.pop(channel, None)
+            if identity is not None:
+                # Timed out, yet the socket is still open and talking.
+                self.join(channel, *identity)
+        self.sweep()
+
+    def sweep(self):
+        """Drop connections that stopped sending heartbeats."""
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        cutoff = now - self.timeout
+        with self._lock:
+            stale = [channel for channel, entry in self.channels.items() if entry[2] < cutoff]
+            for channel in stale:
+                room_id, user_id, _ = self.channels[channel]
+                room = self.rooms[room_id]
+                self.timed_out[channel] = (room_id, room.group, user_id, room.usernames[user_id])
+                self._remove(channel)
+            if stale:
+                metrics.incr('presence.timed_out', len(stale))
+                metrics.set_gauge('presence.connections', len(self.channels))
+        if stale:
+            self._schedule()
+
+    def online_count(self, room_id):
+        self.sweep()
+        room = self.rooms.get(room_id)
+        return len(room.online) if room is not None else 0
+
+    def online_users(self, room_id, offset=0, limit=None):
+        """Online user ids in ascending order."""
+        self.sweep()
+        room = self.rooms.get(room_id)
+        if room is None:
+            return []
+        end = None if limit is None else offset + limit
+        return room.online[offset:end].tolist()
+
+    def is_online(self, room_id, user_id):
+        room = self.rooms.get(room_id)
+        return room is not None and user_id in room
+
+    # Broadcasts
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Changed outside the event loop; sent with the next async change.
+            return
+        # A handle left on a loop that has since gone away is replaced.
+        if self._flush_handle is not None and self._flush_loop is loop:
+            return
+        self._flush_loop = loop
+        self._flush_handle = loop.call_later(self.broadcast_interval, self._flush_soon)
+
+    def _flush_soon(self):
+        self._flush_handle = None
+        asyncio.ensure_future(self.flush())
+
+    def collect(self):
+        """Take the pending changes as ``(group, event)`` pairs."""
+        events = []
+        with self._lock:
+            for room_id, room in list(self.rooms.items()):
+                if not room.changes:
+                    continue
+                changes, room.changes = room.changes, {}
+                joined = left = None
+                if len(changes) <= self.max_diff:
+                    joined = [room.usernames[user_id] for user_id, j in changes.items() if j]
+                    left = [room.usernames[user_id] for user_id, j in changes.items() if not j]
+                for user_id, j in changes.items():
+                    if not j and user_id not in room.connections:
+                        room.usernames.pop(user_id, None)
+                events.append((room.group, presence_event(len(room.online), joined, left)))
+                if not room.connections:
+                    del self.rooms[room_id]
+        return events
+
+    async def flush(self, channel_layer=None):
+        channel_layer = channel_layer or get_channel_layer()
+        if self.local:
+            events = self.collect()
+        else:
+            events = await sync_to_async(self.collect, thread_sensitive=False)()
+        for group, event in events:
+            await channel_layer.group_send(group, event)
+            metrics.incr('presence.broadcasts')
+
+
+# KEYS: online, connections, names. ARGV: user id, name, now, ttl, 1 for a
+# new connection. Returns 1 if the user was not online.
+SEEN_SCRIPT = """
+local seen = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not seen or tonumber(seen) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+end
+if ARGV[5] == '1' or not seen then
+    redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+end
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[4])
+end
+if seen then
+    return 0
+end
+return 1
+"""
+
+# Same KEYS, ARGV: user id. Returns 1 if it was the user's last connection.
+LEAVE_SCRIPT = """
+if redis.call('HINCRBY', KEYS[2], ARGV[1], -1) > 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+return redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+
+# Same KEYS, ARGV: cutoff. Drops users silent since the cutoff and returns
+# them as user id, name pairs.
+SWEEP_SCRIPT = """
+local gone = {}
+for _, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])) do
+    redis.call('ZREM', KEYS[1], user_id)
+    redis.call('HDEL', KEYS[2], user_id)
+    gone[#gone + 1] = user_id
+    gone[#gone + 1] = redis.call('HGET', KEYS[3], user_id) or ''
+    redis.call('HDEL', KEYS[3], user_id)
+end
+return gone
+"""
+
+
+class SharedRoomPresence:
+    __slots__ = ('group', 'channels', 'changes')
+
+    def __init__(self, group):
+        self.group = group
+        # connections served by this process
+        self.channels = 0
+        # user id -> (name, True for joined or False for left)
+        self.changes = {}
+
+    def changed(self, user_id, username, joined):
+        change = self.changes.get(user_id)
+        if change is not None and change[1] is not joined:
+            del self.changes[user_id]
+        else:
+            self.changes[user_id] = (username, joined)
+
+
+class RedisPresenceTracker(PresenceTracker):
+    """
+    Presence shared by every worker through Redis. Blocking: call it through
+    ``apresence`` from the event loop.
+    """
+    local = False
+
+    def __init__(self, url, timeout=90, broadcast_interval=1.0, max_diff=100, sweep_interval=15,
+                 prefix='presence'):
+        if redis is None:
+            raise ImproperlyConfigured("PRESENCE_BACKEND = 'redis' needs the redis package")
+        super().__init__(timeout, broadcast_interval, max_diff, sweep_interval)
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        # A busy connection rewrites its score this often, not on every frame.
+        self.refresh_interval = timeout / 3
+        self._ttl = int(timeout * 2) + 1
+        self._seen = self.redis.register_script(SEEN_SCRIPT)
+        self._leave = self.redis.register_script(LEAVE_SCRIPT)
+        self._sweep = self.redis.register_script(SWEEP_SCRIPT)
+        # channel name -> [room id, user id, name, last written]
+        self.channels = {}
+
+    def _keys(self, room_id):
+        return [f'{self.prefix}:{room_id}:{key}' for key in ('online', 'connections', 'names')]
+
+    def join(self, channel, room_id, group, user_id, username):
+        now = time.time()
+        joined = self._seen(keys=self._keys(room_id), args=[user_id, username, now, self._ttl, 1])
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self.rooms[room_id] = SharedRoomPresence(group)
+            room.channels += 1
+            if joined:
+                room.changed(user_id, username, True)
+            self.channels[channel] = [room_id, user_id, username, now]
+            metrics.set_gauge('presence.connections', len(self.channels))
+        self._schedule()
+
+    def leave(self, channel):
+        with self._lock:
+            entry = self.channels.pop(channel, None)
+            metrics.set_gauge('presence.connections', len(self.channels))
+        if entry is None:
+            return
+        room_id, user_id, username, _ = entry
+        left = self._leave(keys=self._keys(room_id), args=[user_id])
+        with self._lock:
+            room = self.rooms[room_id]
+            room.channels -= 1
+            if left:
+                room.changed(user_id, username, False)
+            if not room.channels and not room.changes:
+                del self.rooms[room_id]
+        self._schedule()
+
+    def heartbeat_due(self, channel):
+        now = time.time()
+        entry = self.channels.get(channel)
+        return entry is not None and now - entry[3] >= self.refresh_interval or now >= self._next_sweep
+
+    def heartbeat(self, channel):
+        entry = self.channels.get(channel)
+        now = time.time()
+        if entry is not None and now - entry[3] >= self.refresh_interval:
+            entry[3] = now
+            room_id, user_id, username, _ = entry
+            if self._seen(keys=self._keys(room_id), args=[user_id, username, now, self._ttl, 0]):
+                # Swept, yet the socket is still open and talking.
+                with self._lock:
+                    self.rooms[room_id].changed(user_id, username, True)
+                self._schedule()
+        self.sweep()
+
+    def sweep(self):
+        """Drop users whose connections all stopped sending heartbeats."""
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        with self._lock:
+            room_ids = [room_id for room_id, room in self.rooms.items() if room.channels]
+        dropped = 0
+        for room_id in room_ids:
+            gone = self._sweep(keys=self._keys(room_id), args=[now - self.timeout])
+            if not gone:
+                continue
+            dropped += len(gone) // 2
+            with self._lock:
+                room = self.rooms.get(room_id)
+                if room is None:
+                    continue
+                for user_id, username in zip(gone[::2], gone[1::2]):
+                    room.changed(int(user_id), username.decode(), False)
+        if dropped:
+            metrics.incr('presence.timed_out', dropped)
+            self._schedule()
+
+    def _count(self, room_id):
+        return self.redis.zcount(self._keys(room_id)[0], time.time() - self.timeout, '+inf')
+
+    def online_count(self, room_id):
+        self.sweep()
+        return self._count(room_id)
+
+    def online_users(self, room_id, offset=0, limit=None):
+        """Online user ids in ascending order."""
+        self.sweep()
+        online = self.redis.zrangebyscore(self._keys(room_id)[0], time.time() - self.timeout, '+inf')
+        end = None if limit is None else offset + limit
+        return sorted(int(user_id) for user_id in online)[offset:end]
+
+    def is_online(self, room_id, user_id):
+        seen = self.redis.zscore(self._keys(room_id)[0], user_id)
+        return seen is not None and seen >= time.time() - self.timeout
+
+    def collect(self):
+        """Take the pending changes as ``(group, event)`` pairs."""
+        pending = []
+        with self._lock:
+            for room_id, room in list(self.rooms.items()):
+                if room.changes:
+                    pending.append((room_id, room.group, room.changes))
+                    room.changes = {}
+                if not room.channels:
+                    del self.rooms[room_id]
+        events = []
+        for room_id, group, changes in pending:
+            joined = left = None
+            if len(changes) <= self.max_diff:
+                joined = [username for username, j in changes.values() if j]
+                left = [username for username, j in changes.values() if not j]
+            events.append((group, presence_event(self._count(room_id), joined, left)))
+        return events
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_presence():
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                options = {
+                    'timeout': settings.PRESENCE_TIMEOUT,
+                    'broadcast_interval': settings.PRESENCE_BROADCAST_INTERVAL,
+                    'max_diff': settings.PRESENCE_MAX_DIFF,
+                    'sweep_interval': settings.PRESENCE_SWEEP_INTERVAL,
+                }
+                if settings.PRESENCE_BACKEND == 'redis':
+                    _tracker = RedisPresenceTracker(settings.PRESENCE_REDIS_URL, **options)
+                else:
+                    _tracker = PresenceTracker(**options)
+    return _tracker
+
+
+async def apresence(method, *args):
+    """Call a tracker method from the event loop."""
+    presence = get_presence()
+    if presence.local:
+        return getattr(presence, method)(*args)
+    if method == 'heartbeat' and not presence.heartbeat_due(*args):
+        return None
+    result = await sync_to_async(getattr(presence, method), thread_sensitive=False)(*args)
+    # Changes made in the worker thread are broadcast from the loop.
+    presence._schedule()
+    return result
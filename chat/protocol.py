@@ -0,0 +1,184 @@
+"""
+Wire formats for the chat WebSocket.
+
+Clients pick one with the WebSocket subprotocol header; without one (or with
+only unknown ones) the connection speaks the original JSON objects.
+
+``chat.compact.v1`` sends chat messages as JSON arrays instead of objects so
+the keys are not repeated in every frame::
+
+    client -> server   ["m", "<message>"]
+    server -> client   ["m", "<user>", "<message>", <seq>]
+
+``seq`` is the message's position in the room (``"seq"`` in JSON objects).
+Clients that reconnect with ``?last_seq=<seq>`` first receive what they
+missed as one batch frame.
+
+Batches of messages from the RabbitMQ bridge arrive as one frame, either
+``{"messages": [{"message": ..., "user": ...}, ...]}`` or, compactly,
+``["b", [["<user>", "<message>"], ...]]``.
+
+Clients keep their presence alive with ``{"type": "heartbeat"}`` or
+``["h"]``. Presence changes arrive as
+``{"presence": {"online": <count>, "joined": [...], "left": [...]}}`` or
+``["p", <count>, [...], [...]]``; the lists are null when too many users
+changed at once to list them.
+
+``chat.msgpack.v1`` uses the same arrays packed with MessagePack in binary
+frames and is only offered when ``msgpack`` is installed.
+
+All encoders emit no whitespace and a fixed key order, so repeated frames
+stay byte-identical apart from their values and compress well under
+permessage-deflate.
+"""
+import json
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MESSAGE = 'm'
+BATCH = 'b'
+HEARTBEAT = 'h'
+PRESENCE = 'p'
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class JSONCodec:
+    name = 'json'
+    subprotocol = None
+    binary = False
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def decode(self, text_data=None, bytes_data=None):
+        data = bytes_data if self.binary else text_data
+        if data is None:
+            raise ProtocolError('Unexpected frame type')
+        try:
+            value = self.loads(data)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        if isinstance(value, dict):
+            return value
+        if isinstance(value, list) and len(value) == 2 and value[0] == MESSAGE:
+            return {'message': value[1]}
+        if value == [HEARTBEAT]:
+            return {'type': 'heartbeat'}
+        raise ProtocolError('Unrecognised frame')
+
+    def encode(self, payload):
+        return self.dumps(payload)
+
+    def encode_chat(self, user, message, seq=None):
+        payload = {'message': message, 'user': user}
+        if seq is not None:
+            payload['seq'] = seq
+        return self.dumps(payload)
+
+    def encode_batch(self, messages):
+        return self.dumps({'messages': [_with_seq({'message': m['message'], 'user': m['user']}, m) for m in messages]})
+
+    def encode_presence(self, online, joined, left):
+        return self.dumps({'presence': {'online': online, 'joined': joined, 'left': left}})
+
+
+def _with_seq(payload, message):
+    if message.get('seq') is not None:
+        payload['seq'] = message['seq']
+    return payload
+
+
+class CompactJSONCodec(JSONCodec):
+    name = subprotocol = 'chat.compact.v1'
+
+    def encode_chat(self, user, message, seq=None):
+        return self.dumps([MESSAGE, user, message] if seq is None else [MESSAGE, user, message, seq])
+
+    def encode_batch(self, messages):
+        return self.dumps([BATCH, [
+            [m['user'], m['message']] if m.get('seq') is None else [m['user'], m['message'], m['seq']]
+            for m in messages
+        ]])
+
+    def encode_presence(self, online, joined, left):
+        return self.dumps([PRESENCE, online, joined, left])
+
+
+class MsgPackCodec(CompactJSONCodec):
+    name = subprotocol = 'chat.msgpack.v1'
+    binary = True
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise ValueError(f'Invalid MessagePack frame: {e}')
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+
+JSON = JSONCodec()
+CODECS = {CompactJSONCodec.subprotocol: CompactJSONCodec()}
+if msgpack is not None:
+    CODECS[MsgPackCodec.subprotocol] = MsgPackCodec()
+
+
+def _add_frames(event, encode):
+    if settings.CHAT_PREENCODE_FRAMES:
+        event['frames'] = {JSON.name: encode(JSON)}
+        for codec in CODECS.values():
+            event['frames'][codec.name] = encode(codec)
+    return event
+
+
+def chat_event(user, message, seq=None):
+    """
+    Build the group_send event for a chat message.
+
+    With CHAT_PREENCODE_FRAMES the frame for every supported codec is
+    encoded once here, at the sender, so recipients forward the ready-made
+    bytes instead of each serializing their own copy. It is off for layers
+    that serialize events, where every codec's copy would travel in each
+    message; recipients then encode from ``message``, ``user`` and ``seq``.
+    """
+    return _add_frames(
+        {'type': 'chat_message', 'message': message, 'user': user, 'seq': seq},
+        lambda codec: codec.encode_chat(user, message, seq),
+    )
+
+
+def chat_batch_event(messages):
+    """Like chat_event, for a list of ``{'user': ..., 'message': ..., 'seq': ...}`` dicts."""
+    return _add_frames(
+        {'type': 'chat_message_batch', 'messages': messages},
+        lambda codec: codec.encode_batch(messages),
+    )
+
+
+def presence_event(online, joined, left):
+    """Like chat_event, for a room's online count and who joined or left."""
+    return _add_frames(
+        {'type': 'presence_update', 'online': online, 'joined': joined, 'left': left},
+        lambda codec: codec.encode_presence(online, joined, left),
+    )
+
+
+def negotiate(subprotocols):
+    """Return the first codec the client offered that we support."""
+    for subprotocol in subprotocols or ():
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec
+    return JSON
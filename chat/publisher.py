@@ -0,0 +1,200 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+
+import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError, StreamLostError
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Errors after which the pooled connection can't be trusted any more and is
+# replaced by a fresh one.
+RECONNECT_ERRORS = (AMQPConnectionError, AMQPChannelError, StreamLostError, ConnectionError)
+
+
+class PublishError(Exception):
+    pass
+
+
+class _PooledChannel:
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def alive(self):
+        """Whether the connection survived being idle, checked without blocking."""
+        if not self.connection.is_open:
+            return False
+        try:
+            # Answers missed heartbeats and notices a socket the broker closed.
+            self.connection.process_data_events(time_limit=0)
+        except RECONNECT_ERRORS:
+            return False
+        return self.connection.is_open and self.channel.is_open
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+
+
+class RabbitMQPublisher:
+    """
+    Process-wide RabbitMQ publisher.
+
+    Connections and their channels are opened once and reused across
+    requests, so a publish costs one basic_publish instead of a TCP and AMQP
+    handshake. Connections that died while idle are replaced on checkout;
+    ones that break mid-publish are replaced and the publish retried. With
+    ``confirm`` the broker acknowledges every message before publish returns.
+    With ``batch_size`` > 1 messages are queued and published from a
+    background thread, either when the batch is full or every
+    ``batch_interval`` seconds.
+    """
+
+    def __init__(self, connection_factory=None, queue_name='chat_messages', pool_size=4,
+                 confirm=True, retries=3, batch_size=1, batch_interval=0.05):
+        self.connection_factory = connection_factory or (
+            lambda: pika.BlockingConnection(pika.ConnectionParameters(settings.RABBITMQ_HOST))
+        )
+        self.queue_name = queue_name
+        self.confirm = confirm
+        self.retries = retries
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = None
+
+    def _open(self):
+        connection = self.connection_factory()
+        channel = connection.channel()
+        channel.queue_declare(queue=self.queue_name)
+        if self.confirm:
+            channel.confirm_delivery()
+        return _PooledChannel(connection, channel)
+
+    def _checkout(self):
+        self._slots.acquire()
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if pooled.alive():
+                return pooled
+            # Died while idle (the broker's heartbeat timeout); not a retry.
+            pooled.close()
+        try:
+            return self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, pooled):
+        self._idle.put(pooled)
+        self._slots.release()
+
+    def _discard(self, pooled):
+        pooled.close()
+        self._slots.release()
+
+    def _publish_bodies(self, bodies):
+        # Messages before ``sent`` are on the broker; a retry resumes after them.
+        sent = 0
+        last_error = None
+        for _ in range(self.retries):
+            try:
+                pooled = self._checkout()
+            except RECONNECT_ERRORS as e:
+                last_error = e
+                continue
+            try:
+                while sent < len(bodies):
+                    pooled.channel.basic_publish(exchange='', routing_key=self.queue_name, body=bodies[sent])
+                    sent += 1
+            except RECONNECT_ERRORS as e:
+                last_error = e
+                self._discard(pooled)
+                continue
+            except Exception:
+                self._discard(pooled)
+                raise
+            self._checkin(pooled)
+            return
+        raise PublishError(f'Could not publish to RabbitMQ after {self.retries} attempts: {last_error}')
+
+    def publish(self, message):
+        body = json.dumps(message)
+        if self.batch_size <= 1:
+            self._publish_bodies([body])
+            return
+
+        with self._pending_lock:
+            if self._closed:
+                raise PublishError('Publisher is closed')
+            self._pending.append(body)
+            full = len(self._pending) >= self.batch_size
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='rabbitmq-publisher', daemon=True)
+                self._flusher.start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._pending_lock:
+            bodies, self._pending = self._pending, []
+        if bodies:
+            self._publish_bodies(bodies)
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.batch_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('Error publishing message batch to RabbitMQ: %s', e)
+
+    def close(self):
+        with self._pending_lock:
+            self._closed = True
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        self.flush()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = RabbitMQPublisher(
+                    queue_name=settings.RABBITMQ_QUEUE,
+                    pool_size=settings.RABBITMQ_PUBLISHER_POOL_SIZE,
+                    confirm=settings.RABBITMQ_PUBLISHER_CONFIRMS,
+                    batch_size=settings.RABBITMQ_PUBLISH_BATCH_SIZE,
+                    batch_interval=settings.RABBITMQ_PUBLISH_BATCH_INTERVAL,
+                )
+                atexit.register(_publisher.close)
+    return _publisher
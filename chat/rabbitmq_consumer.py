@@ -1,30 +1,320 @@
-import pika
+import asyncio
 import json
+import logging
+import signal
+from collections import deque
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.exceptions import AMQPConnectionError
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .protocol import chat_batch_event, chat_event
+
+logger = logging.getLogger(__name__)
+
+
+def build_event(message):
+    return chat_event(message.get('user'), message.get('message', 'No message content'), message.get('seq'))
+
 
 def callback(ch, method, properties, body):
     try:
         message = json.loads(body)
+        if message.get('broadcast'):
+            return
         channel_layer = get_channel_layer()
         room_name = message.get('room_name', 'default_room')
-        async_to_sync(channel_layer.group_send)(
-            f'chat_{room_name}',
-            {
-                'type': 'chat_message',
-                'message': message.get('message', 'No message content')
-            }
-        )
+        async_to_sync(channel_layer.group_send)(f'chat_{room_name}', build_event(message))
     except json.JSONDecodeError:
         print(f"Received non-JSON message: {body}")
 
+
+def _callback_future():
+    future = asyncio.get_running_loop().create_future()
+
+    def resolve(*args):
+        if not future.done():
+            future.set_result(args)
+    return future, resolve
+
+
+class AsyncRabbitMQConsumer:
+    """
+    Bridge from the RabbitMQ chat queue to the channel layer.
+
+    Runs on asyncio through pika's AsyncioConnection. The broker keeps at most
+    ``prefetch`` unacknowledged messages in flight. Each room has one lane
+    that hands its messages to group_send in the order they arrived, and up
+    to ``concurrency`` rooms are sent at a time. A message is acked only
+    after its group_send succeeded and is requeued otherwise, so a crash
+    mid-process loses nothing. ``stop()`` cancels the subscription and waits for
+    in-flight messages before closing the connection.
+
+    Messages marked ``broadcast`` were already sent to the channel layer by
+    the producer that published them; they are acked without being delivered
+    again.
+
+    With a ``batch_window`` (seconds) messages are collected per room and
+    sent as one ``chat_message_batch`` event per room per window, or as soon
+    as a room has ``max_batch`` messages waiting. Larger windows trade
+    latency for fewer group_sends during bursts.
+    """
+
+    def __init__(self, parameters=None, queue_name='chat_messages', prefetch=50, concurrency=20,
+                 channel_layer=None, reconnect_delay=5, batch_window=0, max_batch=100):
+        self.parameters = parameters or pika.ConnectionParameters(settings.RABBITMQ_HOST)
+        self.queue_name = queue_name
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.channel_layer = channel_layer
+        self.reconnect_delay = reconnect_delay
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._semaphore = None
+        self._tasks = set()
+        self._stopping = None
+        self._batches = {}
+        self._flush_handle = None
+        # room name -> batches waiting for the room's lane task
+        self._lanes = {}
+
+    def on_message(self, channel, method, properties, body):
+        metrics.incr('bridge.messages')
+        try:
+            message = json.loads(body)
+        except json.JSONDecodeError:
+            # Redelivering a malformed message would never succeed.
+            logger.warning('Dropping non-JSON message: %r', body)
+            self._settle(channel.basic_ack, method.delivery_tag)
+            return
+        if message.get('broadcast'):
+            metrics.incr('bridge.skipped')
+            self._settle(channel.basic_ack, method.delivery_tag)
+            return
+        room_name = message.get('room_name', 'default_room')
+        if not self.batch_window:
+            self._enqueue(room_name, [(channel, method.delivery_tag, message)])
+            return
+        batch = self._batches.setdefault(room_name, [])
+        batch.append((channel, method.delivery_tag, message))
+        if len(batch) >= self.max_batch:
+            self._dispatch(room_name)
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._dispatch_all)
+
+    def _spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _enqueue(self, room_name, batch):
+        lane = self._lanes.get(room_name)
+        if lane is None:
+            lane = self._lanes[room_name] = deque()
+            self._spawn(self._run_lane(room_name, lane))
+        lane.append(batch)
+
+    async def _run_lane(self, room_name, lane):
+        try:
+            while lane:
+                await self._process_batch(room_name, lane.popleft())
+        finally:
+            del self._lanes[room_name]
+
+    def _dispatch(self, room_name):
+        self._enqueue(room_name, self._batches.pop(room_name))
+
+    def _dispatch_all(self):
+        self._flush_handle = None
+        for room_name in list(self._batches):
+            self._dispatch(room_name)
+
+    async def _process_batch(self, room_name, batch):
+        messages = [message for _, _, message in batch]
+        if len(messages) == 1:
+            event = build_event(messages[0])
+        else:
+            event = chat_batch_event([
+                {'user': m.get('user'), 'message': m.get('message', 'No message content'), 'seq': m.get('seq')}
+                for m in messages
+            ])
+        async with self._semaphore:
+            try:
+                await self.channel_layer.group_send(f'chat_{room_name}', event)
+            except Exception:
+                logger.exception('Failed to dispatch %d messages for %s, requeueing', len(batch), room_name)
+                for channel, delivery_tag, _ in batch:
+                    self._settle(channel.basic_nack, delivery_tag, requeue=True)
+                return
+        metrics.incr('bridge.group_sends')
+        if self.batch_window:
+            metrics.incr('bridge.batches')
+            metrics.incr('bridge.batched_messages', len(batch))
+        for channel, delivery_tag, _ in batch:
+            self._settle(channel.basic_ack, delivery_tag)
+
+    def on_channel_closed(self, channel, reason):
+        """
+        Drop the batched messages delivered on ``channel``: their delivery
+        tags can't be acked on a new channel, and the broker redelivers them.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        dropped = 0
+        for room_name, batch in list(self._batches.items()):
+            kept = [entry for entry in batch if entry[0] is not channel]
+            dropped += len(batch) - len(kept)
+            if kept:
+                self._batches[room_name] = kept
+            else:
+                del self._batches[room_name]
+        if dropped:
+            logger.warning('Channel closed (%s); %d batched messages will be redelivered', reason, dropped)
+            metrics.incr('bridge.dropped', dropped)
+        if self._batches:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._dispatch_all)
+
+    def _settle(self, method, delivery_tag, **kwargs):
+        try:
+            method(delivery_tag=delivery_tag, **kwargs)
+        except Exception as e:
+            # The channel is gone; the broker redelivers unacked messages.
+            logger.warning('Could not settle message %s: %s', delivery_tag, e)
+
+    async def drain(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._dispatch_all()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def run(self):
+        self.channel_layer = self.channel_layer or get_channel_layer()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._stopping = asyncio.Event()
+        while not self._stopping.is_set():
+            try:
+                await self._consume()
+            except AMQPConnectionError as e:
+                logger.error('RabbitMQ connection failed: %r', e)
+            if not self._stopping.is_set():
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.reconnect_delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+        closed = loop.create_future()
+
+        def on_open_error(connection, error):
+            if not opened.done():
+                opened.set_exception(error if isinstance(error, Exception) else AMQPConnectionError(error))
+
+        def on_close(connection, reason):
+            if not closed.done():
+                closed.set_result(reason)
+
+        connection = AsyncioConnection(
+            self.parameters,
+            on_open_callback=lambda connection: opened.set_result(connection),
+            on_open_error_callback=on_open_error,
+            on_close_callback=on_close,
+            custom_ioloop=loop,
+        )
+        await opened
+
+        async def step(future):
+            # Fail instead of hanging when the connection drops mid-setup.
+            await asyncio.wait({future, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if not future.done():
+                raise AMQPConnectionError(f'Connection closed during setup: {closed.result()}')
+            return future.result()
+
+        future, resolve = _callback_future()
+        connection.channel(on_open_callback=resolve)
+        (channel,) = await step(future)
+
+        def on_channel_close(channel, reason):
+            self.on_channel_closed(channel, reason)
+            # Reconnect rather than carry on with a connection that has no channel.
+            if connection.is_open:
+                connection.close()
+
+        channel.add_on_close_callback(on_channel_close)
+        future, resolve = _callback_future()
+        channel.queue_declare(queue=self.queue_name, callback=resolve)
+        await step(future)
+        future, resolve = _callback_future()
+        channel.basic_qos(prefetch_count=self.prefetch, callback=resolve)
+        await step(future)
+        consumer_tag = channel.basic_consume(self.queue_name, self.on_message, auto_ack=False)
+        logger.info('Consuming %s (prefetch=%d, concurrency=%d, batch window=%ss)',
+                    self.queue_name, self.prefetch, self.concurrency, self.batch_window)
+
+        stopping = loop.create_task(self._stopping.wait())
+        await asyncio.wait({closed, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if closed.done():
+            logger.warning('RabbitMQ connection closed: %s', closed.result())
+            return
+
+        future, resolve = _callback_future()
+        channel.basic_cancel(consumer_tag, callback=resolve)
+        await step(future)
+        await self.drain()
+        connection.close()
+        await closed
+
+
+async def report_throughput(interval):
+    """Log relay throughput every ``interval`` seconds and expose it as gauges."""
+    last_messages = metrics.get('bridge.messages')
+    last_sends = metrics.get('bridge.group_sends')
+    while True:
+        await asyncio.sleep(interval)
+        messages, sends = metrics.get('bridge.messages'), metrics.get('bridge.group_sends')
+        rate = (messages - last_messages) / interval
+        send_rate = (sends - last_sends) / interval
+        metrics.set_gauge('bridge.messages_per_second', rate)
+        metrics.set_gauge('bridge.group_sends_per_second', send_rate)
+        logger.info('Relayed %.1f msg/s with %.1f group_sends/s', rate, send_rate)
+        last_messages, last_sends = messages, sends
+
+
+async def serve(consumers, stats_interval=0):
+    """Run consumers until SIGINT/SIGTERM, then let them drain."""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: [consumer.stop() for consumer in consumers])
+    reporter = loop.create_task(report_throughput(stats_interval)) if stats_interval else None
+    try:
+        await asyncio.gather(*(consumer.run() for consumer in consumers))
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+
+
 def start_rabbitmq_consumer():
-    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-    channel = connection.channel()
-    channel.queue_declare(queue='chat_messages')
-    channel.basic_consume(queue='chat_messages', auto_ack=True, on_message_callback=callback)
+    consumer = AsyncRabbitMQConsumer(
+        queue_name=settings.RABBITMQ_QUEUE,
+        prefetch=settings.RABBITMQ_CONSUMER_PREFETCH,
+        concurrency=settings.RABBITMQ_CONSUMER_CONCURRENCY,
+        batch_window=settings.RABBITMQ_CONSUMER_BATCH_WINDOW,
+        max_batch=settings.RABBITMQ_CONSUMER_MAX_BATCH,
+    )
     print('Waiting for messages. To exit press CTRL+C')
-    channel.start_consuming()
+    asyncio.run(serve([consumer]))
 
 if __name__ == '__main__':
     start_rabbitmq_consumer()
@@ -0,0 +1,170 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+
+class TokenBucket:
+    """
+    Classic token bucket: ``rate`` tokens per second, holding up to ``burst``.
+    Thread-safe.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available; otherwise return the seconds to wait."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def release(self, tokens=1):
+        """Give back tokens taken by try_acquire."""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + tokens)
+
+    def acquire(self, tokens=1):
+        """Block until the tokens are available."""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class MemoryRateLimiter:
+    """
+    A TokenBucket per key, kept in this process. Only the ``max_keys`` most
+    recently used keys are kept; a key that was evicted starts again with a
+    full bucket, like one that has been idle long enough to refill.
+    """
+    local = True
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, rate, burst):
+        """Take a token for ``key``; returns 0, or the seconds to wait."""
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+    def refund(self, key, rate, burst):
+        """Give back the token taken by a successful ``hit``."""
+        with self._lock:
+            bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.release()
+
+
+class CacheRateLimiter:
+    """
+    Budgets shared by every process through a Django cache. The cache API
+    has no compare-and-set, so the bucket is approximated by counting hits
+    in windows of ``burst / rate`` seconds with the atomic ``incr``. At a
+    window boundary a key can briefly get up to twice its burst.
+    """
+    local = False
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def hit(self, key, rate, burst):
+        window = burst / rate
+        now = time.time()
+        index = int(now // window)
+        cache_key = f'ratelimit:{key}:{index}'
+        self.cache.add(cache_key, 0, timeout=math.ceil(window) + 1)
+        try:
+            count = self.cache.incr(cache_key)
+        except ValueError:
+            # Expired between add() and incr().
+            self.cache.set(cache_key, 1, timeout=math.ceil(window) + 1)
+            count = 1
+        if count <= burst:
+            return 0
+        return (index + 1) * window - now
+
+    def refund(self, key, rate, burst):
+        window = burst / rate
+        try:
+            self.cache.decr(f'ratelimit:{key}:{int(time.time() // window)}')
+        except ValueError:
+            # The window ended; its count no longer matters.
+            pass
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                if settings.CHAT_RATE_LIMIT_BACKEND == 'cache':
+                    _limiter = CacheRateLimiter(settings.CHAT_RATE_LIMIT_CACHE)
+                else:
+                    _limiter = MemoryRateLimiter(settings.CHAT_RATE_LIMIT_MAX_KEYS)
+    return _limiter
+
+
+def check_message(user_id, room_id):
+    """
+    Charge a new message to its sender's and its room's budgets. Returns 0
+    when it may be sent, or the seconds until it may be retried. A message
+    is charged to both budgets or to neither: if the room is out of budget,
+    the sender's token is given back.
+    """
+    limiter = get_rate_limiter()
+    charged = []
+    for key, budget in (
+        (f'user:{user_id}', settings.CHAT_RATE_LIMIT_USER),
+        (f'room:{room_id}', settings.CHAT_RATE_LIMIT_ROOM),
+    ):
+        if budget is None:
+            continue
+        wait = limiter.hit(key, *budget)
+        if wait:
+            for charged_key, charged_budget in charged:
+                limiter.refund(charged_key, *charged_budget)
+            metrics.incr(f'ratelimit.rejected.{key.partition(":")[0]}')
+            return wait
+        charged.append((key, budget))
+    return 0
+
+
+async def acheck_message(user_id, room_id):
+    # The in-memory check is cheap enough to run on the event loop.
+    if get_rate_limiter().local:
+        return check_message(user_id, room_id)
+    # A DatabaseCache backend queries from the executor thread, so close stale
+    # connections around the call like the consumer's other queries.
+    return await database_sync_to_async(check_message)(user_id, room_id)
@@ -0,0 +1,97 @@
+"""
+Recent messages per room for WebSocket reconnects.
+
+While at least one consumer in this process is attached to a room, every
+message broadcast to the room reaches this process, so the last ``size`` of
+them are kept in a ring. A client reconnecting with the seq it saw last is
+caught up from the ring when it covers the gap without holes, and from the
+(room, seq) index otherwise. A room's ring is dropped with its last local
+consumer, since messages sent while nobody here listened would be missing.
+"""
+import threading
+from collections import deque
+
+from django.conf import settings
+
+
+class RoomReplay:
+    __slots__ = ('consumers', 'order', 'entries', 'last_seq')
+
+    def __init__(self, size):
+        self.consumers = 0
+        self.order = deque(maxlen=size)
+        # seq -> (user, message)
+        self.entries = {}
+        self.last_seq = 0
+
+    def add(self, seq, user, message):
+        if seq in self.entries:
+            return
+        if len(self.order) == self.order.maxlen:
+            del self.entries[self.order[0]]
+        self.order.append(seq)
+        self.entries[seq] = (user, message)
+        self.last_seq = max(self.last_seq, seq)
+
+
+class ReplayBuffer:
+    def __init__(self, size=500):
+        self.size = size
+        self.rooms = {}
+        self._lock = threading.Lock()
+
+    def attach(self, room_id):
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self.rooms[room_id] = RoomReplay(self.size)
+            room.consumers += 1
+
+    def detach(self, room_id):
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is not None:
+                room.consumers -= 1
+                if room.consumers <= 0:
+                    del self.rooms[room_id]
+
+    def record(self, room_id, seq, user, message):
+        room = self.rooms.get(room_id)
+        if room is not None and seq is not None:
+            room.add(seq, user, message)
+
+    def since(self, room_id, after_seq, limit):
+        """
+        Messages after ``after_seq`` as ``(messages, has_more)``, or None when
+        the ring can't prove it has all of them.
+        """
+        room = self.rooms.get(room_id)
+        if room is None or not room.entries:
+            return None
+        if after_seq >= room.last_seq:
+            return [], False
+        if after_seq + 1 not in room.entries:
+            return None
+        messages = []
+        for seq in range(after_seq + 1, room.last_seq + 1):
+            entry = room.entries.get(seq)
+            if entry is None:
+                # A hole, e.g. a message dropped by a full channel queue.
+                return None
+            if len(messages) == limit:
+                return messages, True
+            messages.append({'user': entry[0], 'message': entry[1], 'seq': seq})
+        return messages, False
+
+
+_replay = None
+_replay_lock = threading.Lock()
+
+
+def get_replay():
+    global _replay
+    if _replay is None:
+        with _replay_lock:
+            if _replay is None:
+                _replay = ReplayBuffer(size=settings.CHAT_REPLAY_SIZE)
+    return _replay
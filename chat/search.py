@@ -0,0 +1,222 @@
+"""
+Full-text search over chat messages.
+
+On SQLite, messages are indexed by an FTS5 table, ``chat_message_fts``. It
+reads its text from chat_chatmessage and triggers keep it up to date, so
+every insert, edit and delete is indexed in the same transaction. Results
+are ranked by bm25 among the newest CHAT_SEARCH_RANK_WINDOW matches.
+
+Other databases, and SQLite builds without FTS5, use a built-in inverted
+index instead: one MessageTerm row per distinct word of a message, written
+once the transaction that created the message commits. Results must contain every word of the query.
+They are ranked by how often those words occur, newest first among equals.
+"""
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+
+from . import metrics
+from .models import ChatMessage, ChatRoom, MessageTerm
+from .pagination import HISTORY_FIELDS, serialize_row
+
+WORD_RE = re.compile(r'\w+')
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 10
+
+FTS5_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5("
+    "content, content='chat_chatmessage', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_insert AFTER INSERT ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_delete AFTER DELETE ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_message_fts_update AFTER UPDATE OF content ON chat_chatmessage BEGIN "
+    "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+FTS5_DROP = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_insert',
+    'DROP TRIGGER IF EXISTS chat_message_fts_delete',
+    'DROP TRIGGER IF EXISTS chat_message_fts_update',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+
+
+def fts5_available(conn=connection):
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def install_fts5(conn=connection):
+    """
+    Create the FTS5 table and its triggers if they are missing. SQLite drops
+    the triggers when a migration rebuilds chat_chatmessage, so rebuilding
+    the index puts them back.
+    """
+    with conn.cursor() as cursor:
+        for statement in FTS5_SCHEMA:
+            cursor.execute(statement)
+
+
+def uninstall_fts5(conn=connection):
+    with conn.cursor() as cursor:
+        for statement in FTS5_DROP:
+            cursor.execute(statement)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = settings.CHAT_SEARCH_BACKEND or ('fts5' if fts5_available() else 'inverted')
+    return _backend
+
+
+def tokenize(text):
+    """Lowercased words of ``text`` and how often each occurs."""
+    return Counter(word for word in WORD_RE.findall((text or '').lower()) if len(word) <= MAX_TERM_LENGTH)
+
+
+def query_terms(query):
+    terms = list(tokenize(query))[:MAX_QUERY_TERMS]
+    if not terms:
+        raise ValueError('q must contain at least one word')
+    return terms
+
+
+# Indexing
+
+def index_messages(messages):
+    """Add freshly created messages to the inverted index."""
+    if get_backend() != 'inverted':
+        return
+    rows = [
+        (term, message.pk, message.room_id, count)
+        for message in messages
+        for term, count in tokenize(message.content).items()
+    ]
+    # A message has a dozen terms or so; executemany skips building a model
+    # instance for each of them.
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {MessageTerm._meta.db_table} (term, message_id, room_id, count) VALUES (%s, %s, %s, %s)',
+            rows,
+        )
+
+
+def rebuild(batch_size=10_000):
+    """Rebuild the search index from chat_chatmessage; returns the messages indexed."""
+    total = ChatMessage.objects.count()
+    if get_backend() == 'fts5':
+        install_fts5()
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('optimize')")
+        return total
+
+    MessageTerm.objects.all().delete()
+    last_id = 0
+    while True:
+        batch = list(
+            ChatMessage.objects.filter(pk__gt=last_id).order_by('pk')
+            .only('id', 'room_id', 'content')[:batch_size]
+        )
+        if not batch:
+            break
+        with transaction.atomic():
+            index_messages(batch)
+        last_id = batch[-1].pk
+    return total
+
+
+# Queries
+
+ORDERS = ('rank', 'recent')
+
+
+def search(query, user, room_id=None, author_id=None, limit=50, offset=0, order='rank'):
+    """
+    Messages matching every word of ``query``, best first or, with
+    ``order='recent'``, newest first. Ranking has to score every match, so
+    for very common words the newest-first order is much cheaper. Only rooms
+    ``user`` belongs to are searched, or only ``room_id``, whose membership
+    the caller has checked.
+    """
+    if order not in ORDERS:
+        raise ValueError(f'order must be one of {", ".join(ORDERS)}')
+    terms = query_terms(query)
+    if get_backend() == 'fts5':
+        ids = _search_fts5(terms, user, room_id, author_id, order, limit + 1, offset)
+    else:
+        ids = _search_inverted(terms, user, room_id, author_id, order, limit + 1, offset)
+    metrics.incr('search.queries')
+
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    rows = {
+        row[0]: row
+        for row in ChatMessage.objects.filter(pk__in=ids).values_list(*HISTORY_FIELDS, 'room__name')
+    }
+    results = []
+    for message_id in ids:
+        row = rows.get(message_id)
+        if row is not None:
+            results.append({**serialize_row(row[:-1]), 'room_name': row[-1]})
+    return {'results': results, 'next_offset': offset + limit if has_more else None}
+
+
+def _search_fts5(terms, user, room_id, author_id, order, limit, offset):
+    # Every term quoted, so user input is never FTS5 query syntax.
+    match = ' '.join('"%s"' % term for term in terms)
+    sql = [
+        'SELECT m.id, bm25(chat_message_fts) AS score',
+        'FROM chat_message_fts JOIN chat_chatmessage m ON m.id = chat_message_fts.rowid',
+        'WHERE chat_message_fts MATCH %s',
+    ]
+    params = [match]
+    if room_id is not None:
+        sql.append('AND m.room_id = %s')
+        params.append(room_id)
+    else:
+        sql.append(f'AND m.room_id IN (SELECT chatroom_id FROM {ChatRoom.users.through._meta.db_table} WHERE user_id = %s)')
+        params.append(user.pk)
+    if author_id is not None:
+        sql.append('AND m.user_id = %s')
+        params.append(author_id)
+    sql.append('ORDER BY chat_message_fts.rowid DESC')
+    if order == 'rank':
+        # Scoring every match of a very common word is a full pass over its
+        # postings; only the newest CHAT_SEARCH_RANK_WINDOW matches are ranked.
+        sql = ['SELECT id FROM (', *sql, 'LIMIT %s) ORDER BY score, id DESC']
+        params.append(settings.CHAT_SEARCH_RANK_WINDOW)
+    sql.append('LIMIT %s OFFSET %s')
+    params += [limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _search_inverted(terms, user, room_id, author_id, order, limit, offset):
+    queryset = MessageTerm.objects.filter(term__in=terms)
+    if room_id is not None:
+        queryset = queryset.filter(room_id=room_id)
+    else:
+        queryset = queryset.filter(room__users=user)
+    if author_id is not None:
+        queryset = queryset.filter(message__user_id=author_id)
+    ranked = (
+        queryset.values('message_id')
+        .annotate(matched=Count('id'), score=Sum('count'))
+        .filter(matched=len(terms))
+        .order_by(*(('-score', '-message_id') if order == 'rank' else ('-message_id',)))
+        .values_list('message_id', flat=True)
+    )
+    return list(ranked[offset:offset + limit])
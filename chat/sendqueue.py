@@ -0,0 +1,177 @@
+"""
+Bounded outbound queues for WebSocket connections.
+
+Handlers used to await ``send`` for every frame, so a client that stopped
+reading held up its consumer and, behind it, the channel layer's queue for
+the connection. Frames now go into a SendQueue that a writer task per
+connection drains: handlers return at once and a slow reader only grows its
+own queue, up to ``size`` frames. Frames are sent as they were queued
+until then. What happens once the queue is full depends on the policy:
+
+``drop_oldest``
+    The oldest queued chat or presence frame is discarded.
+``coalesce``
+    Chat messages queued back to back are merged into batch frames, and
+    queued presence updates into one. A client that falls behind gets
+    fewer, larger frames. If that frees no room, the oldest chat or
+    presence frame is discarded.
+``disconnect``
+    The connection is closed with 1013 (try again later).
+
+Other frames (errors, notifications, catch-up notices) are never dropped.
+A client with a full queue of those is disconnected under every policy.
+
+Chat frames carry their seq. A client that missed messages reconnects with
+``?last_seq=`` and is caught up (see chat.replay).
+"""
+import asyncio
+import logging
+from collections import deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+
+def merge_presence(earlier, later):
+    """Fold two ``(online, joined, left)`` updates into one."""
+    online, joined, left = later
+    if earlier[1] is None or joined is None:
+        return online, None, None
+    # Joining and then leaving, or the reverse, cancels out.
+    return (
+        online,
+        [name for name in earlier[1] if name not in left] + [name for name in joined if name not in earlier[2]],
+        [name for name in earlier[2] if name not in joined] + [name for name in left if name not in earlier[1]],
+    )
+
+
+class SendQueue:
+    def __init__(self, send, codec, size=256, policy='coalesce'):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown send queue policy {policy!r}')
+        self.send = send
+        self.codec = codec
+        self.size = size
+        self.policy = policy
+        # [frame, messages, presence]; frame is None once entries were merged
+        self.entries = deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        """Stop the writer and drop whatever is still queued."""
+        self.closed = True
+        metrics.incr('send_queue.depth', -len(self.entries))
+        self.entries.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def put(self, frame, messages=None, presence=None):
+        """
+        Queue ``frame``. ``messages`` (chat messages) or ``presence`` (an
+        ``(online, joined, left)`` update) describe it so that it can be
+        merged with its neighbours. Returns False when the queue overflowed
+        under the disconnect policy, or was full of frames that can't be
+        dropped.
+        """
+        if self.closed:
+            return True
+        if len(self.entries) >= self.size and self.policy == 'coalesce':
+            if self._coalesce(messages, presence):
+                metrics.incr('send_queue.coalesced')
+                return True
+            self._compact()
+        if len(self.entries) >= self.size:
+            if self.policy == 'disconnect':
+                return self._evict()
+            victim = next((entry for entry in self.entries if entry[1] is not None or entry[2] is not None), None)
+            if victim is None:
+                if messages is None and presence is None:
+                    # Neither the queued frames nor this one may be lost.
+                    return self._evict()
+                metrics.incr('send_queue.dropped')
+                return True
+            self.entries.remove(victim)
+            metrics.incr('send_queue.dropped')
+            metrics.incr('send_queue.depth', -1)
+        self.entries.append([frame, list(messages) if messages is not None else None, presence])
+        metrics.incr('send_queue.depth')
+        self._ready.set()
+        return True
+
+    def _evict(self):
+        metrics.incr('send_queue.evicted')
+        self.close()
+        return False
+
+    def _coalesce(self, messages, presence):
+        if messages is not None:
+            tail = self.entries[-1]
+            if tail[1] is None or len(tail[1]) + len(messages) > self.size:
+                return False
+            tail[0] = None
+            tail[1].extend(messages)
+            return True
+        if presence is not None:
+            for entry in reversed(self.entries):
+                if entry[2] is not None:
+                    # Presence is a snapshot; the merged update can go last.
+                    self.entries.remove(entry)
+                    self.entries.append([None, None, merge_presence(entry[2], presence)])
+                    return True
+        return False
+
+    def _compact(self):
+        """Merge queued chat messages into batches and presence updates into one."""
+        entries = deque()
+        updates = []
+        for entry in self.entries:
+            if entry[2] is not None:
+                updates.append(entry)
+                continue
+            tail = entries[-1] if entries else None
+            if (entry[1] is not None and tail is not None and tail[1] is not None
+                    and len(tail[1]) + len(entry[1]) <= self.size):
+                tail[0] = None
+                tail[1].extend(entry[1])
+                metrics.incr('send_queue.coalesced')
+                continue
+            entries.append(entry)
+        if updates:
+            presence = updates[0][2]
+            for entry in updates[1:]:
+                presence = merge_presence(presence, entry[2])
+                metrics.incr('send_queue.coalesced')
+            entries.append(updates[0] if len(updates) == 1 else [None, None, presence])
+        metrics.incr('send_queue.depth', len(entries) - len(self.entries))
+        self.entries = entries
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self.entries:
+                frame, messages, presence = self.entries.popleft()
+                metrics.incr('send_queue.depth', -1)
+                if frame is None:
+                    if messages is not None:
+                        frame = self.codec.encode_batch(messages)
+                    else:
+                        frame = self.codec.encode_presence(*presence)
+                try:
+                    await self.send(frame)
+                except Exception:
+                    logger.exception('Failed to send a WebSocket frame')
+                    self.close()
+                    return
@@ -0,0 +1,32 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import notifications, search
+from .cache import room_ids, user_ids
+from .models import ChatMessage, ChatRoom, User, messages_created
+
+
+@receiver([post_save, post_delete], sender=ChatRoom)
+def invalidate_room_lookup(sender, instance, **kwargs):
+    room_ids.invalidate_value(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_lookup(sender, instance, **kwargs):
+    user_ids.invalidate_value(instance.pk)
+
+
+# Each receiver writes in a transaction of its own: one that fails leaves
+# nothing half done and doesn't affect the others.
+
+@receiver(messages_created, sender=ChatMessage)
+def notify_mentions(sender, messages, **kwargs):
+    with transaction.atomic():
+        notifications.fan_out(messages)
+
+
+@receiver(messages_created, sender=ChatMessage)
+def index_messages(sender, messages, **kwargs):
+    with transaction.atomic():
+        search.index_messages(messages)
@@ -0,0 +1,245 @@
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import metrics
+from .models import Invitation
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# The only provider answer that certainly means nothing was sent. A 5xx or a
+# read timeout may come after the texts went out, so those aren't retried.
+RETRY_STATUSES = {429}
+
+
+class SMSJob:
+    def __init__(self, invitation_ids, numbers, message):
+        self.invitation_ids = list(invitation_ids)
+        self.numbers = list(numbers)
+        self.message = message
+        self.attempts = 0
+
+
+def invitation_message(invitation):
+    user = invitation.invited_by
+    join_url = f"{settings.BASE_URL}/join/?invited_by={user.username}&phone_number={invitation.phone_number}"
+    expiry_date_formatted = invitation.expires_at.strftime("%Y-%m-%d %H:%M:%S")
+    return f"Hello {invitation.first_name} {invitation.last_name}, you've been invited to join Shawazi by {user.username}. This invitation expires on {expiry_date_formatted}. Click here to join: {join_url}"
+
+
+def bulk_invitation_message(user, expires_at):
+    # The provider sends one message to many destinations, so the bulk
+    # text can't carry per-recipient details.
+    expiry_date_formatted = expires_at.strftime("%Y-%m-%d %H:%M:%S")
+    join_url = f"{settings.BASE_URL}/join/?invited_by={user.username}"
+    return f"Hello, you've been invited to join Shawazi by {user.username}. This invitation expires on {expiry_date_formatted}. Click here to join: {join_url}"
+
+
+def record_sms_result(job, ok, detail):
+    Invitation.objects.filter(pk__in=job.invitation_ids).update(
+        sms_status=Invitation.SMS_SENT if ok else Invitation.SMS_FAILED,
+        sms_error='' if ok else str(detail)[:500],
+    )
+
+
+class SMSDispatcher:
+    """
+    Background SMS sender for invitations.
+
+    Jobs are queued by the request thread and sent by ``workers`` daemon
+    threads over one pooled HTTP session with timeouts. Failed connections
+    and 429 responses are retried with exponential backoff and jitter, and
+    each provider host gets its own token bucket so bursts of invitations
+    stay within its rate limit. ``on_result(job, ok, detail)`` is called once
+    per job with the provider's response or the last error.
+
+    Jobs only live in memory. An invitation whose job was lost with its
+    process stays 'queued' until requeue_invitations claims it ('sending')
+    and submits it again.
+    """
+
+    def __init__(self, workers=2, timeout=(3.05, 10), max_retries=3, backoff=0.5,
+                 rate=10, burst=None, on_result=record_sms_result, session=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate = rate
+        self.burst = burst
+        self.on_result = on_result
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(workers, 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._work, name=f'sms-dispatcher-{i}', daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job):
+        metrics.incr('sms.queued', len(job.numbers))
+        self._queue.put(job)
+
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        with self._buckets_lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                ok, detail = self.send(job)
+                self.on_result(job, ok, detail)
+            except Exception:
+                logger.exception('SMS job for invitations %s failed', job.invitation_ids)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def send(self, job):
+        url = settings.SMSLEOPARD_API_URL
+        headers = {
+            "Authorization": f"Basic {settings.SMSLEOPARD_ACCESS_TOKEN}",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            "source": "Akirachix",
+            "message": job.message,
+            "destination": [{"number": number} for number in job.numbers],
+        }
+        bucket = self._bucket(url)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * (1 + random.random()))
+            bucket.acquire()
+            job.attempts += 1
+            try:
+                response = self.session.post(url, json=payload, headers=headers, timeout=self.timeout)
+            except requests.ConnectionError as e:
+                error = e
+                continue
+            except requests.RequestException as e:
+                metrics.incr('sms.failed', len(job.numbers))
+                return False, e
+            if response.status_code in RETRY_STATUSES:
+                error = f'{response.status_code} {response.reason}'
+                continue
+            try:
+                response.raise_for_status()
+                result = response.json()
+            except (requests.RequestException, ValueError) as e:
+                metrics.incr('sms.failed', len(job.numbers))
+                return False, e
+            metrics.incr('sms.sent', len(job.numbers))
+            return True, result
+        metrics.incr('sms.failed', len(job.numbers))
+        return False, error
+
+    def join(self):
+        """Wait until every queued job has been handled."""
+        self._queue.join()
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=30)
+        self.session.close()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = SMSDispatcher(
+                    workers=settings.SMS_DISPATCHER_WORKERS,
+                    timeout=settings.SMS_TIMEOUT,
+                    max_retries=settings.SMS_MAX_RETRIES,
+                    backoff=settings.SMS_RETRY_BACKOFF,
+                    rate=settings.SMS_RATE_LIMIT,
+                )
+                atexit.register(_dispatcher.close)
+    return _dispatcher
+
+
+def claim_invitations(ids):
+    """Move the invitations among ``ids`` that are still 'queued' to 'sending' and return them."""
+    claim = uuid.uuid4()
+    Invitation.objects.filter(pk__in=ids, sms_status=Invitation.SMS_QUEUED).update(
+        sms_status=Invitation.SMS_SENDING, sms_claim=claim,
+    )
+    return list(
+        Invitation.objects.filter(pk__in=ids, sms_claim=claim).select_related('invited_by').order_by('pk')
+    )
+
+
+def requeue_invitations(older_than=None, dispatcher=None):
+    """
+    Submit again the unexpired invitations still 'queued' after
+    ``older_than`` (default SMS_REQUEUE_AFTER_MINUTES), whose jobs were lost
+    with the process that queued them. Returns how many were requeued.
+
+    Invitations of one bulk request share their inviter and expiry; they
+    get the bulk text again, SMS_BULK_CHUNK_SIZE numbers per job. Each job's
+    invitations are claimed first, so runs that overlap never send one
+    twice.
+    """
+    now = timezone.now()
+    cutoff = now - (older_than or timedelta(minutes=settings.SMS_REQUEUE_AFTER_MINUTES))
+    stale = Invitation.objects.filter(
+        sms_status=Invitation.SMS_QUEUED, created_at__lt=cutoff, expires_at__gt=now,
+    ).order_by('pk').values_list('pk', 'invited_by', 'expires_at')
+    by_request = defaultdict(list)
+    for pk, invited_by, expires_at in stale.iterator():
+        by_request[invited_by, expires_at].append(pk)
+
+    chunk_size = settings.SMS_BULK_CHUNK_SIZE
+    count = 0
+    for ids in by_request.values():
+        for i in range(0, len(ids), chunk_size):
+            claimed = claim_invitations(ids[i:i + chunk_size])
+            if not claimed:
+                continue
+            if len(ids) > 1:
+                message = bulk_invitation_message(claimed[0].invited_by, claimed[0].expires_at)
+            else:
+                message = invitation_message(claimed[0])
+            dispatcher = dispatcher or get_dispatcher()
+            dispatcher.submit(SMSJob(
+                [invitation.id for invitation in claimed],
+                [invitation.phone_number for invitation in claimed],
+                message,
+            ))
+            count += len(claimed)
+    metrics.incr('sms.requeued', count)
+    return count
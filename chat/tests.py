@@ -1,9 +1,50 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import json
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from pika.exceptions import StreamLostError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
-from django.contrib.auth.models import User
+from django.utils import timezone
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
 from rest_framework import status
 from rest_framework.test import APIClient
-from .models import ChatRoom, Invitation, ChatMessage
+from .models import (
+    ArchiveSegment, ChatRoom, Invitation, ChatMessage, MediaFile, MediaUpload, Notification,
+    delete_expired_invitations,
+)
+from . import archive, media, notifications, search
+from .pagination import astream_messages, paginate_messages, stream_messages
+from .cache import LookupCache, get_room_id, get_user_id, room_ids, user_ids
+from .persistence import MessageWriteBuffer, get_write_buffer, persist_messages
+from .publisher import PublishError, RabbitMQPublisher
+from .rabbitmq_consumer import AsyncRabbitMQConsumer
+from .sms import SMSDispatcher, SMSJob, bulk_invitation_message, record_sms_result, requeue_invitations
+from .layers import HybridChannelLayer, ShardedInMemoryChannelLayer
+from .presence import PresenceTracker, RedisPresenceTracker, redis
+from .ratelimit import CacheRateLimiter, MemoryRateLimiter, check_message
+from .protocol import JSON, chat_batch_event, chat_event, msgpack
+from .sendqueue import SendQueue
+from .thumbnails import Image
+from .urls import websocket_urlpatterns
 
 class ChatAppTests(TestCase):
 
@@ -24,9 +65,13 @@ class ChatAppTests(TestCase):
             'last_name': 'Mwendwa',
             'phone_number': '+254704264110'
         }
-        response = self.client.post(self.invitation_url, data)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertIn('Invitation created and SMS sent', response.data['status'])
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(self.invitation_url, data)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn('Invitation created and SMS queued', response.data['status'])
+        self.assertEqual(response.data['sms_status'], 'queued')
+        self.assertTrue(Invitation.objects.filter(pk=response.data['invitation_id']).exists())
+        self.assertEqual(len(callbacks), 1)
 
     def test_create_chat_message(self):
         data = {
@@ -55,3 +100,1850 @@ class ChatAppTests(TestCase):
         response = self.client.get(self.notifications_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['notifications'], [])
+
+
+class ChatHistoryPaginationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='historyuser', password='testpass')
+        self.client = APIClient()
+        self.client.login(username='historyuser', password='testpass')
+        self.chat_room = ChatRoom.objects.create(name='history_room')
+        self.url = reverse('chat_message_list_create')
+        for i in range(7):
+            ChatMessage.objects.create(room=self.chat_room, user=self.user, content=f'message {i}')
+
+    def get_history(self, **params):
+        return self.client.get(self.url, {'room_name': 'history_room', **params})
+
+    def test_latest_page_is_chronological(self):
+        response = self.get_history(limit=3)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['message'] for m in response.data['messages']], ['message 4', 'message 5', 'message 6'])
+        self.assertEqual(response.data['messages'][0]['user'], 'historyuser')
+        self.assertTrue(response.data['has_more'])
+
+    def test_walk_backwards_and_forwards(self):
+        latest = self.get_history(limit=3).data
+        older = self.get_history(limit=3, before=latest['before']).data
+        self.assertEqual([m['message'] for m in older['messages']], ['message 1', 'message 2', 'message 3'])
+        oldest = self.get_history(limit=3, before=older['before']).data
+        self.assertEqual([m['message'] for m in oldest['messages']], ['message 0'])
+        self.assertFalse(oldest['has_more'])
+
+        newer = self.get_history(limit=3, after=oldest['after']).data
+        self.assertEqual([m['message'] for m in newer['messages']], ['message 1', 'message 2', 'message 3'])
+
+    def test_history_uses_single_query(self):
+        with self.assertNumQueries(1):
+            paginate_messages(self.chat_room, limit=5)
+
+    def test_invalid_cursor(self):
+        response = self.get_history(before='not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_streaming_export(self):
+        response = self.get_history(stream=1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(body['messages']), 7)
+        self.assertEqual(body['messages'][-1]['message'], 'message 6')
+
+    @mock.patch('chat.pagination.STREAM_CHUNK_SIZE', 3)
+    async def test_streaming_export_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url, {'room_name': 'history_room', 'stream': 1})
+        self.assertTrue(response.is_async)
+        body = json.loads(b''.join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual([m['message'] for m in body['messages']], [f'message {i}' for i in range(7)])
+
+    def test_messages_get_per_room_sequence_numbers(self):
+        other_room = ChatRoom.objects.create(name='other_room')
+        message = ChatMessage.objects.create(room=other_room, user=self.user, content='first')
+        self.assertEqual(message.seq, 1)
+        self.assertEqual(
+            list(ChatMessage.objects.filter(room=self.chat_room).order_by('id').values_list('seq', flat=True)),
+            list(range(1, 8)),
+        )
+        self.chat_room.refresh_from_db()
+        self.assertEqual(self.chat_room.last_seq, 7)
+
+    def test_after_seq(self):
+        response = self.get_history(after_seq=5)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['seq'] for m in response.data['messages']], [6, 7])
+        self.assertEqual(self.get_history(after_seq=-1).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FakeBroker:
+    """In-process stand-in for RabbitMQ recording what gets published."""
+
+    def __init__(self):
+        self.queues = {}
+        self.connections_opened = 0
+        self.fail_next_publishes = 0
+
+    def connect(self):
+        self.connections_opened += 1
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.dropped = False
+
+    def channel(self):
+        return FakeChannel(self.broker)
+
+    def process_data_events(self, time_limit):
+        if self.dropped:
+            # The broker closed the socket after missed heartbeats.
+            self.is_open = False
+            raise StreamLostError('connection reset')
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeChannel:
+    def __init__(self, broker):
+        self.broker = broker
+        self.confirming = False
+        self.is_open = True
+
+    def queue_declare(self, queue):
+        self.broker.queues.setdefault(queue, [])
+
+    def confirm_delivery(self):
+        self.confirming = True
+
+    def basic_publish(self, exchange, routing_key, body):
+        if self.broker.fail_next_publishes:
+            self.broker.fail_next_publishes -= 1
+            raise StreamLostError('connection reset')
+        self.broker.queues[routing_key].append(json.loads(body))
+
+
+class RabbitMQPublisherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.broker = FakeBroker()
+
+    def make_publisher(self, **kwargs):
+        publisher = RabbitMQPublisher(connection_factory=self.broker.connect, **kwargs)
+        self.addCleanup(publisher.close)
+        return publisher
+
+    def test_connection_is_reused(self):
+        publisher = self.make_publisher()
+        for i in range(5):
+            publisher.publish({'message': i})
+        self.assertEqual(self.broker.connections_opened, 1)
+        self.assertEqual(self.broker.queues['chat_messages'], [{'message': i} for i in range(5)])
+
+    def test_reconnects_after_connection_loss(self):
+        publisher = self.make_publisher()
+        publisher.publish({'message': 'first'})
+        self.broker.fail_next_publishes = 1
+        publisher.publish({'message': 'second'})
+        self.assertEqual(self.broker.connections_opened, 2)
+        self.assertEqual(self.broker.queues['chat_messages'], [{'message': 'first'}, {'message': 'second'}])
+
+    def test_connection_dead_while_idle_is_replaced(self):
+        publisher = self.make_publisher(retries=1)
+        publisher.publish({'message': 'first'})
+        publisher._idle.queue[0].connection.dropped = True
+        publisher.publish({'message': 'second'})
+        self.assertEqual(self.broker.connections_opened, 2)
+        self.assertEqual(self.broker.queues['chat_messages'], [{'message': 'first'}, {'message': 'second'}])
+
+    def test_gives_up_after_retries(self):
+        publisher = self.make_publisher(retries=2)
+        self.broker.fail_next_publishes = 2
+        with self.assertRaises(PublishError):
+            publisher.publish({'message': 'lost'})
+
+    def test_batched_messages_are_flushed(self):
+        publisher = self.make_publisher(batch_size=100, batch_interval=60)
+        for i in range(3):
+            publisher.publish({'message': i})
+        self.assertEqual(self.broker.queues, {})
+        publisher.close()
+        self.assertEqual(self.broker.queues['chat_messages'], [{'message': i} for i in range(3)])
+
+
+class MessageWriteBufferTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='bufferuser', password='testpass')
+        self.chat_room = ChatRoom.objects.create(name='buffer_room')
+
+    def test_persist_messages_batches_per_room(self):
+        other_room = ChatRoom.objects.create(name='buffer_room_2')
+        pending = [
+            (self.chat_room.id, self.user.id, 'one'),
+            (other_room.id, self.user.id, 'two'),
+            (self.chat_room.id, self.user.id, 'three'),
+        ]
+        persist_messages(pending)
+        self.assertEqual(
+            list(ChatMessage.objects.filter(room=self.chat_room).order_by('seq').values_list('content', 'seq')),
+            [('one', 1), ('three', 2)],
+        )
+        self.assertEqual(ChatMessage.objects.get(room=other_room).seq, 1)
+
+    def test_bad_row_only_fails_itself(self):
+        other_room = ChatRoom.objects.create(name='buffer_room_2')
+        results = persist_messages([
+            (self.chat_room.id, self.user.id, 'hello'),
+            (other_room.id, self.user.id, None),
+            (other_room.id, self.user.id, 'still here'),
+            (other_room.id + 100, self.user.id, 'deleted room'),
+        ])
+        self.assertEqual([type(result).__name__ for result in results], ['ChatMessage', 'IntegrityError', 'ChatMessage', 'DoesNotExist'])
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('room_id', 'seq').values_list('content', 'seq')),
+            [('hello', 1), ('still here', 1)],
+        )
+
+    def test_buffer_retries_transient_errors(self):
+        calls = []
+
+        def flaky(batch):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                return [OperationalError('database is locked')] * len(batch)
+            return persist_messages(batch)
+
+        async def scenario():
+            buffer = MessageWriteBuffer(flush_interval=60, retry_delay=0)
+            _, saved = await buffer.add(self.chat_room.id, self.user.id, 'a')
+            await buffer.close()
+            return (await saved).content
+
+        with mock.patch('chat.persistence.persist_messages', flaky):
+            self.assertEqual(async_to_sync(scenario)(), 'a')
+        self.assertEqual(calls, [1, 1])
+
+    def test_buffer_flushes_on_size_and_close(self):
+        async def scenario():
+            buffer = MessageWriteBuffer(batch_size=2, flush_interval=60)
+            await buffer.add(self.chat_room.id, self.user.id, 'a')
+            await buffer.add(self.chat_room.id, self.user.id, 'b')
+            await asyncio.sleep(0.05)
+            flushed = len(buffer.pending)
+            await buffer.add(self.chat_room.id, self.user.id, 'c')
+            await buffer.close()
+            return flushed
+
+        self.assertEqual(async_to_sync(scenario)(), 0)
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('seq').values_list('content', flat=True)), ['a', 'b', 'c']
+        )
+
+    def test_full_buffer_applies_backpressure(self):
+        async def scenario():
+            buffer = MessageWriteBuffer(batch_size=100, flush_interval=60, max_pending=2)
+            for content in ('a', 'b', 'c'):
+                seq, _ = await buffer.add(self.chat_room.id, self.user.id, content)
+            await seq
+            pending = list(buffer.pending)
+            await buffer.close()
+            return pending
+
+        # The third add had to wait until the first two were written.
+        self.assertEqual(async_to_sync(scenario)(), [(self.chat_room.id, self.user.id, 'c', 3)])
+        self.assertEqual(ChatMessage.objects.count(), 3)
+
+
+    def test_seqs_are_counted_in_memory(self):
+        async def scenario():
+            buffer = MessageWriteBuffer(flush_interval=60)
+            first, _ = await buffer.add(self.chat_room.id, self.user.id, 'a')
+            await first
+            # The room's last_seq was read once; later seqs need no query.
+            second, _ = await buffer.add(self.chat_room.id, self.user.id, 'b')
+            done = second.done()
+            await buffer.close()
+            return done, await first, await second
+
+        self.assertEqual(async_to_sync(scenario)(), (True, 1, 2))
+        self.chat_room.refresh_from_db()
+        self.assertEqual(self.chat_room.last_seq, 2)
+
+    def test_seq_taken_elsewhere_is_renumbered(self):
+        async def scenario():
+            buffer = MessageWriteBuffer(flush_interval=60)
+            seq, saved = await buffer.add(self.chat_room.id, self.user.id, 'buffered')
+            await seq
+            # A REST post takes the same seq before the buffer writes.
+            await ChatMessage.objects.acreate(room=self.chat_room, user=self.user, content='posted')
+            await buffer.close()
+            return (await saved).seq
+
+        with self.assertLogs('chat.persistence', 'WARNING'):
+            self.assertEqual(async_to_sync(scenario)(), 2)
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('seq').values_list('content', 'seq')), [('posted', 1), ('buffered', 2)]
+        )
+
+    def test_flush_on_exit_writes_unsequenced_messages(self):
+        async def scenario():
+            buffer = MessageWriteBuffer(flush_interval=60)
+            with mock.patch.object(buffer, '_allocate', mock.AsyncMock()):
+                await buffer.add(self.chat_room.id, self.user.id, 'late')
+            return buffer
+
+        async_to_sync(scenario)().flush_sync()
+        self.assertEqual(ChatMessage.objects.get().content, 'late')
+
+
+class LookupCacheTests(TestCase):
+
+    def setUp(self):
+        room_ids.clear()
+        user_ids.clear()
+        self.user = User.objects.create_user(username='cacheuser', password='testpass')
+        self.chat_room = ChatRoom.objects.create(name='cache_room')
+
+    def test_lookups_hit_the_database_once(self):
+        with self.assertNumQueries(2):
+            for _ in range(5):
+                self.assertEqual(get_room_id('cache_room'), self.chat_room.id)
+                self.assertEqual(get_user_id('cacheuser'), self.user.id)
+        self.assertEqual(room_ids.stats()['size'], 1)
+        self.assertIsNone(get_room_id('no_such_room'))
+
+    def test_saves_and_deletes_invalidate(self):
+        get_room_id('cache_room')
+        self.chat_room.name = 'renamed_room'
+        self.chat_room.save()
+        self.assertIsNone(room_ids.get('cache_room'))
+        self.assertEqual(get_room_id('renamed_room'), self.chat_room.id)
+
+        get_user_id('cacheuser')
+        self.user.delete()
+        self.assertIsNone(get_user_id('cacheuser'))
+
+    def test_lru_and_ttl(self):
+        cache = LookupCache('test', maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+        expired = LookupCache('test', ttl=0)
+        expired.set('a', 1)
+        self.assertIsNone(expired.get('a'))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'chat.layers.ShardedInMemoryChannelLayer'}},
+                   PRESENCE_ENABLED=True, CHAT_PREENCODE_FRAMES=True)
+class ChatConsumerTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='wsuser', password='testpass')
+        self.outsider = User.objects.create_user(username='outsider', password='testpass')
+        self.chat_room = ChatRoom.objects.create(name='ws_room')
+        self.chat_room.users.add(self.user)
+        # A tracker per test, broadcasting only when flushed explicitly.
+        self.presence = PresenceTracker(broadcast_interval=60)
+        patcher = mock.patch('chat.presence._tracker', self.presence)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('chat.ratelimit._limiter', MemoryRateLimiter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def communicator(self, user, room_name='ws_room', subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{room_name}/', subprotocols=subprotocols
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    async def test_member_sends_body_only(self):
+        communicator = self.communicator(self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'message': 'hello'})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'hello', 'user': 'wsuser', 'seq': 1})
+        await communicator.disconnect()
+
+        await get_write_buffer().close()
+        message = await ChatMessage.objects.aget(room=self.chat_room)
+        self.assertEqual((message.user_id, message.content), (self.user.id, 'hello'))
+
+    @override_settings(CHAT_WRITE_BUFFER_FLUSH_INTERVAL=60)
+    async def test_broadcast_does_not_wait_for_the_write(self):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await communicator.send_json_to({'message': 'hello'})
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'hello', 'user': 'wsuser', 'seq': 1})
+        self.assertFalse(await ChatMessage.objects.aexists())
+        await communicator.disconnect()
+        await get_write_buffer().close()
+        message = await ChatMessage.objects.aget()
+        self.assertEqual((message.content, message.seq), ('hello', 1))
+
+    async def test_rest_post_is_delivered_once(self):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await self.async_client.aforce_login(self.user)
+        with mock.patch('chat.views.get_publisher') as get_publisher:
+            response = await self.async_client.post(
+                reverse('chat_message_list_create'), {'message': 'hi', 'room_name': 'ws_room'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # Nothing is sent until the bridge delivers the published message.
+        self.assertTrue(await communicator.receive_nothing())
+
+        published = get_publisher.return_value.publish.call_args.args[0]
+        bridge = AsyncRabbitMQConsumer(channel_layer=get_channel_layer())
+        bridge._semaphore = asyncio.Semaphore(1)
+        channel = FakeAMQPChannel()
+        bridge.on_message(channel, FakeDelivery(1), None, json.dumps(published))
+        await bridge.drain()
+        self.assertEqual(channel.acked, [1])
+
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'hi', 'user': 'wsuser', 'seq': 1})
+        self.assertTrue(await communicator.receive_nothing())
+
+        # Without the broker the view sends it itself.
+        with mock.patch('chat.views.get_publisher') as get_publisher:
+            get_publisher.return_value.publish.side_effect = PublishError('broker down')
+            await self.async_client.post(
+                reverse('chat_message_list_create'), {'message': 'again', 'room_name': 'ws_room'},
+                content_type='application/json',
+            )
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'again', 'user': 'wsuser', 'seq': 2})
+        await communicator.disconnect()
+
+    async def test_invalid_message_is_rejected(self):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        for message in (None, 5, ''):
+            await communicator.send_json_to({'message': message})
+            self.assertEqual(await communicator.receive_json_from(), {'error': 'Invalid message frame'})
+        await communicator.disconnect()
+        self.assertFalse(await ChatMessage.objects.aexists())
+
+    async def test_compact_subprotocol(self):
+        communicator = self.communicator(self.user, subprotocols=['unknown', 'chat.compact.v1'])
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(subprotocol, 'chat.compact.v1')
+
+        await communicator.send_to(text_data='["m","hi"]')
+        self.assertEqual(await communicator.receive_from(), '["m","wsuser","hi",1]')
+        await communicator.send_to(text_data='["x"]')
+        self.assertEqual(json.loads(await communicator.receive_from()), {'error': 'Invalid message frame'})
+        await communicator.disconnect()
+        await get_write_buffer().close()
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    async def test_msgpack_subprotocol(self):
+        communicator = self.communicator(self.user, subprotocols=['chat.msgpack.v1'])
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(subprotocol, 'chat.msgpack.v1')
+
+        await communicator.send_to(bytes_data=msgpack.packb(['m', 'hi']))
+        self.assertEqual(msgpack.unpackb(await communicator.receive_from()), ['m', 'wsuser', 'hi', 1])
+        await communicator.disconnect()
+        await get_write_buffer().close()
+
+    @override_settings(CHAT_PREENCODE_FRAMES=False)
+    def test_frames_are_not_encoded_for_serializing_layers(self):
+        self.assertNotIn('frames', chat_event('sender', 'hi'))
+        self.assertNotIn('frames', chat_batch_event([{'user': 'a', 'message': 'b'}]))
+
+    async def test_pre_encoded_frames_are_forwarded(self):
+        communicator = self.communicator(self.user, subprotocols=['chat.compact.v1'])
+        await communicator.connect()
+        event = chat_event('sender', 'hi')
+        self.assertEqual(event['frames']['json'], '{"message":"hi","user":"sender"}')
+        event['frames']['chat.compact.v1'] = 'pre-encoded'
+        await get_channel_layer().group_send('chat_ws_room', event)
+        self.assertEqual(await communicator.receive_from(), 'pre-encoded')
+
+        # Events without frames, e.g. from older senders, are still encoded.
+        await get_channel_layer().group_send('chat_ws_room', {'type': 'chat_message', 'message': 'old', 'user': 'x'})
+        self.assertEqual(await communicator.receive_from(), '["m","x","old"]')
+        await communicator.disconnect()
+
+    async def test_batch_is_one_frame(self):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await get_channel_layer().group_send('chat_ws_room', chat_batch_event([
+            {'user': 'a', 'message': 'one'}, {'user': 'b', 'message': 'two'},
+        ]))
+        self.assertEqual(await communicator.receive_json_from(), {'messages': [
+            {'message': 'one', 'user': 'a'}, {'message': 'two', 'user': 'b'},
+        ]})
+        await communicator.disconnect()
+
+    async def test_presence(self):
+        other = await User.objects.acreate_user(username='wsfriend', password='testpass')
+        await self.chat_room.users.aadd(other)
+        first = self.communicator(self.user)
+        await first.connect()
+        second = self.communicator(other, subprotocols=['chat.compact.v1'])
+        await second.connect()
+        self.assertEqual(self.presence.online_count(self.chat_room.id), 2)
+
+        await self.presence.flush()
+        self.assertEqual(await first.receive_json_from(), {'presence': {'online': 2, 'joined': ['wsuser', 'wsfriend'], 'left': []}})
+        self.assertEqual(await second.receive_from(), '["p",2,["wsuser","wsfriend"],[]]')
+
+        # Heartbeats are not chat messages.
+        await second.send_to(text_data='["h"]')
+        await second.disconnect()
+        await self.presence.flush()
+        self.assertEqual(await first.receive_json_from(), {'presence': {'online': 1, 'joined': [], 'left': ['wsfriend']}})
+        self.assertTrue(await first.receive_nothing())
+
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('presence'), {'room_name': 'ws_room', 'users': '1'})
+        self.assertEqual(response.data, {
+            'room_name': 'ws_room', 'online': 1, 'users': [{'id': self.user.id, 'username': 'wsuser'}],
+        })
+        await first.disconnect()
+        await get_write_buffer().close()
+
+        with override_settings(PRESENCE_ENABLED=False):
+            response = await self.async_client.get(reverse('presence'), {'room_name': 'ws_room'})
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    @override_settings(CHAT_RATE_LIMIT_USER=(1, 1))
+    async def test_rate_limited(self):
+        communicator = self.communicator(self.user)
+        await communicator.connect()
+        await communicator.send_json_to({'message': 'one'})
+        await communicator.send_json_to({'message': 'two'})
+        # The rejection is immediate; the accepted message follows its seq reservation.
+        rejected = await communicator.receive_json_from()
+        self.assertEqual(rejected['error'], 'Rate limit exceeded')
+        self.assertGreater(rejected['retry_after'], 0)
+        self.assertEqual(await communicator.receive_json_from(), {'message': 'one', 'user': 'wsuser', 'seq': 1})
+        await communicator.disconnect()
+        await get_write_buffer().close()
+
+    async def test_reconnect_catches_up(self):
+        listener = self.communicator(self.user)
+        await listener.connect()
+        for content in ('one', 'two', 'three'):
+            await listener.send_json_to({'message': content})
+            await listener.receive_json_from()
+
+        # Served from the ring kept while a consumer is attached.
+        resumed = self.communicator(self.user)
+        resumed.scope['query_string'] = b'last_seq=1'
+        with mock.patch('chat.consumers.paginate_messages') as paginate:
+            await resumed.connect()
+            self.assertEqual(await resumed.receive_json_from(), {'messages': [
+                {'message': 'two', 'user': 'wsuser', 'seq': 2}, {'message': 'three', 'user': 'wsuser', 'seq': 3},
+            ]})
+        paginate.assert_not_called()
+        await resumed.disconnect()
+        await listener.disconnect()
+
+        # Nobody attached any more: the ring is gone and the index answers,
+        # including messages the write buffer still held.
+        resumed = self.communicator(self.user, subprotocols=['chat.compact.v1'])
+        resumed.scope['query_string'] = b'last_seq=2'
+        await resumed.connect()
+        self.assertEqual(await resumed.receive_from(), '["b",[["wsuser","three",3]]]')
+        await resumed.disconnect()
+        await get_write_buffer().close()
+
+    async def test_non_member_is_rejected(self):
+        connected, _ = await self.communicator(self.outsider).connect()
+        self.assertFalse(connected)
+
+    async def test_anonymous_is_rejected(self):
+        connected, _ = await self.communicator(AnonymousUser()).connect()
+        self.assertFalse(connected)
+
+    async def test_unknown_room_is_rejected(self):
+        connected, _ = await self.communicator(self.user, 'no_such_room').connect()
+        self.assertFalse(connected)
+
+
+class PresenceTrackerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tracker = PresenceTracker(timeout=30, max_diff=2, sweep_interval=0)
+
+    def changes(self):
+        return [(event['online'], event['joined'], event['left']) for _, event in self.tracker.collect()]
+
+    def test_online_users_stay_sorted_and_counted_once(self):
+        for channel, user_id in [('a', 30), ('b', 10), ('c', 20), ('d', 10)]:
+            self.tracker.join(channel, 1, 'chat_r', user_id, f'u{user_id}')
+        self.assertEqual(self.tracker.online_users(1), [10, 20, 30])
+        self.assertEqual(self.tracker.online_users(1, offset=1, limit=1), [20])
+        self.tracker.leave('b')
+        self.assertTrue(self.tracker.is_online(1, 10))
+        self.tracker.leave('d')
+        self.assertFalse(self.tracker.is_online(1, 10))
+        self.assertEqual(self.tracker.online_count(1), 2)
+
+    def test_broadcasts_are_debounced(self):
+        self.tracker.join('a', 1, 'chat_r', 1, 'alice')
+        self.tracker.join('b', 1, 'chat_r', 2, 'bob')
+        self.assertEqual(self.changes(), [(2, ['alice', 'bob'], [])])
+
+        # A quick reconnect cancels out.
+        self.tracker.leave('a')
+        self.tracker.join('a2', 1, 'chat_r', 1, 'alice')
+        self.assertEqual(self.changes(), [])
+
+        # Too many changes are summarised as a count.
+        for i in range(3, 6):
+            self.tracker.join(str(i), 1, 'chat_r', i, f'user{i}')
+        self.assertEqual(self.changes(), [(5, None, None)])
+
+    def test_silent_connections_time_out(self):
+        self.tracker.join('a', 1, 'chat_r', 1, 'alice')
+        self.tracker.join('b', 1, 'chat_r', 2, 'bob')
+        self.tracker.collect()
+        with mock.patch('chat.presence.time.monotonic', return_value=time.monotonic() + 20):
+            self.tracker.heartbeat('b')
+        with mock.patch('chat.presence.time.monotonic', return_value=time.monotonic() + 40):
+            self.assertEqual(self.tracker.online_count(1), 1)
+        self.assertEqual(self.changes(), [(1, [], ['alice'])])
+
+        # The socket was still open after all: it counts again.
+        self.tracker.heartbeat('a')
+        self.assertTrue(self.tracker.is_online(1, 1))
+        self.assertEqual(self.changes(), [(2, ['alice'], [])])
+        self.tracker.leave('a')
+        self.assertEqual(self.tracker.timed_out, {})
+
+
+
+def redis_reachable():
+    if redis is None:
+        return False
+    try:
+        return redis.Redis.from_url('redis://127.0.0.1:6379/0', socket_connect_timeout=0.2).ping()
+    except redis.RedisError:
+        return False
+
+
+@skipUnless(redis_reachable(), 'needs a Redis server on 127.0.0.1:6379')
+class RedisPresenceTrackerTests(SimpleTestCase):
+
+    def setUp(self):
+        prefix = f'test-presence-{os.getpid()}-{time.time()}'
+        # Two workers sharing one Redis.
+        self.first, self.second = [
+            RedisPresenceTracker('redis://127.0.0.1:6379/0', timeout=30, sweep_interval=0, prefix=prefix)
+            for _ in range(2)
+        ]
+        self.addCleanup(lambda: [self.first.redis.delete(key) for key in self.first.redis.keys(prefix + ':*')])
+
+    def changes(self, tracker):
+        return [(event['online'], event['joined'], event['left']) for _, event in tracker.collect()]
+
+    def test_workers_share_the_online_set(self):
+        self.first.join('a', 1, 'chat_r', 2, 'bob')
+        self.second.join('b', 1, 'chat_r', 1, 'alice')
+        self.second.join('c', 1, 'chat_r', 2, 'bob')
+        self.assertEqual(self.first.online_users(1), [1, 2])
+        self.assertEqual(self.second.online_count(1), 2)
+        self.assertEqual(self.changes(self.first), [(2, ['bob'], [])])
+        self.assertEqual(self.changes(self.second), [(2, ['alice'], [])])
+
+        # Bob is still connected to the second worker.
+        self.first.leave('a')
+        self.assertTrue(self.second.is_online(1, 2))
+        self.assertEqual(self.changes(self.first), [])
+        self.second.leave('c')
+        self.assertFalse(self.first.is_online(1, 2))
+        self.assertEqual(self.changes(self.second), [(1, [], ['bob'])])
+
+    def test_silent_users_are_swept_by_any_worker(self):
+        self.first.join('a', 1, 'chat_r', 1, 'alice')
+        self.second.join('b', 1, 'chat_r', 2, 'bob')
+        self.first.collect()
+        self.second.collect()
+        later = time.time() + 20
+        with mock.patch('chat.presence.time.time', return_value=later):
+            self.second.heartbeat('b')
+        with mock.patch('chat.presence.time.time', return_value=later + 20):
+            self.assertEqual(self.second.online_count(1), 1)
+            self.assertEqual(self.changes(self.second), [(1, [], ['alice'])])
+
+            # Alice's socket was still open after all: she counts again.
+            self.first.heartbeat('a')
+            self.assertEqual(self.changes(self.first), [(2, ['alice'], [])])
+            self.assertTrue(self.second.is_online(1, 1))
+
+
+class SendQueueTests(SimpleTestCase):
+
+    async def stalled_queue(self, policy, size=2):
+        # The first frame is taken by the writer and stalls until released.
+        self.sent = []
+        self.gate = asyncio.Event()
+
+        async def send(frame):
+            await self.gate.wait()
+            self.sent.append(json.loads(frame))
+
+        queue = SendQueue(send, JSON, size=size, policy=policy)
+        queue.start()
+        queue.put('{"first": true}')
+        await asyncio.sleep(0)
+        self.assertEqual(len(queue), 0)
+        return queue
+
+    async def drain(self, queue):
+        self.gate.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        queue.close()
+        return self.sent[1:]
+
+    async def test_drop_oldest(self):
+        queue = await self.stalled_queue('drop_oldest')
+        for i in range(3):
+            queue.put(JSON.encode_chat('a', str(i), i), messages=[{'user': 'a', 'message': str(i), 'seq': i}])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(await self.drain(queue), [
+            {'user': 'a', 'message': '1', 'seq': 1}, {'user': 'a', 'message': '2', 'seq': 2},
+        ])
+
+    async def test_control_frames_are_not_dropped(self):
+        queue = await self.stalled_queue('drop_oldest')
+        queue.put('{"error": "Invalid message frame"}')
+        for i in range(2):
+            queue.put(JSON.encode_chat('a', str(i), i), messages=[{'user': 'a', 'message': str(i), 'seq': i}])
+        self.assertEqual(await self.drain(queue), [
+            {'error': 'Invalid message frame'}, {'user': 'a', 'message': '1', 'seq': 1},
+        ])
+
+        # A client that isn't reading even those is let go.
+        queue = await self.stalled_queue('coalesce')
+        self.assertTrue(queue.put('{"notification": 1}'))
+        self.assertTrue(queue.put('{"notification": 2}'))
+        self.assertTrue(queue.put(JSON.encode_chat('a', 'x', 1), messages=[{'user': 'a', 'message': 'x', 'seq': 1}]))
+        self.assertFalse(queue.put('{"notification": 3}'))
+        self.assertTrue(queue.closed)
+
+    async def test_coalesce_only_when_full(self):
+        queue = await self.stalled_queue('coalesce', size=4)
+        queue.put(JSON.encode_presence(2, ['bob'], []), presence=(2, ['bob'], []))
+        for i in range(2):
+            queue.put(JSON.encode_chat('a', str(i), i), messages=[{'user': 'a', 'message': str(i), 'seq': i}])
+        self.assertEqual(len(queue), 3)
+        # Once full, queued messages are merged into a batch and presence
+        # updates are folded into one at the end.
+        queue.put('{"notification": 1}')
+        queue.put(JSON.encode_chat('a', '2', 2), messages=[{'user': 'a', 'message': '2', 'seq': 2}])
+        queue.put(JSON.encode_presence(2, ['carol'], ['bob']), presence=(2, ['carol'], ['bob']))
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(await self.drain(queue), [
+            {'messages': [{'user': 'a', 'message': '0', 'seq': 0}, {'user': 'a', 'message': '1', 'seq': 1}]},
+            {'notification': 1},
+            {'user': 'a', 'message': '2', 'seq': 2},
+            {'presence': {'online': 2, 'joined': ['carol'], 'left': []}},
+        ])
+
+    async def test_disconnect(self):
+        queue = await self.stalled_queue('disconnect')
+        self.assertTrue(queue.put('{}'))
+        self.assertTrue(queue.put('{}'))
+        self.assertFalse(queue.put('{}'))
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue), 0)
+
+
+class RateLimitTests(TestCase):
+
+    def test_memory_limiter(self):
+        limiter = MemoryRateLimiter(max_keys=2)
+        self.assertEqual(limiter.hit('a', 1, 2), 0)
+        self.assertEqual(limiter.hit('a', 1, 2), 0)
+        self.assertAlmostEqual(limiter.hit('a', 1, 2), 1, places=1)
+        limiter.hit('b', 1, 2)
+        limiter.hit('c', 1, 2)
+        # The least recently used key made room.
+        self.assertEqual(list(limiter.buckets), ['b', 'c'])
+
+    def test_cache_limiter(self):
+        limiter = CacheRateLimiter('default')
+        self.assertEqual([limiter.hit('shared', 10, 2) for _ in range(2)], [0, 0])
+        wait = limiter.hit('shared', 10, 2)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.2)
+
+    @override_settings(CHAT_RATE_LIMIT_USER=(1, 2), CHAT_RATE_LIMIT_ROOM=(1, 1))
+    def test_room_rejection_does_not_charge_sender(self):
+        for limiter in (MemoryRateLimiter(), CacheRateLimiter('default')):
+            with mock.patch('chat.ratelimit._limiter', limiter):
+                self.assertEqual(check_message(1, 'busy'), 0)
+                # The busy room turns these away without using the sender's budget.
+                for _ in range(3):
+                    self.assertGreater(check_message(1, 'busy'), 0)
+                self.assertEqual(check_message(1, 'quiet'), 0)
+
+    @override_settings(CHAT_RATE_LIMIT_USER=None, CHAT_RATE_LIMIT_ROOM=(1, 1))
+    def test_rest_post_is_limited_per_room(self):
+        user = User.objects.create_user(username='poster', password='testpass')
+        chat_room = ChatRoom.objects.create(name='busy_room')
+        self.client.force_login(user)
+        data = {'room_name': 'busy_room', 'message': 'hi'}
+        with mock.patch('chat.ratelimit._limiter', MemoryRateLimiter()), \
+                mock.patch('chat.views.ChatMessageListCreateView.publish_message'):
+            self.assertEqual(self.client.post(reverse('chat_message_list_create'), data).status_code, 201)
+            response = self.client.post(reverse('chat_message_list_create'), data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.json()['error'], 'Rate limit exceeded')
+        self.assertEqual(ChatMessage.objects.filter(room=chat_room).count(), 1)
+
+
+class ShardedInMemoryChannelLayerTests(SimpleTestCase):
+
+    async def test_send_and_receive(self):
+        layer = ShardedInMemoryChannelLayer()
+        channel = await layer.new_channel()
+        await layer.send(channel, {'type': 'test', 'value': 1})
+        self.assertEqual(await layer.receive(channel), {'type': 'test', 'value': 1})
+        self.assertNotIn(channel, layer.channels)
+
+    async def test_capacity(self):
+        layer = ShardedInMemoryChannelLayer(capacity=2)
+        await layer.send('test-channel', {'type': 'a'})
+        await layer.send('test-channel', {'type': 'b'})
+        with self.assertRaises(ChannelFull):
+            await layer.send('test-channel', {'type': 'c'})
+
+    async def test_group_send_and_discard(self):
+        layer = ShardedInMemoryChannelLayer(shards=4)
+        await layer.group_add('chat_room', 'first')
+        await layer.group_add('chat_room', 'second')
+        await layer.group_discard('chat_room', 'second')
+        await layer.group_send('chat_room', {'type': 'chat_message'})
+        self.assertEqual(await layer.receive('first'), {'type': 'chat_message'})
+        self.assertNotIn('second', layer.channels)
+        self.assertEqual(layer.group_channels('chat_room'), ['first'])
+
+    async def test_group_members_share_frames(self):
+        layer = ShardedInMemoryChannelLayer()
+        await layer.group_add('chat_room', 'first')
+        await layer.group_add('chat_room', 'second')
+        await layer.group_send('chat_room', {'type': 'chat_message', 'messages': [], 'frames': {'json': '{}'}})
+        first, second = await layer.receive('first'), await layer.receive('second')
+        self.assertIs(first['frames'], second['frames'])
+        with self.assertRaises(TypeError):
+            first['frames']['json'] = 'changed'
+        self.assertIsNot(first['messages'], second['messages'])
+
+    async def test_full_member_does_not_block_group(self):
+        layer = ShardedInMemoryChannelLayer(capacity=1)
+        await layer.group_add('chat_room', 'slow')
+        await layer.group_add('chat_room', 'fast')
+        await layer.group_send('chat_room', {'type': 'one'})
+        await layer.receive('fast')
+        await layer.group_send('chat_room', {'type': 'two'})
+        self.assertEqual(await layer.receive('fast'), {'type': 'two'})
+        self.assertEqual(await layer.receive('slow'), {'type': 'one'})
+
+    async def test_expired_messages_and_memberships_are_swept(self):
+        layer = ShardedInMemoryChannelLayer(expiry=-1, group_expiry=-1, sweep_interval=0)
+        await layer.group_add('chat_room', 'gone')
+        await layer.send('gone', {'type': 'stale'})
+        await layer.group_send('other_room', {'type': 'trigger'})
+        self.assertEqual(layer.group_channels('chat_room'), [])
+        self.assertEqual(layer.channels, {})
+
+    async def test_sweep_keeps_queues_being_read(self):
+        layer = ShardedInMemoryChannelLayer(sweep_interval=0)
+        await layer.group_add('chat_room', 'reader')
+        receive = asyncio.ensure_future(layer.receive('reader'))
+        await asyncio.sleep(0)
+        # group_send sweeps first; the reader's empty queue must survive it.
+        await layer.group_send('chat_room', {'type': 'chat_message'})
+        self.assertEqual(await asyncio.wait_for(receive, 1), {'type': 'chat_message'})
+
+    async def test_members_get_their_own_copy(self):
+        layer = ShardedInMemoryChannelLayer()
+        await layer.group_add('chat_room', 'first')
+        await layer.group_add('chat_room', 'second')
+        await layer.group_send('chat_room', {'type': 'chat_message', 'tags': []})
+        (await layer.receive('first'))['tags'].append('mutated')
+        self.assertEqual(await layer.receive('second'), {'type': 'chat_message', 'tags': []})
+
+    async def test_flush(self):
+        layer = ShardedInMemoryChannelLayer()
+        await layer.group_add('chat_room', 'member')
+        await layer.send('member', {'type': 'x'})
+        await layer.flush()
+        self.assertEqual(layer.channels, {})
+        self.assertEqual(layer.group_channels('chat_room'), [])
+
+
+class CountingRelay(ShardedInMemoryChannelLayer):
+    """Local fake of the cross-node relay that counts group sends, but not node announcements."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.group_sends = 0
+
+    async def group_send(self, group, message):
+        if message['type'] not in ('hybrid.hello', 'hybrid.join', 'hybrid.leave'):
+            self.group_sends += 1
+        await super().group_send(group, message)
+
+
+class SlowRelay(CountingRelay):
+    """A relay whose calls yield to the event loop, as a network round-trip would."""
+
+    def __init__(self, discard_delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.discard_delay = discard_delay
+
+    async def group_add(self, group, channel):
+        await asyncio.sleep(0)
+        await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await asyncio.sleep(self.discard_delay)
+        await super().group_discard(group, channel)
+
+
+class HybridChannelLayerTests(SimpleTestCase):
+
+    def make_nodes(self, **kwargs):
+        self.relay = CountingRelay()
+        self.node_a = HybridChannelLayer(relay=self.relay, **kwargs)
+        self.node_b = HybridChannelLayer(relay=self.relay, **kwargs)
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), timeout=1)
+
+    async def test_group_send_delivers_locally_and_relays_once(self):
+        self.make_nodes()
+        local = [await self.node_a.new_channel() for _ in range(3)]
+        remote = [await self.node_b.new_channel() for _ in range(3)]
+        for channel in local:
+            await self.node_a.group_add('chat_room', channel)
+        for channel in remote:
+            await self.node_b.group_add('chat_room', channel)
+
+        await self.node_a.group_send('chat_room', {'type': 'chat_message', 'message': 'hi'})
+        self.assertEqual(self.relay.group_sends, 1)
+        for channel in local:
+            self.assertEqual(await self.receive(self.node_a, channel), {'type': 'chat_message', 'message': 'hi'})
+        for channel in remote:
+            self.assertEqual(await self.receive(self.node_b, channel), {'type': 'chat_message', 'message': 'hi'})
+
+        # The sender's own relayed copy is ignored.
+        await asyncio.sleep(0.01)
+        self.assertNotIn(local[0], self.node_a.channels)
+        await self.node_a.close()
+        await self.node_b.close()
+
+    @override_settings(CHAT_PREENCODE_FRAMES=True)
+    async def test_pre_encoded_frames_stay_local(self):
+        self.make_nodes()
+        local, remote = await self.node_a.new_channel(), await self.node_b.new_channel()
+        await self.node_a.group_add('chat_room', local)
+        await self.node_b.group_add('chat_room', remote)
+
+        await self.node_a.group_send('chat_room', chat_event('amy', 'hi'))
+        self.assertIn('frames', await self.receive(self.node_a, local))
+        relayed = await self.receive(self.node_b, remote)
+        self.assertNotIn('frames', relayed)
+        self.assertEqual(relayed['message'], 'hi')
+        await self.node_a.close()
+        await self.node_b.close()
+
+    async def test_concurrent_first_sends_wait_for_startup(self):
+        relay = SlowRelay()
+        layer = HybridChannelLayer(relay=relay, relay_warmup=0)
+        await asyncio.gather(*[layer.group_send('chat_room', {'type': 'chat_message'}) for _ in range(3)])
+        self.assertEqual(relay.group_channels(layer.nodes_group), [layer.node_channel])
+        await layer.close()
+
+    async def test_rejoin_during_leave_is_not_announced_as_left(self):
+        self.relay = SlowRelay(discard_delay=0.01)
+        self.node_a = HybridChannelLayer(relay=self.relay, relay_warmup=0)
+        self.node_b = HybridChannelLayer(relay=self.relay, relay_warmup=0)
+        channel = await self.node_a.new_channel()
+        await self.node_a.group_add('chat_room', channel)
+        await self.node_b.group_send('other_room', {'type': 'ping'})
+        await asyncio.sleep(0.01)
+
+        # The member joins again while the relay is still processing its leave.
+        leaving = asyncio.ensure_future(self.node_a.group_discard('chat_room', channel))
+        await asyncio.sleep(0)
+        await self.node_a.group_add('chat_room', channel)
+        await leaving
+        await asyncio.sleep(0.02)
+
+        self.assertEqual(self.relay.group_channels('chat_room'), [self.node_a.node_channel])
+        await self.node_b.group_send('chat_room', {'type': 'chat_message'})
+        self.assertEqual(await self.receive(self.node_a, channel), {'type': 'chat_message'})
+        await self.node_a.close()
+        await self.node_b.close()
+
+    async def test_direct_send_to_other_node(self):
+        self.make_nodes()
+        channel = await self.node_b.new_channel()
+        await self.node_a.send(channel, {'type': 'direct'})
+        self.assertEqual(await self.receive(self.node_b, channel), {'type': 'direct'})
+        await self.node_a.close()
+        await self.node_b.close()
+
+    async def test_last_local_member_leaves_relay_group(self):
+        self.make_nodes()
+        channel = await self.node_a.new_channel()
+        await self.node_a.group_add('chat_room', channel)
+        self.assertEqual(self.relay.group_channels('chat_room'), [self.node_a.node_channel])
+        await self.node_a.group_discard('chat_room', channel)
+        self.assertEqual(self.relay.group_channels('chat_room'), [])
+        await self.node_a.close()
+
+    async def test_group_send_is_relayed_only_to_groups_with_remote_members(self):
+        self.make_nodes(relay_warmup=0)
+        local = await self.node_a.new_channel()
+        remote = await self.node_b.new_channel()
+        await self.node_a.group_add('chat_room', local)
+        await self.node_b.group_add('other_room', remote)
+        await asyncio.sleep(0.01)
+
+        await self.node_a.group_send('chat_room', {'type': 'chat_message'})
+        self.assertEqual(self.relay.group_sends, 0)
+        self.assertEqual(await self.receive(self.node_a, local), {'type': 'chat_message'})
+
+        await self.node_b.group_add('chat_room', remote)
+        await asyncio.sleep(0.01)
+        await self.node_a.group_send('chat_room', {'type': 'chat_message'})
+        self.assertEqual(self.relay.group_sends, 1)
+        self.assertEqual(await self.receive(self.node_b, remote), {'type': 'chat_message'})
+
+        # Once node b leaves, node a stops relaying again.
+        await self.node_b.group_discard('chat_room', remote)
+        await asyncio.sleep(0.01)
+        await self.node_a.group_send('chat_room', {'type': 'chat_message'})
+        self.assertEqual(self.relay.group_sends, 1)
+        await self.node_a.close()
+        await self.node_b.close()
+
+    async def test_late_node_learns_existing_members(self):
+        self.make_nodes(relay_warmup=0)
+        remote = await self.node_b.new_channel()
+        await self.node_b.group_add('chat_room', remote)
+        # Node a starts after node b joined and asks the others for their groups.
+        await self.node_a.group_send('other_room', {'type': 'ping'})
+        await asyncio.sleep(0.01)
+        await self.node_a.group_send('chat_room', {'type': 'chat_message'})
+        self.assertEqual(await self.receive(self.node_b, remote), {'type': 'chat_message'})
+        await self.node_a.close()
+        await self.node_b.close()
+
+    async def test_expired_membership_leaves_relay_group(self):
+        relay = CountingRelay()
+        layer = HybridChannelLayer(relay=relay, group_expiry=-1, sweep_interval=0)
+        channel = await layer.new_channel()
+        await layer.group_add('chat_room', channel)
+        self.assertEqual(relay.group_channels('chat_room'), [layer.node_channel])
+        await layer.group_send('other_room', {'type': 'trigger'})
+        await asyncio.sleep(0.01)
+        self.assertEqual(relay.group_channels('chat_room'), [])
+        await layer.close()
+
+    async def test_relay_membership_is_refreshed(self):
+        relay = CountingRelay()
+        layer = HybridChannelLayer(relay=relay, relay_refresh=0.01)
+        channel = await layer.new_channel()
+        await layer.group_add('chat_room', channel)
+        # As if the relay had expired the membership.
+        await relay.group_discard('chat_room', layer.node_channel)
+        await asyncio.sleep(0.05)
+        self.assertEqual(relay.group_channels('chat_room'), [layer.node_channel])
+        await layer.close()
+
+
+class FakeAMQPChannel:
+    def __init__(self):
+        self.acked = []
+        self.nacked = []
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.nacked.append((delivery_tag, requeue))
+
+
+class FakeDelivery:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class AsyncRabbitMQConsumerTests(SimpleTestCase):
+
+    def make_consumer(self, channel_layer, concurrency=2, **kwargs):
+        consumer = AsyncRabbitMQConsumer(channel_layer=channel_layer, concurrency=concurrency, **kwargs)
+        consumer._semaphore = asyncio.Semaphore(concurrency)
+        return consumer
+
+    async def test_acks_after_group_send(self):
+        layer = ShardedInMemoryChannelLayer()
+        await layer.group_add('chat_lobby', 'member')
+        consumer = self.make_consumer(layer)
+        channel = FakeAMQPChannel()
+        body = json.dumps({'room_name': 'lobby', 'user': 'amy', 'message': 'hi'})
+        consumer.on_message(channel, FakeDelivery(1), None, body)
+        consumer.on_message(channel, FakeDelivery(2), None, b'not json')
+        await consumer.drain()
+
+        self.assertEqual(sorted(channel.acked), [1, 2])
+        event = await layer.receive('member')
+        self.assertEqual((event['user'], event['message']), ('amy', 'hi'))
+
+    async def test_failed_dispatch_is_requeued(self):
+        class BrokenLayer:
+            async def group_send(self, group, message):
+                raise ConnectionError('redis is down')
+
+        consumer = self.make_consumer(BrokenLayer())
+        channel = FakeAMQPChannel()
+        with self.assertLogs('chat.rabbitmq_consumer', 'ERROR'):
+            consumer.on_message(channel, FakeDelivery(7), None, json.dumps({'room_name': 'lobby'}))
+            await consumer.drain()
+        self.assertEqual(channel.acked, [])
+        self.assertEqual(channel.nacked, [(7, True)])
+
+    async def test_concurrency_is_bounded(self):
+        class SlowLayer:
+            active = peak = 0
+
+            async def group_send(self, group, message):
+                SlowLayer.active += 1
+                SlowLayer.peak = max(SlowLayer.peak, SlowLayer.active)
+                await asyncio.sleep(0.01)
+                SlowLayer.active -= 1
+
+        consumer = self.make_consumer(SlowLayer(), concurrency=3)
+        channel = FakeAMQPChannel()
+        for tag in range(10):
+            consumer.on_message(channel, FakeDelivery(tag), None, json.dumps({'room_name': f'room{tag}'}))
+        await consumer.drain()
+        self.assertEqual(SlowLayer.peak, 3)
+        self.assertEqual(len(channel.acked), 10)
+
+    async def test_rooms_are_delivered_in_order(self):
+        class UnevenLayer:
+            sent = []
+
+            async def group_send(self, group, message):
+                # Earlier messages take longer.
+                await asyncio.sleep(0.01 if message['message'] == 'first' else 0)
+                UnevenLayer.sent.append((group, message['message']))
+
+        consumer = self.make_consumer(UnevenLayer(), concurrency=4)
+        channel = FakeAMQPChannel()
+        for tag, (room, message) in enumerate([('lobby', 'first'), ('lobby', 'second'), ('quiet', 'other')]):
+            consumer.on_message(channel, FakeDelivery(tag), None, json.dumps({'room_name': room, 'message': message}))
+        await consumer.drain()
+        self.assertEqual(UnevenLayer.sent, [('chat_quiet', 'other'), ('chat_lobby', 'first'), ('chat_lobby', 'second')])
+        self.assertEqual(consumer._lanes, {})
+
+    @override_settings(CHAT_PREENCODE_FRAMES=True)
+    async def test_batches_per_room(self):
+        layer = CountingRelay()
+        await layer.group_add('chat_lobby', 'lobby_member')
+        await layer.group_add('chat_quiet', 'quiet_member')
+        consumer = self.make_consumer(layer, batch_window=0.01, max_batch=100)
+        channel = FakeAMQPChannel()
+        for tag in range(5):
+            body = json.dumps({'room_name': 'lobby', 'user': 'amy', 'message': f'm{tag}'})
+            consumer.on_message(channel, FakeDelivery(tag), None, body)
+        consumer.on_message(channel, FakeDelivery(5), None, json.dumps({'room_name': 'quiet', 'message': 'x'}))
+        await asyncio.sleep(0.05)
+        await consumer.drain()
+
+        self.assertEqual(layer.group_sends, 2)
+        self.assertEqual(sorted(channel.acked), list(range(6)))
+        event = await layer.receive('lobby_member')
+        self.assertEqual(event['type'], 'chat_message_batch')
+        self.assertEqual([m['message'] for m in event['messages']], ['m0', 'm1', 'm2', 'm3', 'm4'])
+        self.assertEqual(event['frames']['chat.compact.v1'], json.dumps(
+            ['b', [['amy', f'm{i}'] for i in range(5)]], separators=(',', ':')
+        ))
+        self.assertEqual((await layer.receive('quiet_member'))['type'], 'chat_message')
+
+    async def test_full_batch_is_sent_before_window(self):
+        layer = CountingRelay()
+        consumer = self.make_consumer(layer, batch_window=60, max_batch=3)
+        channel = FakeAMQPChannel()
+        for tag in range(3):
+            consumer.on_message(channel, FakeDelivery(tag), None, json.dumps({'room_name': 'lobby'}))
+        await asyncio.gather(*consumer._tasks)
+        self.assertEqual(layer.group_sends, 1)
+        self.assertEqual(sorted(channel.acked), [0, 1, 2])
+        await consumer.drain()
+
+    async def test_batches_from_a_closed_channel_are_dropped(self):
+        layer = CountingRelay()
+        consumer = self.make_consumer(layer, batch_window=60)
+        old, new = FakeAMQPChannel(), FakeAMQPChannel()
+        for tag in range(2):
+            consumer.on_message(old, FakeDelivery(tag), None, json.dumps({'room_name': 'lobby'}))
+        with self.assertLogs('chat.rabbitmq_consumer', 'WARNING'):
+            consumer.on_channel_closed(old, 'connection lost')
+        self.assertEqual(consumer._batches, {})
+        self.assertIsNone(consumer._flush_handle)
+
+        consumer.on_message(new, FakeDelivery(0), None, json.dumps({'room_name': 'lobby'}))
+        await consumer.drain()
+        self.assertEqual(layer.group_sends, 1)
+        self.assertEqual((old.acked, new.acked), ([], [0]))
+
+
+class FakeSMSProvider(BaseHTTPRequestHandler):
+    """Local stand-in for the SMS provider; replies from a scripted list."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(body)
+        status_code = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'success': status_code == 200}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class SMSDispatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSMSProvider)
+        self.server.requests = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.results = []
+        url = f'http://127.0.0.1:{self.server.server_address[1]}/v1/sms/send'
+        settings_override = override_settings(SMSLEOPARD_API_URL=url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def make_dispatcher(self, **kwargs):
+        dispatcher = SMSDispatcher(
+            workers=1, backoff=0.01, on_result=lambda job, ok, detail: self.results.append((job, ok, detail)),
+            **kwargs
+        )
+        self.addCleanup(dispatcher.close)
+        return dispatcher
+
+    def test_sends_in_background(self):
+        dispatcher = self.make_dispatcher()
+        dispatcher.submit(SMSJob([1], ['+254700000001'], 'hello'))
+        dispatcher.join()
+        (job, ok, detail), = self.results
+        self.assertTrue(ok)
+        self.assertEqual(detail, {'success': True})
+        self.assertEqual(self.server.requests[0]['destination'], [{'number': '+254700000001'}])
+
+    def test_retries_rate_limits(self):
+        self.server.statuses = [429, 429]
+        dispatcher = self.make_dispatcher(max_retries=3)
+        dispatcher.submit(SMSJob([1], ['+254700000001'], 'hello'))
+        dispatcher.join()
+        (job, ok, _), = self.results
+        self.assertTrue(ok)
+        self.assertEqual(job.attempts, 3)
+
+    def test_errors_that_may_have_sent_are_not_retried(self):
+        # The provider may have sent the texts before failing with a 5xx.
+        for code in (400, 503):
+            self.server.statuses = [code]
+            self.results = []
+            dispatcher = self.make_dispatcher(max_retries=3)
+            dispatcher.submit(SMSJob([1], ['+254700000001'], 'hello'))
+            dispatcher.join()
+            (job, ok, _), = self.results
+            self.assertFalse(ok)
+            self.assertEqual(job.attempts, 1)
+
+    def test_rate_limit_per_provider(self):
+        dispatcher = self.make_dispatcher(rate=20, burst=1)
+        start = time.monotonic()
+        for i in range(5):
+            dispatcher.submit(SMSJob([i], ['+254700000001'], 'hello'))
+        dispatcher.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertEqual(len(self.server.requests), 5)
+
+
+class InvitationSMSResultTests(TestCase):
+
+    def test_result_updates_invitation(self):
+        user = User.objects.create_user(username='inviter', password='testpass')
+        invitation = Invitation.objects.create(
+            first_name='A', last_name='B', phone_number='+254700000001', invited_by=user
+        )
+        record_sms_result(SMSJob([invitation.id], [invitation.phone_number], 'hi'), False, 'timed out')
+        invitation.refresh_from_db()
+        self.assertEqual((invitation.sms_status, invitation.sms_error), ('failed', 'timed out'))
+
+
+@override_settings(SMS_BULK_CHUNK_SIZE=2)
+class BulkInvitationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='bulkinviter', password='testpass')
+        self.client = APIClient()
+        self.client.login(username='bulkinviter', password='testpass')
+        self.url = reverse('bulk_send_invitations')
+
+    def test_bulk_invite(self):
+        invitations = [
+            {'first_name': f'Guest{i}', 'last_name': 'X', 'phone_number': f'+25470000000{i}'} for i in range(5)
+        ]
+        invitations.append({'first_name': 'No', 'last_name': 'Phone'})
+        invitations.append({'first_name': 'Dup', 'last_name': 'X', 'phone_number': '+254700000000'})
+
+        submitted = []
+        with mock.patch('chat.views.get_dispatcher') as get_dispatcher:
+            get_dispatcher.return_value.submit.side_effect = submitted.append
+            with self.captureOnCommitCallbacks(execute=True):
+                # Session, user, and a single INSERT for every invitation.
+                with self.assertNumQueries(3):
+                    response = self.client.post(self.url, {'invitations': invitations}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        results = response.data['results']
+        self.assertEqual([r['status'] for r in results], ['queued'] * 5 + ['rejected', 'rejected'])
+        self.assertEqual(Invitation.objects.count(), 5)
+        self.assertEqual(results[0]['invitation_id'], Invitation.objects.get(phone_number='+254700000000').id)
+        self.assertEqual([len(job.numbers) for job in submitted], [2, 2, 1])
+
+    def test_requeue_keeps_bulk_chunks(self):
+        expires_at = timezone.now() + timedelta(days=1)
+        Invitation.objects.bulk_create([
+            Invitation(first_name='G', last_name='X', phone_number=f'+25470000000{i}',
+                       invited_by=self.user, expires_at=expires_at)
+            for i in range(3)
+        ])
+        Invitation.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        dispatcher = mock.Mock()
+        self.assertEqual(requeue_invitations(dispatcher=dispatcher), 3)
+        jobs = [call.args[0] for call in dispatcher.submit.call_args_list]
+        self.assertEqual([len(job.numbers) for job in jobs], [2, 1])
+        self.assertEqual({job.message for job in jobs}, {bulk_invitation_message(self.user, expires_at)})
+        self.assertEqual(set(Invitation.objects.values_list('sms_status', flat=True)), {Invitation.SMS_SENDING})
+
+        # Claimed invitations aren't sent again by the next run.
+        self.assertEqual(requeue_invitations(dispatcher=dispatcher), 0)
+        self.assertEqual(dispatcher.submit.call_count, 2)
+
+    def test_requires_a_list(self):
+        response = self.client.post(self.url, {'invitations': 'nope'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class InvitationExpiryTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='sweeper', password='testpass')
+
+    def invite(self, **kwargs):
+        return Invitation.objects.create(first_name='A', last_name='B', phone_number='+254700000000',
+                                         invited_by=self.user, **kwargs)
+
+    def test_expiry_is_computed_per_row(self):
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(days=30)):
+            later = self.invite()
+        earlier = self.invite()
+        self.assertAlmostEqual(later.expires_at - earlier.expires_at, timedelta(days=30), delta=timedelta(minutes=1))
+
+    def test_sweep_deletes_expired_in_batches(self):
+        past = timezone.now() - timedelta(hours=1)
+        for _ in range(5):
+            self.invite(expires_at=past)
+        live = self.invite()
+
+        self.assertEqual(delete_expired_invitations(batch_size=2, max_batches=1), 2)
+        self.assertEqual(delete_expired_invitations(batch_size=2), 3)
+        self.assertEqual(list(Invitation.objects.all()), [live])
+
+    def test_sweep_command(self):
+        self.invite(expires_at=timezone.now() - timedelta(hours=2))
+        self.invite(expires_at=timezone.now() - timedelta(minutes=10))
+        out = StringIO()
+        call_command('sweep_invitations', '--grace-hours', '1', '--pause', '0', stdout=out)
+        self.assertIn('Deleted 1 expired invitations', out.getvalue())
+        self.assertEqual(Invitation.objects.count(), 1)
+
+    def test_requeues_invitations_lost_while_queued(self):
+        stale = self.invite()
+        sent = self.invite(sms_status=Invitation.SMS_SENT)
+        self.invite()
+        Invitation.objects.filter(pk__in=[stale.pk, sent.pk]).update(created_at=timezone.now() - timedelta(hours=1))
+        dispatcher = mock.Mock()
+        with mock.patch('chat.sms._dispatcher', dispatcher):
+            out = StringIO()
+            call_command('sweep_invitations', '--pause', '0', stdout=out)
+        self.assertIn('Resent 1 queued invitations', out.getvalue())
+        (job,), _ = dispatcher.submit.call_args
+        self.assertEqual(job.invitation_ids, [stale.id])
+        self.assertIn('Hello A B', job.message)
+        dispatcher.join.assert_called_once_with()
+
+
+class MediaUploadTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_UPLOAD_MAX_CHUNK_SIZE=4)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='uploader', password='testpass')
+        self.room = ChatRoom.objects.create(name='media_room')
+        self.room.users.add(self.user)
+        self.client = APIClient()
+        self.client.login(username='uploader', password='testpass')
+
+    def start(self, data=b'0123456789', **extra):
+        response = self.client.post(reverse('chunked_upload'), {
+            'filename': 'notes.txt', 'size': len(data), **extra,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return reverse('chunked_upload_detail', args=[response.data['upload_id']])
+
+    def send(self, url, chunk, offset):
+        return self.client.patch(url, chunk, content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_chunked_upload_is_content_addressed_and_in_history(self):
+        data = b'0123456789'
+        sha256 = hashlib.sha256(data).hexdigest()
+        url = self.start(data, room_name='media_room')
+
+        self.assertEqual(self.send(url, data[:4], 0).data['offset'], 4)
+        # A retried chunk at a stale offset is refused with the offset to resume from.
+        response = self.send(url, data[:4], 0)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.client.get(url).data['offset'], 4)
+        self.assertEqual(self.send(url, data[4:8], 4).data['offset'], 8)
+        response = self.send(url, data[8:], 8)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['media']['id'], sha256)
+        with open(os.path.join(self.media_root, 'uploads', sha256[:2], sha256), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'uploads', 'partial')), [])
+
+        history = self.client.get(reverse('chat_message_list_create'), {'room_name': 'media_room'})
+        message = history.data['messages'][-1]
+        self.assertEqual(message['id'], response.data['message_id'])
+        self.assertEqual(message['message'], 'notes.txt')
+        self.assertEqual(message['media']['url'], f'/media/uploads/{sha256[:2]}/{sha256}')
+
+    def test_identical_uploads_are_deduplicated(self):
+        for _ in range(2):
+            url = self.start(b'abc')
+            response = self.send(url, b'abc', 0)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(MediaFile.objects.count(), 1)
+
+    def test_limits(self):
+        url = self.start()
+        self.assertEqual(self.send(url, b'01234', 0).status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        with override_settings(MEDIA_UPLOAD_MAX_SIZE=5):
+            response = self.client.post(reverse('chunked_upload'), {'filename': 'big.bin', 'size': 6}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    @skipUnless(media.fcntl, 'needs flock')
+    def test_chunk_is_refused_while_another_is_written(self):
+        url = self.start(b'abc')
+        with media.locked_partial(MediaUpload.objects.get()):
+            response = self.send(url, b'abc', 0)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 0)
+        self.assertEqual(self.send(url, b'abc', 0).status_code, status.HTTP_201_CREATED)
+
+    def test_room_uploads_require_membership(self):
+        ChatRoom.objects.create(name='other_room')
+        response = self.client.post(reverse('chunked_upload'), {
+            'filename': 'notes.txt', 'size': 3, 'room_name': 'other_room',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # Leaving the room before the last chunk stops the upload being posted.
+        url = self.start(b'abc', room_name='media_room')
+        self.room.users.remove(self.user)
+        self.assertEqual(self.send(url, b'abc', 0).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(ChatMessage.objects.filter(room=self.room).exists())
+
+    def test_abandoned_uploads_are_swept(self):
+        self.send(self.start(b'0123456789'), b'0123', 0)
+        stale = MediaUpload.objects.get()
+        self.start(b'abc')
+        MediaUpload.objects.filter(pk=stale.pk).update(created_at=timezone.now() - timedelta(days=2))
+        partial = os.path.join(self.media_root, 'uploads', 'partial', str(stale.pk))
+        os.utime(partial, (time.time() - 2 * 86400,) * 2)
+
+        out = StringIO()
+        call_command('sweep_uploads', stdout=out)
+        self.assertIn('Deleted 1 abandoned uploads', out.getvalue())
+        self.assertFalse(MediaUpload.objects.filter(pk=stale.pk).exists())
+        self.assertEqual(MediaUpload.objects.count(), 1)
+        self.assertFalse(os.path.exists(partial))
+
+    def test_multipart_upload(self):
+        upload = SimpleUploadedFile('photo.png', b'not really a png', content_type='image/png')
+        response = self.client.post(reverse('media_upload'), {'file': upload})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['media']['content_type'], 'image/png')
+        self.assertEqual(MediaFile.objects.get().size, 16)
+
+
+class MediaServingTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='viewer', password='testpass')
+        self.client.login(username='viewer', password='testpass')
+        self.data = bytes(range(256)) * 4
+        upload = SimpleUploadedFile('blob.bin', self.data, content_type='application/octet-stream')
+        self.media = self.client.post(reverse('media_upload'), {'file': upload}).data['media']
+
+    async def fetch(self, url, **headers):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(url, headers=headers)
+        body = b''.join([chunk async for chunk in response.streaming_content]) if response.streaming else response.content
+        return response, body
+
+    async def test_full_and_ranged_downloads(self):
+        response, body = await self.fetch(self.media['url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        etag = response['ETag']
+
+        response, body = await self.fetch(self.media['url'], Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.data)}')
+        self.assertEqual(body, self.data[10:20])
+
+        response, body = await self.fetch(self.media['url'], Range='bytes=-5')
+        self.assertEqual(body, self.data[-5:])
+
+        response, _ = await self.fetch(self.media['url'], Range=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+
+        response, body = await self.fetch(self.media['url'], If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b'')
+
+    @override_settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect')
+    async def test_sendfile_header(self):
+        response, body = await self.fetch(self.media['url'])
+        sha256 = self.media['id']
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/uploads/{sha256[:2]}/{sha256}')
+        self.assertEqual(body, b'')
+
+    async def test_requires_login(self):
+        response = await self.async_client.get(self.media['url'])
+        self.assertEqual(response.status_code, 403)
+
+    async def test_basic_auth(self):
+        credentials = base64.b64encode(b'viewer:testpass').decode()
+        response = await self.async_client.get(self.media['url'], headers={'Authorization': f'Basic {credentials}'})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_only_room_members_see_posted_files(self):
+        other = await User.objects.acreate_user(username='other', password='testpass')
+        await self.async_client.aforce_login(other)
+        response = await self.async_client.get(self.media['url'])
+        self.assertEqual(response.status_code, 404)
+
+        room = await ChatRoom.objects.acreate(name='shared')
+        await room.users.aadd(self.user, other)
+        media = await MediaFile.objects.aget(sha256=self.media['id'])
+        await ChatMessage.objects.acreate(room=room, user=self.user, content='blob.bin', media=media)
+        response = await self.async_client.get(self.media['url'])
+        self.assertEqual(response.status_code, 200)
+
+    @skipUnless(Image, 'Pillow is not installed')
+    async def test_thumbnail(self):
+        buffer = io.BytesIO()
+        Image.new('RGBA', (1024, 768), (255, 0, 0, 128)).save(buffer, 'PNG')
+        upload = SimpleUploadedFile('photo.png', buffer.getvalue(), content_type='image/png')
+        await self.async_client.aforce_login(self.user)
+        media = (await self.async_client.post(reverse('media_upload'), {'file': upload})).data['media']
+
+        response, body = await self.fetch(media['thumbnails']['128'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        with Image.open(io.BytesIO(body)) as thumbnail:
+            self.assertEqual(thumbnail.size, (128, 96))
+
+        response, _ = await self.fetch(f'/media/thumbs/{media["id"]}/100')
+        self.assertEqual(response.status_code, 404)
+
+
+class NotificationTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='testpass')
+        self.bob = User.objects.create_user(username='bob', password='testpass')
+        self.carol = User.objects.create_user(username='carol', password='testpass')
+        self.room = ChatRoom.objects.create(name='notify_room')
+        self.room.users.add(self.alice, self.bob)
+        self.client = APIClient()
+        self.client.login(username='bob', password='testpass')
+
+    def test_mentions_fan_out_on_write(self):
+        with mock.patch('chat.notifications.push') as push:
+            with self.captureOnCommitCallbacks(execute=True):
+                ChatMessage.objects.create(room=self.room, user=self.alice, content='hi @bob, @carol and @alice.')
+                persist_messages([(self.room.id, self.alice.id, 'again @bob.'), (self.room.id, self.alice.id, 'plain')])
+
+        # carol isn't a member and alice mentioned herself.
+        self.assertEqual(Notification.objects.filter(user=self.bob).count(), 2)
+        self.assertEqual(Notification.objects.exclude(user=self.bob).count(), 0)
+        pushed = [event for call in push.call_args_list for event in call.args[0]]
+        self.assertEqual([(user_id, n['user']) for user_id, n in pushed], [(self.bob.id, 'alice')] * 2)
+
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('notifications'))
+        self.assertEqual(response.data['rooms'], [{'room_name': 'notify_room', 'unread': 3, 'unread_mentions': 2}])
+        self.assertEqual([n['message'] for n in response.data['notifications']], ['again @bob.', 'hi @bob, @carol and @alice.'])
+
+    def test_batched_mark_as_read(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = ChatMessage.objects.create(room=self.room, user=self.alice, content='@bob one')
+            second = ChatMessage.objects.create(room=self.room, user=self.alice, content='@bob two')
+        latest = Notification.objects.get(message=second)
+
+        response = self.client.post(reverse('notifications_read'), {
+            'rooms': {'notify_room': first.seq}, 'notifications': [latest.id],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['rooms'], [{'room_name': 'notify_room', 'unread': 1, 'unread_mentions': 0}])
+        self.assertFalse(Notification.objects.filter(read=False).exists())
+
+    def test_notifications_outlive_archived_messages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            message = ChatMessage.objects.create(room=self.room, user=self.alice, content='@bob old news')
+        ChatMessage.objects.filter(pk=message.pk).update(timestamp=timezone.now() - timedelta(days=100))
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        with override_settings(CHAT_ARCHIVE_ROOT=archive_root):
+            call_command('archive_messages', stdout=StringIO())
+        self.assertFalse(ChatMessage.objects.exists())
+
+        notification = self.client.get(reverse('notifications')).data['notifications'][0]
+        self.assertEqual(
+            (notification['message_id'], notification['seq'], notification['user'], notification['message']),
+            (None, 1, 'alice', '@bob old news'),
+        )
+        self.client.post(reverse('notifications_read'), {'rooms': {'notify_room': 1}}, format='json')
+        self.assertFalse(Notification.objects.filter(read=False).exists())
+
+    async def test_websocket_push(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/notify_room/')
+        communicator.scope['user'] = self.bob
+        with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'chat.layers.ShardedInMemoryChannelLayer'}}), \
+                mock.patch('chat.presence._tracker', PresenceTracker(broadcast_interval=60)):
+            await communicator.connect()
+            await sync_to_async(notifications.push)([(self.bob.id, {'id': 1, 'message': '@bob hi'})])
+            self.assertEqual(await communicator.receive_json_from(), {'notification': {'id': 1, 'message': '@bob hi'}})
+            await communicator.disconnect()
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', password='testpass')
+        self.other = User.objects.create_user(username='other', password='testpass')
+        self.room = ChatRoom.objects.create(name='search_room')
+        self.elsewhere = ChatRoom.objects.create(name='search_elsewhere')
+        self.private = ChatRoom.objects.create(name='search_private')
+        self.room.users.add(self.user, self.other)
+        self.elsewhere.users.add(self.user)
+        self.private.users.add(self.other)
+        self.client = APIClient()
+        self.client.login(username='searcher', password='testpass')
+
+    def seed(self):
+        self.once = ChatMessage.objects.create(room=self.room, user=self.other, content='Deploy the release tonight')
+        self.twice = ChatMessage.objects.create(room=self.room, user=self.user, content='release notes: release it')
+        ChatMessage.objects.create(room=self.elsewhere, user=self.user, content='Release party!')
+        ChatMessage.objects.create(room=self.private, user=self.other, content='secret release')
+        ChatMessage.objects.create(room=self.room, user=self.other, content='unrelated')
+
+    def check_queries(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seed()
+        found = search.search('RELEASE', self.user, room_id=self.room.id)
+        self.assertEqual([r['id'] for r in found['results']], [self.twice.id, self.once.id])
+        self.assertEqual(found['results'][0]['room_name'], 'search_room')
+
+        # Every word must match, and only the user's rooms are searched.
+        self.assertEqual(len(search.search('release', self.user)['results']), 3)
+        self.assertEqual([r['id'] for r in search.search('deploy release', self.user)['results']], [self.once.id])
+        self.assertEqual(search.search('release', self.user, author_id=self.other.id)['results'][0]['id'], self.once.id)
+
+        page = search.search('release', self.user, limit=2, order='recent')
+        self.assertEqual(page['next_offset'], 2)
+        self.assertEqual(page['results'][1]['id'], self.twice.id)
+        self.assertIsNone(search.search('release', self.user, limit=2, offset=2)['next_offset'])
+
+    def test_failing_receiver_keeps_the_message(self):
+        with mock.patch('chat.search._backend', 'inverted'), \
+                mock.patch('chat.notifications.fan_out', side_effect=RuntimeError('boom')):
+            with self.assertLogs('django.dispatch', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+                persist_messages([(self.room.id, self.user.id, 'release @other')])
+            self.assertEqual(ChatMessage.objects.get().content, 'release @other')
+            self.assertEqual(len(search.search('release', self.user)['results']), 1)
+
+    def test_fts5(self):
+        if not search.fts5_available():
+            self.skipTest('SQLite was built without FTS5')
+        with mock.patch('chat.search._backend', 'fts5'):
+            self.check_queries()
+            # Edits and deletes reach the index through the triggers.
+            self.once.content = 'postponed'
+            self.once.save()
+            self.twice.delete()
+            self.assertEqual(search.search('release', self.user, room_id=self.room.id)['results'], [])
+
+    def test_inverted_index(self):
+        with mock.patch('chat.search._backend', 'inverted'):
+            self.check_queries()
+            # Edits aren't indexed as they happen; a rebuild catches up.
+            self.once.content = 'postponed'
+            self.once.save()
+            call_command('rebuild_search_index', stdout=StringIO())
+            found = search.search('release', self.user, room_id=self.room.id)['results']
+            self.assertEqual([r['id'] for r in found], [self.twice.id])
+            self.twice.delete()
+            self.assertEqual(search.search('release', self.user, room_id=self.room.id)['results'], [])
+
+    def test_search_view(self):
+        self.seed()
+        response = self.client.get(reverse('search'), {'q': 'release', 'room_name': 'search_room'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+        response = self.client.get(reverse('search'), {'q': 'release', 'room_name': 'search_private'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get(reverse('search'), {'q': '!!'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'release', 'order': 'best'}).status_code, 400)
+        response = self.client.get(reverse('search'), {'q': 'release', 'user': 'nobody'})
+        self.assertEqual(response.data['results'], [])
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_root)
+        settings_override = override_settings(CHAT_ARCHIVE_ROOT=self.archive_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        user = User.objects.create_user(username='archivist', password='testpass')
+        self.room = ChatRoom.objects.create(name='archive_room')
+        persist_messages([(self.room.id, user.id, f'm{i}') for i in range(1, 36)])
+        old = timezone.now() - timedelta(days=100)
+        ChatMessage.objects.filter(room=self.room, seq__lte=30).update(timestamp=old)
+        out = StringIO()
+        call_command('archive_messages', '--segment-size=12', '--block-size=4', stdout=out)
+        self.assertIn('Archived 30 messages.', out.getvalue())
+
+    def seqs(self, page):
+        return [message['seq'] for message in page['messages']]
+
+    def test_old_messages_move_to_segments(self):
+        self.assertEqual(list(ChatMessage.objects.filter(room=self.room).values_list('seq', flat=True)), [31, 32, 33, 34, 35])
+        segments = ArchiveSegment.objects.filter(room=self.room).order_by('first_seq')
+        self.assertEqual([(s.first_seq, s.last_seq, len(s.blocks)) for s in segments], [(1, 12, 3), (13, 24, 3), (25, 30, 2)])
+        # Nothing left to do on a second run.
+        call_command('archive_messages', stdout=StringIO())
+        self.assertEqual(ArchiveSegment.objects.count(), 3)
+
+    def test_overlapping_run_keeps_the_other_runs_segment(self):
+        before = timezone.now()
+        write_segment = archive.write_segment
+        raced = []
+
+        def racing_write(room_id, rows, block_size):
+            # Another run archives the same rows while this one writes them.
+            if not raced:
+                raced.append(True)
+                archive._archive_room(room_id, before, 12, 4)
+            return write_segment(room_id, rows, block_size)
+
+        with mock.patch('chat.archive.write_segment', racing_write), self.assertLogs('chat.archive', 'WARNING'):
+            self.assertEqual(archive.archive_room(self.room.id, before, 12, 4), 0)
+        segment = ArchiveSegment.objects.get(room=self.room, first_seq=31)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.archive_root, str(self.room.id)))),
+            sorted([os.path.basename(s.path) for s in ArchiveSegment.objects.all()] + ['.lock']),
+        )
+        self.assertEqual([row[4] for row in archive.read_block(segment, 0)], [31, 32, 33, 34])
+
+    def test_history_reads_through_to_the_archive(self):
+        page = paginate_messages(self.room, limit=10)
+        self.assertEqual(self.seqs(page), list(range(26, 36)))
+        self.assertEqual(page['messages'][0]['message'], 'm26')
+
+        seen = self.seqs(page)
+        while page['has_more']:
+            page = paginate_messages(self.room, before=page['before'], limit=7)
+            seen = self.seqs(page) + seen
+        self.assertEqual(seen, list(range(1, 36)))
+
+        self.assertEqual(self.seqs(paginate_messages(self.room, after_seq=3, limit=5)), [4, 5, 6, 7, 8])
+        self.assertEqual(self.seqs(paginate_messages(self.room, after_seq=28, limit=5)), [29, 30, 31, 32, 33])
+        older = paginate_messages(self.room, after_seq=8, limit=2)
+        self.assertEqual(self.seqs(paginate_messages(self.room, after=older['after'], limit=3)), [11, 12, 13])
+
+        streamed = json.loads(''.join(stream_messages(self.room)))
+        self.assertEqual([message['seq'] for message in streamed['messages']], list(range(1, 36)))
+
+        async def astream():
+            return [chunk async for chunk in astream_messages(self.room)]
+
+        with mock.patch('chat.pagination.STREAM_CHUNK_SIZE', 4):
+            chunks = async_to_sync(astream)()
+        self.assertEqual([message['seq'] for message in json.loads(''.join(chunks))['messages']], list(range(1, 36)))
+
+class HealthTests(TestCase):
+    def test_reports_database(self):
+        response = self.client.get(reverse('health'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['status'], 'ok')
+        self.assertEqual(response.json()['database']['vendor'], 'sqlite')
+        self.assertIn('journal_mode', response.json()['database'])
+
+    def test_unavailable_database(self):
+        with mock.patch('chat.health.check_database', side_effect=OperationalError('database is locked')):
+            response = self.client.get(reverse('health'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.json(), {'status': 'unavailable', 'error': 'OperationalError'})
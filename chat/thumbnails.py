@@ -0,0 +1,102 @@
+"""
+Disk-cached previews of uploaded images.
+
+Thumbnails are rendered on a small thread pool, either right after an image
+is stored or on the first request for a size that is not on disk yet, and
+written next to the originals under MEDIA_ROOT/thumbs. Rendering needs
+Pillow; without it images are only served full size.
+"""
+import atexit
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+def supports(content_type):
+    return Image is not None and (content_type or '').startswith('image/')
+
+
+def thumbnail_path(sha256, size):
+    return f'thumbs/{sha256[:2]}/{sha256}_{size}.jpg'
+
+
+def render_thumbnail(source, target, size):
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial = f'{target}.{threading.get_ident()}.tmp'
+        image.save(partial, 'JPEG', quality=80, optimize=True)
+    # Readers only ever see a complete file.
+    os.replace(partial, target)
+    metrics.incr('media.thumbnails_rendered')
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = {}
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.MEDIA_THUMBNAIL_WORKERS, thread_name_prefix='thumbnails'
+                )
+                atexit.register(_executor.shutdown, wait=False)
+    return _executor
+
+
+def ensure_thumbnail(sha256, source, size):
+    """
+    Return a Future that resolves once the ``size`` thumbnail is on disk.
+    Concurrent requests for the same thumbnail share a single render.
+    """
+    target = os.path.join(settings.MEDIA_ROOT, thumbnail_path(sha256, size))
+    if os.path.exists(target):
+        future = Future()
+        future.set_result(target)
+        return future
+
+    key = (sha256, size)
+    with _lock:
+        future = _pending.get(key)
+        if future is None:
+            future = _pending[key] = get_executor().submit(_render, key, source, target, size)
+    return future
+
+
+def _render(key, source, target, size):
+    try:
+        render_thumbnail(source, target, size)
+        return target
+    except Exception:
+        logger.exception('Could not render a %spx thumbnail of %s', size, key[0])
+        raise
+    finally:
+        with _lock:
+            _pending.pop(key, None)
+
+
+def schedule_thumbnails(sha256, source, content_type):
+    """Render every configured size of a newly stored image in the background."""
+    if supports(content_type):
+        for size in settings.MEDIA_THUMBNAIL_SIZES:
+            ensure_thumbnail(sha256, source, size)
@@ -6,11 +6,19 @@ from rest_framework.authtoken.views import obtain_auth_token
 urlpatterns = [
     path('api/chat/messages/', views.ChatMessageListCreateView.as_view(), name='chat_message_list_create'),
     path('api/send_invitation/', views.SendInvitationView.as_view(), name='send_invitation'),
+    path('api/send_invitations/bulk/', views.BulkSendInvitationView.as_view(), name='bulk_send_invitations'),
     path('api/auth/', views.CustomAuthenticatedView.as_view(), name='custom_auth'),
     path('api/messages/send/', views.send_message, name='send_message'), 
     path('api/messages/retrieve/', views.get_messages, name='get_messages'),  
     path('api/media_upload/', views.MediaUploadView.as_view(), name='media_upload'),
+    path('api/media/uploads/', views.ChunkedUploadView.as_view(), name='chunked_upload'),
+    path('api/media/uploads/<uuid:upload_id>/', views.ChunkedUploadDetailView.as_view(), name='chunked_upload_detail'),
+    path('api/metrics/', views.MetricsView.as_view(), name='metrics'),
+    path('api/health/', views.HealthView.as_view(), name='health'),
+    path('api/presence/', views.PresenceView.as_view(), name='presence'),
+    path('api/search/', views.SearchView.as_view(), name='search'),
     path('notifications/', views.NotificationsView.as_view(), name='notifications'),
+    path('notifications/read/', views.NotificationsReadView.as_view(), name='notifications_read'),
     path('leave_room/', views.LeaveChatRoomView.as_view(), name='leave_chatroom'),
     path('api-token-auth/', obtain_auth_token, name='api_token_auth'),
 ]
@@ -1,20 +1,39 @@
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
 from django.conf import settings
 from django.shortcuts import render, get_object_or_404
-import requests
-import pika
+from django.contrib.auth.models import User
+from django.db import transaction
+import asyncio
 import json
-from django.http import JsonResponse
+import math
+import os
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from datetime import timedelta
 from django.utils.timezone import now
 from django.utils import timezone
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .models import Invitation, ChatRoom, ChatMessage
+from asgiref.sync import async_to_sync, sync_to_async
+from .models import Invitation, ChatRoom, ChatMessage, MediaFile, MediaUpload, invitation_expiry
+from .media import (
+    UploadError, can_view_media, complete_upload, create_upload, is_member, media_path, media_response,
+    serialize_media, store_uploaded_file, write_chunk,
+)
+from . import health, metrics, notifications, search, thumbnails
+from .cache import get_room_id, get_user_id, room_ids, user_ids
+from .protocol import chat_event
+from .publisher import get_publisher
+from .ratelimit import check_message
+from .sms import SMSJob, bulk_invitation_message, get_dispatcher, invitation_message
+from .presence import get_presence
+from .pagination import astream_messages, paginate_messages, parse_limit, parse_seq, stream_messages
 from django.views.decorators.csrf import csrf_exempt
 from channels.generic.websocket import WebsocketConsumer
 
@@ -32,16 +51,26 @@ class ChatMessageListCreateView(APIView):
             return Response({'error': 'room_name parameter is required'}, status=status.HTTP_400_BAD_REQUEST)
 
         chat_room = get_object_or_404(ChatRoom, name=room_name)
-        messages = ChatMessage.objects.filter(room=chat_room).order_by('timestamp')
-        messages_data = [
-            {
-                'user': message.user.username,
-                'message': message.content,
-                'timestamp': message.timestamp.isoformat()
-            }
-            for message in messages
-        ]
-        return Response({'messages': messages_data}, status=status.HTTP_200_OK)
+
+        if request.query_params.get('stream') in ('1', 'true'):
+            # Under ASGI a sync iterator would be read to the end before sending.
+            stream = astream_messages if isinstance(request._request, ASGIRequest) else stream_messages
+            return StreamingHttpResponse(stream(chat_room), content_type='application/json')
+
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        after_seq = request.query_params.get('after_seq')
+        if len([p for p in (before, after, after_seq) if p]) > 1:
+            return Response({'error': 'before, after and after_seq cannot be combined'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = parse_limit(request.query_params.get('limit'))
+            page = paginate_messages(
+                chat_room, before=before, after=after, after_seq=parse_seq(after_seq), limit=limit
+            )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page, status=status.HTTP_200_OK)
 
     def post(self, request):
         message_content = request.data.get('message')
@@ -50,34 +79,43 @@ class ChatMessageListCreateView(APIView):
             return Response({'error': 'message and room_name are required'}, status=status.HTTP_400_BAD_REQUEST)
 
         chat_room = get_object_or_404(ChatRoom, name=room_name)
+        wait = check_message(request.user.id, chat_room.id)
+        if wait:
+            return Response(
+                {'error': 'Rate limit exceeded', 'retry_after': round(wait, 3)},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(math.ceil(wait))},
+            )
         message = ChatMessage.objects.create(room=chat_room, user=request.user, content=message_content)
 
         message_data = {
             'user': request.user.username,
             'message': message_content,
             'timestamp': message.timestamp.isoformat(),
-            'room_name': room_name
+            'room_name': room_name,
+            'seq': message.seq,
         }
 
         self.publish_message(message_data)
         return Response(message_data, status=status.HTTP_201_CREATED)
 
     def publish_message(self, message):
+        # The RabbitMQ bridge delivers the message to WebSocket clients. Only
+        # if the broker can't take it is it sent to the channel layer here.
+        try:
+            get_publisher().publish(message)
+            return
+        except Exception as e:
+            print(f"Error publishing message to RabbitMQ: {e}")
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-            channel = connection.channel()
-            channel.queue_declare(queue='chat_messages')
-            channel.basic_publish(exchange='', routing_key='chat_messages', body=json.dumps(message))
-
             room_group_name = f'chat_{message["room_name"]}'
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 room_group_name,
-                {'type': 'chat_message', 'message': message}
+                chat_event(message['user'], message['message'], message.get('seq'))
             )
-            connection.close()
         except Exception as e:
-            print(f"Error publishing message to RabbitMQ: {e}")
+            print(f"Error broadcasting message: {e}")
 
 
 class MediaUploadView(APIView):
@@ -86,19 +124,219 @@ class MediaUploadView(APIView):
     def post(self, request):
         file = request.FILES.get('file')
         if file:
-            file_path = f'media/uploads/{file.name}'
-            with open(file_path, 'wb+') as destination:
-                for chunk in file.chunks():
-                    destination.write(chunk)
-            return Response({'status': 'Media uploaded successfully'}, status=status.HTTP_200_OK)
+            try:
+                media = store_uploaded_file(file, request.user)
+            except UploadError as e:
+                return Response({'error': str(e)}, status=e.status)
+            return Response({
+                'status': 'Media uploaded successfully',
+                'media': serialize_media(media.sha256, media.size, media.content_type),
+            }, status=status.HTTP_200_OK)
         return Response({'error': 'No file uploaded'}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ChunkedUploadView(APIView):
+    """
+    Start a resumable upload: POST ``filename``, ``size`` and optionally
+    ``content_type`` and ``room_name``, then send the bytes in order with
+    PATCH requests to the returned upload.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        filename = request.data.get('filename')
+        room_name = request.data.get('room_name')
+        try:
+            size = int(request.data.get('size'))
+        except (TypeError, ValueError):
+            size = None
+        if not filename or size is None:
+            return Response({'error': 'filename and size are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        room = get_object_or_404(ChatRoom, name=room_name) if room_name else None
+        if room is not None and not is_member(request.user.id, room.id):
+            return Response({'error': 'Not a member of this room'}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            upload = create_upload(request.user, filename, size, request.data.get('content_type'), room)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=e.status)
+        return Response({
+            'upload_id': str(upload.id),
+            'offset': upload.offset,
+            'size': upload.size,
+            'max_chunk_size': settings.MEDIA_UPLOAD_MAX_CHUNK_SIZE,
+        }, status=status.HTTP_201_CREATED)
+
+
+class ChunkedUploadDetailView(APIView):
+    """
+    GET reports how far an upload got so the client can resume. PATCH
+    appends the raw request body at the ``Upload-Offset`` header; the
+    request that supplies the last byte completes the upload.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, upload_id):
+        upload = get_object_or_404(MediaUpload, pk=upload_id, user=request.user)
+        return Response(self.describe(upload), status=status.HTTP_200_OK)
+
+    def patch(self, request, upload_id):
+        upload = get_object_or_404(MediaUpload, pk=upload_id, user=request.user)
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+            length = int(request.headers.get('Content-Length', ''))
+        except ValueError:
+            return Response({'error': 'Upload-Offset and Content-Length headers are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # Read the body as a stream; request.data would buffer it.
+            write_chunk(upload, request.stream, offset, length)
+        except UploadError as e:
+            return Response({'error': str(e), **self.describe(upload)}, status=e.status)
+
+        if upload.offset < upload.size:
+            return Response(self.describe(upload), status=status.HTTP_200_OK)
+        try:
+            media, message = complete_upload(upload)
+        except UploadError as e:
+            return Response({'error': str(e), **self.describe(upload)}, status=e.status)
+        return Response({
+            **self.describe(upload),
+            'media': serialize_media(media.sha256, media.size, media.content_type),
+            'message_id': message.id if message else None,
+        }, status=status.HTTP_201_CREATED)
+
+    def describe(self, upload):
+        return {'upload_id': str(upload.id), 'offset': upload.offset, 'size': upload.size}
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'metrics': metrics.snapshot(),
+            'caches': {'room': room_ids.stats(), 'user': user_ids.stats()},
+        }, status=status.HTTP_200_OK)
+
+
+class HealthView(APIView):
+    """For load balancers: 503 when the database cannot be queried."""
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        try:
+            data = health.check()
+        except Exception as exc:
+            return Response(
+                {'status': 'unavailable', 'error': type(exc).__name__},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        return Response({'status': 'ok', **data}, status=status.HTTP_200_OK)
+
+
+class PresenceView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        room_name = request.query_params.get('room_name')
+        if not room_name:
+            return Response({'error': 'room_name parameter is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if not settings.PRESENCE_ENABLED:
+            return Response(
+                {'error': 'Presence is not tracked'},
+                status=status.HTTP_501_NOT_IMPLEMENTED,
+            )
+        room_id = get_room_id(room_name)
+        if room_id is None:
+            raise Http404('No such room')
+
+        presence = get_presence()
+        data = {'room_name': room_name, 'online': presence.online_count(room_id)}
+        if request.query_params.get('users') in ('1', 'true'):
+            try:
+                offset = int(request.query_params.get('offset', 0))
+                limit = parse_limit(request.query_params.get('limit'))
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            online = presence.online_users(room_id, max(offset, 0), limit)
+            names = dict(User.objects.filter(pk__in=online).values_list('id', 'username'))
+            data['users'] = [{'id': user_id, 'username': names.get(user_id)} for user_id in online]
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class SearchView(APIView):
+    """
+    Search messages: ``q`` in one room (``room_name``) or in every room of
+    the current user, optionally only those sent by ``user``. ``order`` is
+    ``rank`` (default) or ``recent``.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        params = request.query_params
+        room_id = author_id = None
+        if params.get('room_name'):
+            room_id = get_room_id(params['room_name'])
+            if room_id is None:
+                raise Http404('No such room')
+            if not ChatRoom.users.through.objects.filter(chatroom_id=room_id, user_id=request.user.id).exists():
+                return Response({'error': 'Not a member of this room'}, status=status.HTTP_403_FORBIDDEN)
+        if params.get('user'):
+            author_id = get_user_id(params['user'])
+            if author_id is None:
+                return Response({'results': [], 'next_offset': None}, status=status.HTTP_200_OK)
+
+        try:
+            limit = parse_limit(params.get('limit'))
+            offset = int(params.get('offset') or 0)
+            if not 0 <= offset <= settings.CHAT_SEARCH_MAX_OFFSET:
+                raise ValueError(f'offset must be between 0 and {settings.CHAT_SEARCH_MAX_OFFSET}')
+            results = search.search(
+                params.get('q', ''), request.user, room_id=room_id, author_id=author_id,
+                limit=limit, offset=offset, order=params.get('order') or 'rank',
+            )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(results, status=status.HTTP_200_OK)
+
+
 class NotificationsView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        return Response({'notifications': []}, status=status.HTTP_200_OK)
+        try:
+            limit = parse_limit(request.query_params.get('limit') or settings.NOTIFICATION_PAGE_SIZE)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        unread_only = request.query_params.get('unread') in ('1', 'true')
+        return Response(notifications.inbox(request.user, limit, unread_only), status=status.HTTP_200_OK)
+
+
+class NotificationsReadView(APIView):
+    """
+    Mark many things read at once: ``rooms`` maps room names to the last seq
+    seen, ``notifications`` lists notification ids.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        rooms = request.data.get('rooms') or {}
+        notification_ids = request.data.get('notifications') or []
+        try:
+            seqs = {name: parse_seq(seq) for name, seq in rooms.items()}
+            notification_ids = [int(i) for i in notification_ids]
+        except (AttributeError, TypeError, ValueError):
+            return Response({'error': 'rooms must map room names to seqs and notifications must list ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+        room_seqs = {
+            room_id: seqs[name]
+            for room_id, name in request.user.chat_rooms.filter(name__in=seqs).values_list('id', 'name')
+            if seqs[name] is not None
+        }
+        notifications.mark_read(request.user, room_seqs, notification_ids)
+        return Response(notifications.inbox(request.user, 0), status=status.HTTP_200_OK)
 
 
 class LeaveChatRoomView(APIView):
@@ -134,38 +372,83 @@ class SendInvitationView(APIView):
             invited_by=user
         )
 
-        expiry_date = now() + timedelta(days=2)
-        invitation.expires_at = expiry_date
-        invitation.save()
+        expiry_date_formatted = invitation.expires_at.strftime("%Y-%m-%d %H:%M:%S")
 
-        expiry_date_formatted = expiry_date.strftime("%Y-%m-%d %H:%M:%S")
-        join_url = f"{settings.BASE_URL}/join/?invited_by={user.username}&phone_number={phone_number}"
+        # Send after commit so the worker never sees an uncommitted invitation.
+        job = SMSJob([invitation.id], [phone_number], invitation_message(invitation))
+        transaction.on_commit(lambda: get_dispatcher().submit(job))
 
-        message = f"Hello {first_name} {last_name}, you've been invited to join Shawazi by {user.username}. This invitation expires on {expiry_date_formatted}. Click here to join: {join_url}"
+        return Response({
+            'status': 'Invitation created and SMS queued',
+            'invitation_id': invitation.id,
+            'sms_status': invitation.sms_status,
+            'expires_at': expiry_date_formatted,
+        }, status=status.HTTP_202_ACCEPTED)
 
-        sms_response = self.send_sms(phone_number, message)
 
-        if 'error' in sms_response:
-            return Response({'status': 'Invitation created, but SMS failed', 'sms_response': sms_response}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+class BulkSendInvitationView(APIView):
+    permission_classes = [IsAuthenticated]
 
-        return Response({'status': 'Invitation created and SMS sent', 'sms_response': sms_response, 'expires_at': expiry_date_formatted}, status=status.HTTP_200_OK)
+    def post(self, request):
+        entries = request.data.get('invitations')
+        if not isinstance(entries, list) or not entries:
+            return Response({'error': 'invitations must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(entries) > settings.SMS_BULK_MAX_INVITATIONS:
+            return Response({'error': f'At most {settings.SMS_BULK_MAX_INVITATIONS} invitations per request'}, status=status.HTTP_400_BAD_REQUEST)
 
-    def send_sms(self, phone_number, message):
-        headers = {
-            "Authorization": f"Basic {settings.SMSLEOPARD_ACCESS_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "source": "Akirachix",
-            "message": message,
-            "destination": [{"number": phone_number}],
-        }
-        try:
-            response = requests.post(settings.SMSLEOPARD_API_URL, json=payload, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            return {"error": str(e)}
+        user = request.user
+        expiry_date = invitation_expiry()
+        results = []
+        invitations = []
+        seen = set()
+        for index, entry in enumerate(entries):
+            entry = entry if isinstance(entry, dict) else {}
+            phone_number = entry.get('phone_number')
+            if not all([entry.get('first_name'), entry.get('last_name'), phone_number]):
+                results.append({'index': index, 'phone_number': phone_number, 'status': 'rejected', 'error': 'First name, last name, and phone number are required'})
+                continue
+            if phone_number in seen:
+                results.append({'index': index, 'phone_number': phone_number, 'status': 'rejected', 'error': 'Duplicate phone number'})
+                continue
+            seen.add(phone_number)
+            invitations.append(Invitation(
+                first_name=entry['first_name'],
+                last_name=entry['last_name'],
+                phone_number=phone_number,
+                invited_by=user,
+                expires_at=expiry_date,
+            ))
+            results.append({'index': index, 'phone_number': phone_number})
+
+        if not invitations:
+            return Response({'error': 'No valid invitations', 'results': results}, status=status.HTTP_400_BAD_REQUEST)
+
+        invitations = Invitation.objects.bulk_create(invitations)
+        by_number = {invitation.phone_number: invitation for invitation in invitations}
+        for result in results:
+            invitation = by_number.get(result['phone_number']) if 'status' not in result else None
+            if invitation is not None:
+                result.update(invitation_id=invitation.id, status=invitation.sms_status)
+
+        expiry_date_formatted = expiry_date.strftime("%Y-%m-%d %H:%M:%S")
+        message = bulk_invitation_message(user, expiry_date)
+
+        chunk_size = settings.SMS_BULK_CHUNK_SIZE
+        jobs = [
+            SMSJob(
+                [invitation.id for invitation in invitations[i:i + chunk_size]],
+                [invitation.phone_number for invitation in invitations[i:i + chunk_size]],
+                message,
+            )
+            for i in range(0, len(invitations), chunk_size)
+        ]
+        transaction.on_commit(lambda: [get_dispatcher().submit(job) for job in jobs])
+
+        return Response({
+            'status': f'{len(invitations)} invitations created and SMS queued',
+            'expires_at': expiry_date_formatted,
+            'results': results,
+        }, status=status.HTTP_202_ACCEPTED)
 
 
 def test_ui(request):
@@ -226,3 +509,52 @@ def send_message(request):
 def get_messages(request):
     return JsonResponse({'messages': []}, status=200)
 
+
+
+def authenticate_request(request):
+    """
+    Authenticate a plain Django view's request the way the API views are
+    (REST_FRAMEWORK's authentication classes, plus Basic). Returns the user,
+    or None without valid credentials.
+    """
+    classes = dict.fromkeys([*api_settings.DEFAULT_AUTHENTICATION_CLASSES, BasicAuthentication])
+    try:
+        user = Request(request, authenticators=[cls() for cls in classes]).user
+    except APIException:
+        return None
+    return user if user.is_authenticated else None
+
+
+async def find_media(user, sha256):
+    """Return the MediaFile for ``sha256``, as missing unless ``user`` may see it."""
+    media = await MediaFile.objects.filter(sha256=sha256).afirst()
+    if media is None or not await sync_to_async(can_view_media)(user, media):
+        raise Http404('No such media')
+    return media
+
+
+async def serve_media(request, prefix, sha256):
+    user = await sync_to_async(authenticate_request)(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication required'}, status=403)
+    media = await find_media(user, sha256)
+    if prefix != sha256[:2]:
+        raise Http404('No such media')
+    return media_response(request, media.path, f'"{sha256}"', media.content_type, media.size)
+
+
+async def serve_thumbnail(request, sha256, size):
+    user = await sync_to_async(authenticate_request)(request)
+    if user is None:
+        return JsonResponse({'error': 'Authentication required'}, status=403)
+    media = await find_media(user, sha256)
+    if size not in settings.MEDIA_THUMBNAIL_SIZES or not thumbnails.supports(media.content_type):
+        raise Http404('No such thumbnail')
+    try:
+        # Normally rendered already; otherwise rendered now on the thumbnail pool.
+        await asyncio.wrap_future(thumbnails.ensure_thumbnail(sha256, media_path(media.path), size))
+    except Exception:
+        raise Http404('No such thumbnail')
+    relative = thumbnails.thumbnail_path(sha256, size)
+    stat = await asyncio.to_thread(os.stat, media_path(relative))
+    return media_response(request, relative, f'"{sha256}-{size}"', 'image/jpeg', stat.st_size)
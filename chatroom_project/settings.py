@@ -107,12 +107,54 @@ WSGI_APPLICATION = 'chatroom_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# CHAT_DB_PROFILE picks the database:
+#   'sqlite'   one file for a single node. The WAL journal lets reads run
+#              while a write is in progress, and IMMEDIATE transactions with a
+#              busy timeout make concurrent writers wait their turn instead
+#              of failing with "database is locked".
+#   'postgres' for several workers. With CHAT_DB_POOL=1 connections come from
+#              psycopg's pool (pip install "psycopg[pool]") rather than being
+#              kept open per thread.
+# CHAT_DB_CONN_MAX_AGE defaults to 0, closing connections after each request.
+# Under ASGI, queries run on executor threads that come and go, and each one
+# would otherwise keep its own connection open for the full age. For reuse on
+# Postgres, set CHAT_DB_POOL instead. Connections are checked before reuse.
+CHAT_DB_PROFILE = os.environ.get('CHAT_DB_PROFILE', 'sqlite')
+CHAT_DB_CONN_MAX_AGE = int(os.environ.get('CHAT_DB_CONN_MAX_AGE', 0))
+CHAT_DB_BUSY_TIMEOUT = 20
+CHAT_DB_POOL = os.environ.get('CHAT_DB_POOL') in ('1', 'true')
+
+if CHAT_DB_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('CHAT_DB_NAME', 'chatroom'),
+            'USER': os.environ.get('CHAT_DB_USER', 'chatroom'),
+            'PASSWORD': os.environ.get('CHAT_DB_PASSWORD', ''),
+            'HOST': os.environ.get('CHAT_DB_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('CHAT_DB_PORT', '5432'),
+            # Pooled connections go back to the pool instead of staying open.
+            'CONN_MAX_AGE': 0 if CHAT_DB_POOL else CHAT_DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {'min_size': 2, 'max_size': 20, 'timeout': CHAT_DB_BUSY_TIMEOUT},
+            } if CHAT_DB_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': CHAT_DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': CHAT_DB_BUSY_TIMEOUT,
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -174,6 +216,21 @@ SMSLEOPARD_ACCESS_TOKEN=  'alA4aXRHVHc2OG9QUGF2a0dxYVc6M01pSldhYUhDMlF2eVdnNHdYZ
 SMSLEOPARD_SENDER_ID =  'alA4aXRHVHc2OG9QUGF2a0dxYVc6M01pSldhYUhDMlF2eVdnNHdYZnpNUjMzQzZZeFNNTVUyQmN4aEhuYg=='
 BASE_URL = 'http://shawazi.com'
 
+# Background SMS dispatch (chat.sms).
+SMS_DISPATCHER_WORKERS = 2
+SMS_TIMEOUT = (3.05, 10)  # connect, read
+SMS_MAX_RETRIES = 3
+SMS_RETRY_BACKOFF = 0.5
+SMS_RATE_LIMIT = 10  # requests per second per provider
+SMS_BULK_MAX_INVITATIONS = 1000
+SMS_BULK_CHUNK_SIZE = 100  # destinations per provider request
+# `manage.py sweep_invitations` resends invitations still queued after this long.
+SMS_REQUEUE_AFTER_MINUTES = 30
+
+# Expired invitations are removed by `manage.py sweep_invitations`.
+INVITATION_SWEEP_BATCH_SIZE = 500
+INVITATION_SWEEP_GRACE_HOURS = 0
+
 CSRF_TRUSTED_ORIGINS = ['http://localhost:8000', 'https://shawazi.com']
 DEBUG = True
 LOGGING = {
@@ -197,14 +254,147 @@ LOGGING = {
 
 
 
+RABBITMQ_HOST = 'localhost'
+RABBITMQ_QUEUE = 'chat_messages'
+RABBITMQ_PUBLISHER_POOL_SIZE = 4
+RABBITMQ_PUBLISHER_CONFIRMS = True
+# Messages per background publish; 1 publishes inline on the request thread.
+RABBITMQ_PUBLISH_BATCH_SIZE = 1
+RABBITMQ_PUBLISH_BATCH_INTERVAL = 0.05
+# Unacked deliveries per consumer connection, and how many of them are
+# dispatched to the channel layer at once.
+RABBITMQ_CONSUMER_PREFETCH = 50
+RABBITMQ_CONSUMER_CONCURRENCY = 20
+# Seconds to collect messages per room before relaying them as one event;
+# 0 relays every message on its own.
+RABBITMQ_CONSUMER_BATCH_WINDOW = 0.0
+RABBITMQ_CONSUMER_MAX_BATCH = 100
+
+# Write-behind persistence of WebSocket messages (chat.persistence).
+CHAT_WRITE_BUFFER_BATCH_SIZE = 500
+CHAT_WRITE_BUFFER_FLUSH_INTERVAL = 0.1
+CHAT_WRITE_BUFFER_MAX_PENDING = 10000
+# Attempts after the first for messages that failed with a transient database
+# error, such as a lock timeout.
+CHAT_WRITE_BUFFER_RETRIES = 3
+
+# Messages kept per room for WebSocket reconnects (chat.replay), and the most
+# sent in one catch-up frame.
+CHAT_REPLAY_SIZE = 500
+CHAT_REPLAY_MAX_MESSAGES = 500
+
+# Frames queued per WebSocket before a slow reader hits CHAT_SEND_QUEUE_POLICY:
+# 'drop_oldest', 'coalesce' or 'disconnect' (chat.sendqueue).
+CHAT_SEND_QUEUE_SIZE = 256
+CHAT_SEND_QUEUE_POLICY = 'coalesce'
+
+# Message budgets as (messages per second, burst), for every sender and every
+# room, over WebSocket and REST alike (chat.ratelimit). None disables one.
+# 'memory' keeps them per process, 'cache' shares them through
+# CACHES[CHAT_RATE_LIMIT_CACHE].
+CHAT_RATE_LIMIT_USER = (5, 20)
+CHAT_RATE_LIMIT_ROOM = (100, 300)
+CHAT_RATE_LIMIT_BACKEND = os.environ.get('CHAT_RATE_LIMIT_BACKEND', 'memory')
+CHAT_RATE_LIMIT_CACHE = 'default'
+CHAT_RATE_LIMIT_MAX_KEYS = 100000
+
+# Message search (chat.search): 'fts5', 'inverted', or None to use SQLite FTS5
+# when the database has it. FTS5 ranks the newest CHAT_SEARCH_RANK_WINDOW
+# matches; results are paged by offset, up to CHAT_SEARCH_MAX_OFFSET.
+CHAT_SEARCH_BACKEND = None
+CHAT_SEARCH_RANK_WINDOW = 2000
+CHAT_SEARCH_MAX_OFFSET = 1000
+
+# Messages older than CHAT_ARCHIVE_AFTER_DAYS are moved by archive_messages
+# into gzip segments of CHAT_ARCHIVE_SEGMENT_SIZE messages under
+# CHAT_ARCHIVE_ROOT, compressed in blocks of CHAT_ARCHIVE_BLOCK_SIZE
+# (chat.archive).
+CHAT_ARCHIVE_ROOT = BASE_DIR / 'archive'
+CHAT_ARCHIVE_AFTER_DAYS = 90
+CHAT_ARCHIVE_SEGMENT_SIZE = 10000
+CHAT_ARCHIVE_BLOCK_SIZE = 256
+
+# Room/user id lookups cached per process (chat.cache). Renames and deletes
+# only invalidate the cache of the process that made them; other workers may
+# keep serving the old id for up to CHAT_LOOKUP_CACHE_TTL seconds.
+CHAT_LOOKUP_CACHE_SIZE = 10000
+CHAT_LOOKUP_CACHE_TTL = 300
+
+# Live presence per room (chat.presence). Connections silent for longer than
+# PRESENCE_TIMEOUT seconds count as gone; joins and leaves are broadcast at
+# most once per PRESENCE_BROADCAST_INTERVAL, and only as a count once more
+# than PRESENCE_MAX_DIFF users changed.
+PRESENCE_TIMEOUT = 90
+PRESENCE_BROADCAST_INTERVAL = 1.0
+PRESENCE_MAX_DIFF = 100
+PRESENCE_SWEEP_INTERVAL = 15
+
+# Mention notifications (chat.notifications).
+NOTIFICATION_PAGE_SIZE = 50
+NOTIFICATION_MAX_MENTIONS = 20
+
 MEDIA_URL= '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
-        },
+# Uploads are stored under MEDIA_ROOT/uploads by SHA-256 (chat.media).
+MEDIA_UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+MEDIA_UPLOAD_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# Unfinished uploads idle for this long are removed by `manage.py sweep_uploads`.
+MEDIA_UPLOAD_EXPIRY_HOURS = 24
+# Hand file bodies to the front-end server instead of streaming them from
+# Django: 'X-Accel-Redirect' (nginx, with an internal location at
+# MEDIA_SENDFILE_ROOT aliased to MEDIA_ROOT) or 'X-Sendfile' (Apache).
+MEDIA_SENDFILE_HEADER = None
+MEDIA_SENDFILE_ROOT = '/protected-media/'
+# Preview sizes (longest side, px) rendered for images; requires Pillow.
+MEDIA_THUMBNAIL_SIZES = (128, 512)
+MEDIA_THUMBNAIL_WORKERS = 2
+
+# 'redis' for multi-node deployments, 'memory' for a single process (and tests),
+# 'hybrid' for local delivery with Redis relaying between worker processes.
+CHAT_CHANNEL_LAYER = os.environ.get('CHAT_CHANNEL_LAYER', 'redis')
+
+REDIS_CHANNEL_LAYER = {
+    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+    'CONFIG': {
+        "hosts": [('127.0.0.1', 6379)],
     },
 }
+
+if CHAT_CHANNEL_LAYER == 'memory':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.ShardedInMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': 100,
+                'expiry': 60,
+            },
+        },
+    }
+elif CHAT_CHANNEL_LAYER == 'hybrid':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.HybridChannelLayer',
+            'CONFIG': {
+                'relay': REDIS_CHANNEL_LAYER,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': REDIS_CHANNEL_LAYER,
+    }
+
+# Encode chat and presence frames once per event for every WebSocket codec
+# (chat.protocol) instead of once per recipient. Only for in-process
+# delivery: channels_redis stores a copy of each event per recipient, so
+# every codec's frame would multiply the Redis traffic. On that layer each
+# consumer encodes its own frame.
+CHAT_PREENCODE_FRAMES = CHAT_CHANNEL_LAYER in ('memory', 'hybrid')
+
+# Presence (chat.presence) is kept in the worker process with the in-process
+# channel layer and shared between workers through Redis (PRESENCE_REDIS_URL)
+# otherwise. Set CHAT_PRESENCE=0 to stop tracking it.
+PRESENCE_BACKEND = os.environ.get('CHAT_PRESENCE_BACKEND', 'memory' if CHAT_CHANNEL_LAYER == 'memory' else 'redis')
+PRESENCE_REDIS_URL = os.environ.get('CHAT_PRESENCE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+PRESENCE_ENABLED = os.environ.get('CHAT_PRESENCE', '1') in ('1', 'true')
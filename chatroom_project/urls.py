@@ -16,10 +16,13 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import include, path
+from chat.views import serve_media, serve_thumbnail
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('chat/', include('chat.urls')),
     path('api/chat/', include('chat.urls')),
+    path('media/uploads/<str:prefix>/<str:sha256>', serve_media, name='serve_media'),
+    path('media/thumbs/<str:sha256>/<int:size>', serve_thumbnail, name='serve_thumbnail'),
 
 ]